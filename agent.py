@@ -1,95 +1,80 @@
+import asyncio
 import json
-import os
 import time
-from typing import Any, Dict, List, Literal, Optional, TypedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, List, Literal, Optional, Tuple, TypedDict
 
-import paramiko
+import jiter
+import openai  # для перехвата openai.RateLimitError
 from dotenv import load_dotenv
-from langchain_core.messages import HumanMessage, SystemMessage
-from langchain_openai import ChatOpenAI
+from langchain_core.caches import BaseCache
+from langchain_core.messages import (
+    AIMessage,
+    BaseMessage,
+    HumanMessage,
+    SystemMessage,
+    message_chunk_to_message,
+)
+from langchain_core.outputs import ChatGeneration
+from langgraph.config import get_config
 from langgraph.graph import END, StateGraph
 
+from bootstrap import ENABLED as BOOTSTRAP_ENABLED
+from bootstrap import bundle as bootstrap_bundle
+from bootstrap import for_llm as facts_for_llm
+from checkpoints import get_checkpointer, get_run_store
+
+from context_budget import (
+    compact_steps,
+    count_call,
+    empty_usage,
+    estimate_tokens,
+    usage_line,
+)
+from facts_cache import ENABLED as FACTS_ENABLED
+from facts_cache import FACTS
+from fleet import (
+    FLEET_CONCURRENCY,
+    compact_groups,
+    group_results,
+    load_inventory,
+    run_on_fleet,
+)
+from history import record_report
+from jobs import brief as job_brief
+from jobs import is_long_running, job_result, started_result
+from jobs import poll as poll_job
+from jobs import start as start_job
+from jobs import wait as wait_job
+from llm_cache import cache_key, get_llm_cache
+from llm_scheduler import ScheduledChatModel, get_llm
+from output_delta import delta_steps
+from parsers import attach as attach_parsed
+from parsers import for_llm
+from pkgops import merge_commands
+from pkgops import record as record_pkg_op
+from pkgops import skip as skip_pkg_op
+from playbooks import ENABLED as PLAYBOOKS_ENABLED
+from playbooks import PLAYBOOKS, diverged
+from policy import POLICY
+from report_stream import ReportWriter, report_path
+from ssh_pool import POOL, SSH_EXECUTOR, run_blocking
+from ssh_stream import read_channel
+from step_store import STEPS
+
 load_dotenv()
 
 # -----------------------------
 # 1) Policy (охрана труда)
 # -----------------------------
 
-READONLY_PREFIXES = (
-    "uname",
-    "uptime",
-    "date",
-    "whoami",
-    "id",
-    "cat /etc/os-release",
-    "df",
-    "free",
-    "ps",
-    "top -b -n1",
-    "systemctl status",
-    "journalctl",
-    "ss ",
-    "ip a",
-    "ip r",
-    "ping ",
-    "dig ",
-    "nslookup ",
-    "tail ",
-    "head ",
-    "grep ",
-    "ls ",
-    "stat ",
-    "du ",
-)
-
-# "Мягкие" изменения: обратимые или ограниченно рискованные
-CHANGE_PREFIXES = (
-    "apt-get update",
-    "apt-get upgrade",
-    "apt-get install",
-    "apt-get remove",
-    "dnf update",
-    "dnf install",
-    "dnf remove",
-    "yum update",
-    "yum install",
-    "yum remove",
-    "systemctl restart",
-    "systemctl reload",
-)
-
-DENY_TOKENS = (
-    "ssh ",
-    "rm -rf",
-    "mkfs",
-    "dd ",
-    ">:",
-    "iptables -F",
-    "nft flush",
-    "shutdown",
-    "reboot",
-    ":(){",
-    "curl | sh",
-    "wget | sh",
-)
+# Правила — в policy.json (общие с agent_tc), см. policy.py
 
 
 def classify_command(cmd: str) -> Literal["readonly", "change", "deny"]:
-    c = cmd.strip()
-
-    for tok in DENY_TOKENS:
-        if tok in c:
-            return "deny"
-
-    for p in READONLY_PREFIXES:
-        if c.startswith(p):
-            return "readonly"
-
-    for p in CHANGE_PREFIXES:
-        if c.startswith(p):
-            return "change"
-
-    return "deny"
+    kind = POLICY.check(cmd).kind
+    # вне allowlist — запрещено
+    return "deny" if kind == "unknown" else kind
 
 
 # -----------------------------
@@ -105,29 +90,17 @@ def run_ssh(
     cmd: str,
     timeout: int = 60,
 ) -> Dict[str, Any]:
-    kind = classify_command(cmd)
+    verdict = POLICY.check(cmd)
+    kind = "deny" if verdict.kind == "unknown" else verdict.kind
     if kind == "deny":
         return {
             "ok": False,
-            "error": f"Command denied by policy: {cmd}",
+            "error": f"Command denied by policy ({verdict.rule or 'not in allowlist'}): {cmd}",
             "cmd": cmd,
             "kind": kind,
         }
 
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-
-    connect_kwargs: Dict[str, Any] = {
-        "hostname": host,
-        "username": user,
-        "timeout": 10,
-    }
-
-    if key_path:
-        connect_kwargs["key_filename"] = key_path
-    elif password:
-        connect_kwargs["password"] = password
-    else:
+    if not key_path and not password:
         return {
             "ok": False,
             "error": "No auth method provided",
@@ -135,15 +108,37 @@ def run_ssh(
             "kind": kind,
         }
 
-    ssh.connect(**connect_kwargs)
-
-    stdin, stdout, stderr = ssh.exec_command(cmd, timeout=timeout)
-    out = stdout.read().decode(errors="replace")
-    err = stderr.read().decode(errors="replace")
-    code = stdout.channel.recv_exit_status()
-    ssh.close()
-
-    return {
+    if FACTS_ENABLED and kind == "readonly":
+        hit = FACTS.get(host, user, cmd)
+        if hit:
+            r = hit["result"]
+            return attach_parsed(
+                {
+                    "ok": True,
+                    "cmd": cmd,
+                    "kind": kind,
+                    "exit_code": r["exit_code"],
+                    "stdout": r["stdout"],
+                    "stderr": r["stderr"],
+                    "cached": True,
+                    "cache_age_s": hit["age_s"],
+                }
+            )
+
+    # Соединение берём из пула: handshake один раз на хост, дальше — новый channel
+    with POOL.session(host, user, key_path=key_path, password=password) as chan:
+        chan.exec_command(cmd)
+        res = read_channel(chan, timeout)
+
+    code = res["exit_code"]
+    out = res["stdout"]
+    err = res["stderr"]
+    if res["timed_out"]:
+        err += f"\n[timeout: command did not finish in {timeout}s]"
+    if res["capped"]:
+        err += f"\n[output cap reached after {res['bytes_in']} bytes, command stopped]"
+
+    result = {
         "ok": code == 0,
         "cmd": cmd,
         "kind": kind,
@@ -151,6 +146,45 @@ def run_ssh(
         "stdout": out,
         "stderr": err,
     }
+    if FACTS_ENABLED:
+        if kind == "readonly":
+            FACTS.put(host, user, cmd, result)
+        elif kind == "change":
+            FACTS.invalidate(host, cmd)
+    # разбор по полному выводу, пока отчёт его не урезал
+    return attach_parsed(result)
+
+
+def run_ssh_fleet(
+    hosts: List[str],
+    user: str,
+    key_path: Optional[str],
+    password: Optional[str],
+    cmd: str,
+    concurrency: int = FLEET_CONCURRENCY,
+) -> Dict[str, Any]:
+    kind = classify_command(cmd)
+    if kind == "deny":
+        return {
+            "ok": False,
+            "error": f"Command denied by policy: {cmd}",
+            "cmd": cmd,
+            "kind": kind,
+        }
+
+    results = run_on_fleet(
+        hosts,
+        lambda h: run_ssh(h, user, key_path, password, cmd),
+        concurrency=concurrency,
+    )
+    groups = group_results(results)
+    return {
+        "ok": all(g["ok"] for g in groups),
+        "cmd": cmd,
+        "kind": kind,
+        "exit_code": groups[0]["exit_code"] if len(groups) == 1 else "mixed",
+        "groups": groups,
+    }
 
 
 # -----------------------------
@@ -161,19 +195,32 @@ def run_ssh(
 class AgentState(TypedDict, total=False):
     goal: str
     host: str
+    hosts: List[str]  # fleet-режим: команда выполняется на всех хостах
+    concurrency: int
     user: str
-    password: Optional[str]
-    key_path: Optional[str]
-    steps: List[Dict[str, Any]]
-    transcript: List[Dict[str, str]]
+    key_path: Optional[str]  # пароль — только в config (ssh_password), не в чекпойнтах
+    steps: List[Dict[str, Any]]  # ссылки на шаги (step_store.make_ref); сами шаги — в STEPS
+    host_facts: Dict[str, Any]  # bootstrap-проба до первого шага (см. bootstrap.py)
     done: bool
     max_steps: int
 
     # внутренние поля (чтобы не ругался типизатор)
     _next_command: str
+    _next_commands: List[str]  # пачка независимых read-only команд
+    _round: int
     _success_criteria: str
     _rationale: str
     _report_md: str
+    _report_path: str  # отчёт пишется по шагам (report_stream)
+    _prefetched: Dict[str, Dict[str, Any]]  # команда -> результат, начатый до конца ответа LLM
+    _jobs: List[Dict[str, Any]]  # фоновые задачи, которые ещё идут (см. jobs.py)
+    _playbook: Dict[str, Any]  # совпавший плейбук ({} — нет или уже разошёлся)
+    _pb_pos: int  # сколько его раундов уже отдано executor'у
+    _pb_note: str
+    _pb_proposal: List[str]  # раунд плейбука с change-командами: ждёт решения LLM
+    _stopped_by: str  # "planner" | "playbook": кто решил, что цель достигнута
+    _llm_cache_base: Dict[str, int]  # счётчики кэша LLM на старте прогона
+    _tokens: Dict[str, int]  # расход токенов планировщиком за прогон
 
 
 # -----------------------------
@@ -181,16 +228,9 @@ class AgentState(TypedDict, total=False):
 # -----------------------------
 
 
-def make_llm() -> ChatOpenAI:
-    api_key = os.environ["OPENROUTER_API_KEY"]
-    model = os.environ.get("OPENROUTER_MODEL", "openai/gpt-4o-mini")
-
-    return ChatOpenAI(
-        model=model,
-        api_key=api_key,
-        base_url="https://openrouter.ai/api/v1",
-        temperature=0.1,
-    )
+def make_llm() -> ScheduledChatModel:
+    # общий клиент процесса: token bucket, повторы с backoff и fallback-модели
+    return get_llm()
 
 
 SYSTEM = """Ты автономный помощник системного администратора.
@@ -214,9 +254,29 @@ SYSTEM = """Ты автономный помощник системного ад
 - кавычки вокруг всей команды
 - && между несколькими действиями
 
-Одна команда за шаг.
+Одна команда за шаг. Исключение — диагностика: если нужно несколько
+НЕЗАВИСИМЫХ read-only команд (df -h, free -h, uptime, ...), перечисли их
+в "next_commands" — они выполнятся параллельно. Изменяющие команды
+(apt-get, systemctl restart, ...) — только по одной через "next_command".
 
 Правила:
+- В контексте может быть host_facts: ядро, ОС, память, диски, упавшие юниты и
+  свежие ошибки уже собраны одной пробой. Не запрашивай их повторно без причины.
+- playbook_proposal — изменяющие команды из прошлого успешного прогона той же
+  цели. Если по текущим шагам они уместны, верни их в next_command, иначе
+  планируй сам.
+- Если команда уже выполнялась, её шаг содержит "delta": stdout/stderr — это
+  "[unchanged since step N]" или unified diff к выводу шага N.
+- Вывод df, free, ps, ss, systemctl --failed, journalctl -p и dpkg -l приходит
+  разобранным в поле "parsed" вместо stdout; сырой текст сохранён в отчёте.
+- Долгие apt-get/dnf/yum install/upgrade/update запускаются фоновой задачей:
+  шаг сразу возвращает "[started as background job ...]", задача видна в
+  background_jobs, а её итог придёт отдельным шагом с "background": true.
+  Пока она идёт, можно делать read-only диагностику; следующая изменяющая
+  команда дождётся её завершения.
+- Пакеты ставь одной командой (apt-get install -y a b c): несколько install
+  подряд в "next_commands" всё равно склеятся в одну. apt-get update при
+  свежих индексах вернёт "[skipped: ...]" — это успех, повторять не нужно.
 - Сначала диагностика (read-only), затем осторожные изменения.
 - Запрещено придумывать опасные команды (rm -rf, mkfs, dd, iptables flush, reboot/shutdown и т.п.).
 - Если не уверен — собирай больше фактов.
@@ -225,6 +285,7 @@ SYSTEM = """Ты автономный помощник системного ад
 {
   "rationale": "кратко почему так",
   "next_command": "одна команда",
+  "next_commands": ["необязательно: несколько read-only команд вместо next_command"],
   "success_criteria": "как поймём, что шаг помог",
   "stop": false
 }
@@ -232,24 +293,99 @@ SYSTEM = """Ты автономный помощник системного ад
 """
 
 
-def planner_node(state: AgentState) -> AgentState:
-    llm = make_llm()
+MAX_BATCH = 8  # не больше, чем каналов на одно соединение в пуле
+
 
-    last_steps = state["steps"][-5:]
+def _plan_commands(plan: Dict[str, Any], budget: int) -> List[str]:
+    """
+    Команды на этот раунд: пачка допускается только из readonly-команд,
+    change-команды выполняются строго по одной.
+    """
+    batch = [c.strip() for c in plan.get("next_commands") or [] if isinstance(c, str)]
+    # install/remove подряд — одной транзакцией: один dpkg lock вместо нескольких
+    batch = merge_commands([c for c in dict.fromkeys(batch) if c])
+    single = (plan.get("next_command") or "").strip()
+
+    if len(batch) > 1:
+        readonly = [c for c in batch if classify_command(c) == "readonly"]
+        if readonly:
+            return readonly[: max(1, min(MAX_BATCH, budget))]
+        # в пачке нет read-only — берём первую команду и идём последовательно
+        return batch[:1]
+    if batch:
+        return batch
+    return [single] if single else []
+
+
+# поля шага, которые разнятся между прогонами при тех же командах и выводе:
+# с ними промпт планировщика не совпал бы с записью в кэше LLM
+_VOLATILE_STEP_KEYS = ("ts", "round", "early", "duration_s", "cache_age_s")
+
+
+def _step_for_llm(step: Dict[str, Any]) -> Dict[str, Any]:
+    out = {k: v for k, v in step.items() if k not in _VOLATILE_STEP_KEYS}
+    if "groups" in out:
+        out["groups"] = compact_groups(out["groups"])
+    return out
+
+
+def _step_payloads(state: AgentState) -> List[Dict[str, Any]]:
+    refs = state["steps"]
+    got = iter(STEPS.get(state["_report_path"], [r["id"] for r in refs if "id" in r]))
+    # шаги без id — из чекпойнта до step_store, они в состоянии целиком
+    return [next(got) if "id" in r else r for r in refs]
+
+
+def _note(state: AgentState, role: str, content: str) -> None:
+    # транскрипт — в файл рядом с отчётом, не в состояние графа
+    STEPS.note(state["_report_path"], role, content)
+
+
+def _planner_prompt(state: AgentState) -> Tuple[List[BaseMessage], int, int]:
+    """Сообщения для планировщика и оценка токенов: (msgs, без сжатия, после)."""
+    # свежие шаги — целиком, старые — сводками, всё в пределах бюджета токенов;
+    # повторы команд — дельтой к прошлому запуску, известные таблицы — записями parsed
+    steps = _step_payloads(state)
+    all_steps = [_step_for_llm(s) for s in steps]
+    sent_steps = [_step_for_llm(for_llm(s)) for s in delta_steps(steps)]
     context = {
         "goal": state["goal"],
         "host": state["host"],
-        "recent_steps": last_steps,
+        "recent_steps": compact_steps(sent_steps),
         "policy_note": "Команды вне allowlist будут отклонены.",
         "remaining_budget": state["max_steps"] - len(state["steps"]),
     }
+    if state.get("host_facts"):
+        context["host_facts"] = facts_for_llm(state["host_facts"])
+    if state.get("_pb_note"):
+        context["playbook_note"] = state["_pb_note"]
+    if state.get("_pb_proposal"):
+        context["playbook_proposal"] = {
+            "commands": state["_pb_proposal"],
+            "note": "Этот раунд изменений записан в успешном прогоне той же цели. "
+            "Выполни его, только если он подходит по текущим шагам.",
+        }
+    if state.get("_jobs"):
+        context["background_jobs"] = [job_brief(j) for j in state["_jobs"]]
+    if state.get("hosts"):
+        context["fleet_note"] = (
+            f"Команда выполняется на всех {len(state['hosts'])} хостах; "
+            "одинаковые результаты сгруппированы (groups)."
+        )
 
     msgs = [
         SystemMessage(content=SYSTEM),
         HumanMessage(content="Контекст:\n" + json.dumps(context, ensure_ascii=False)),
     ]
+    # оценки в одних единицах (json без ensure_ascii), иначе "экономия" уходит в минус
+    full = estimate_tokens({**context, "recent_steps": all_steps})
+    sent = estimate_tokens(context)
+    return msgs, full, sent
+
 
-    resp = llm.invoke(msgs).content
+def _apply_plan(state: AgentState, answer: BaseMessage, full: int, sent: int) -> AgentState:
+    resp = answer.content
+    state["_tokens"] = count_call(state.get("_tokens") or empty_usage(), full, sent, answer)
     try:
         plan = json.loads(resp)
     except Exception:
@@ -260,113 +396,551 @@ def planner_node(state: AgentState) -> AgentState:
             "stop": False,
         }
 
-    state["transcript"].append({"role": "planner", "content": resp})
-    state["transcript"].append(
-        {"role": "planner_parsed", "content": json.dumps(plan, ensure_ascii=False)}
-    )
+    _note(state, "planner", resp)
+    _note(state, "planner_parsed", json.dumps(plan, ensure_ascii=False))
 
-    if plan.get("stop") is True or len(state["steps"]) >= state["max_steps"]:
+    budget_left = len(state["steps"]) < state["max_steps"]
+    if plan.get("stop") is True and state.get("_jobs") and budget_left:
+        # фоновые задачи ещё идут: executor дождётся их, решение — после их итога
+        state["_next_commands"] = []
+        state["_next_command"] = ""
+        _note(state, "planner", "waiting for background jobs")
+        return state
+    if plan.get("stop") is True or not budget_left:
         state["done"] = True
+        if plan.get("stop") is True:
+            state["_stopped_by"] = "planner"
+        # иначе executor повторит команды прошлого раунда
+        state["_next_commands"] = []
+        state["_next_command"] = ""
         return state
 
-    state["_next_command"] = plan.get("next_command", "") or ""
+    cmds = _plan_commands(plan, state["max_steps"] - len(state["steps"]))
+    state["_next_commands"] = cmds
+    state["_next_command"] = cmds[0] if cmds else ""
     state["_success_criteria"] = plan.get("success_criteria", "") or ""
     state["_rationale"] = plan.get("rationale", "") or ""
-    state["transcript"].append(
-        {"role": "next_command", "content": state["_next_command"]}
-    )
+    _note(state, "next_command", "\n".join(cmds))
     return state
 
 
-def executor_node(state: AgentState) -> AgentState:
-    cmd = state.get("_next_command", "")
-    if not cmd:
+def bootstrap_node(state: AgentState) -> AgentState:
+    """
+    До первого планирования: базовые факты о хосте (флоте) одним SSH-вызовом
+    и поиск плейбука по цели и ОС.
+    """
+    if BOOTSTRAP_ENABLED and "host_facts" not in state:
+        facts = bootstrap_bundle(
+            host=state["host"],
+            user=state["user"],
+            key_path=state.get("key_path"),
+            password=get_config()["configurable"].get("ssh_password"),
+            hosts=state.get("hosts") or None,
+            concurrency=state.get("concurrency", FLEET_CONCURRENCY),
+        )
+        state["host_facts"] = facts
+        ReportWriter(state["_report_path"]).add_section(
+            "Host facts", ["```json", json.dumps(facts, ensure_ascii=False, indent=2), "```"]
+        )
+    if PLAYBOOKS_ENABLED and "_playbook" not in state:
+        state["_playbook"] = PLAYBOOKS.get(state["goal"], state.get("host_facts")) or {}
+        state["_pb_pos"] = 0
+    return state
+
+
+async def abootstrap_node(state: AgentState) -> AgentState:
+    return await run_blocking(bootstrap_node, state)
+
+
+# Ответ планировщика читаем потоком: как только в частично разобранном JSON
+# появилась готовая read-only команда, она уходит на SSH, пока модель ещё
+# дописывает success_criteria. Изменяющие команды ждут полного ответа:
+# модель может закончить план через stop=true.
+
+JSON_MODE = {"type": "json_object"}
+
+
+def _partial_plan(buf: str) -> Dict[str, Any]:
+    try:
+        # partial_mode="on": недописанная строка отбрасывается, готовые значения — целиком
+        plan = jiter.from_json(buf.encode("utf-8"), partial_mode="on")
+    except ValueError:
+        return {}
+    return plan if isinstance(plan, dict) else {}
+
+
+def _early_commands(plan: Dict[str, Any], budget: int) -> List[str]:
+    """Команды из недописанного плана, которые уже безопасно запускать."""
+    if plan.get("stop") is True or budget <= 0:
+        return []
+    cands = [plan.get("next_command")] + list(plan.get("next_commands") or [])
+    cands = [c.strip() for c in cands if isinstance(c, str) and c.strip()]
+    ready = [c for c in dict.fromkeys(cands) if classify_command(c) == "readonly"]
+    return ready[: min(MAX_BATCH, budget)]
+
+
+def _cached_answer(llm, msgs: List[BaseMessage]) -> Tuple[Optional[BaseMessage], Any]:
+    # stream() мимо кэша LLM — смотрим в него сами
+    cache = llm.cache if isinstance(llm.cache, BaseCache) else None
+    if cache is None:
+        return None, None
+    key = cache_key(llm, msgs, response_format=JSON_MODE)
+    hit = cache.lookup(*key)
+    return (hit[0].message if hit else None), (cache, key)
+
+
+def _store_answer(slot: Any, answer: BaseMessage) -> None:
+    if slot is not None:
+        cache, key = slot
+        cache.update(*key, [ChatGeneration(message=answer)])
+
+
+def _stream_plan(state: AgentState, msgs: List[BaseMessage], dispatch) -> BaseMessage:
+    llm = make_llm()
+    cached, slot = _cached_answer(llm, msgs)
+    if cached is not None:
+        return cached
+    budget = state["max_steps"] - len(state["steps"])
+    buf, answer = "", None
+    for chunk in llm.stream(msgs, response_format=JSON_MODE):
+        answer = chunk if answer is None else answer + chunk
+        if isinstance(chunk.content, str) and chunk.content:
+            buf += chunk.content
+            for cmd in _early_commands(_partial_plan(buf), budget):
+                dispatch(cmd)
+    answer = message_chunk_to_message(answer) if answer is not None else AIMessage(content="")
+    _store_answer(slot, answer)
+    return answer
+
+
+async def _astream_plan(state: AgentState, msgs: List[BaseMessage], dispatch) -> BaseMessage:
+    llm = make_llm()
+    cached, slot = await run_blocking(_cached_answer, llm, msgs)
+    if cached is not None:
+        return cached
+    budget = state["max_steps"] - len(state["steps"])
+    buf, answer = "", None
+    async for chunk in llm.astream(msgs, response_format=JSON_MODE):
+        answer = chunk if answer is None else answer + chunk
+        if isinstance(chunk.content, str) and chunk.content:
+            buf += chunk.content
+            for cmd in _early_commands(_partial_plan(buf), budget):
+                dispatch(cmd)
+    answer = message_chunk_to_message(answer) if answer is not None else AIMessage(content="")
+    await run_blocking(_store_answer, slot, answer)
+    return answer
+
+
+def _replay_round(state: AgentState) -> bool:
+    """
+    Следующий раунд плейбука вместо вызова LLM. False — плейбука нет,
+    прошлый раунд разошёлся с записью или следующий раунд что-то меняет
+    (тогда он уходит LLM как _pb_proposal); план строит LLM.
+    """
+    pb = state.get("_playbook")
+    state["_pb_proposal"] = []
+    if not pb:
+        return False
+    pos = state.get("_pb_pos", 0)
+    if pos > 0:
+        last = [s for s in state["steps"] if s.get("round") == state.get("_round")]
+        reason = diverged(pb["rounds"][pos - 1], last)
+        if reason:
+            state["_playbook"] = {}
+            state["_pb_note"] = f"playbook {pb['id']} diverged at round {pos}: {reason}"
+            _note(state, "playbook", state["_pb_note"])
+            return False
+
+    state["_prefetched"] = {}
+    budget = state["max_steps"] - len(state["steps"])
+    cmds: List[str] = []
+    if pos < len(pb["rounds"]) and budget > 0:
+        cmds = _plan_commands({"next_commands": pb["rounds"][pos]["cmds"]}, budget)
+    if not cmds:
         state["done"] = True
+        state["_next_commands"] = []
+        state["_next_command"] = ""
+        if pos >= len(pb["rounds"]):
+            state["_stopped_by"] = "playbook"
+            state["_pb_note"] = f"playbook {pb['id']} replayed: {pos} rounds"
+        return True
+
+    if any(classify_command(c) == "change" for c in cmds):
+        # изменения вслепую не повторяем: раунд решает LLM, а сверка с записью —
+        # на следующем вызове, как для обычного раунда
+        state["_pb_proposal"] = cmds
+        state["_pb_pos"] = pos + 1
+        _note(state, "playbook", "proposed to planner:\n" + "\n".join(cmds))
+        return False
+
+    state["_next_commands"] = cmds
+    state["_next_command"] = cmds[0]
+    state["_rationale"] = f"playbook {pb['id']}, round {pos + 1}/{len(pb['rounds'])}"
+    state["_success_criteria"] = "exit codes as recorded: " + ", ".join(
+        str(c) for c in pb["rounds"][pos]["exit_codes"]
+    )
+    state["_pb_pos"] = pos + 1
+    _note(state, "playbook", "\n".join(cmds))
+    return True
+
+
+def planner_node(state: AgentState) -> AgentState:
+    if _replay_round(state):
         return state
+    msgs, full, sent = _planner_prompt(state)
+    password = get_config()["configurable"].get("ssh_password")
+    early: Dict[str, Future] = {}
+
+    def dispatch(cmd: str) -> None:
+        if cmd not in early:
+            early[cmd] = SSH_EXECUTOR.submit(_execute, state, cmd, password)
+
+    state = _apply_plan(state, _stream_plan(state, msgs, dispatch), full, sent)
+    # результаты команд, которые остались в итоговом плане; ошибку executor
+    # получит сам, повторив команду
+    prefetched = {}
+    for cmd in _pending_commands(state):
+        if cmd in early:
+            try:
+                prefetched[cmd] = early[cmd].result()
+            except Exception:
+                pass
+    state["_prefetched"] = prefetched
+    return state
+
 
-    result = run_ssh(
+async def aplanner_node(state: AgentState) -> AgentState:
+    if _replay_round(state):
+        return state
+    msgs, full, sent = _planner_prompt(state)
+    password = get_config()["configurable"].get("ssh_password")
+    early: Dict[str, asyncio.Future] = {}
+
+    def dispatch(cmd: str) -> None:
+        if cmd not in early:
+            fut = asyncio.ensure_future(run_blocking(_execute, state, cmd, password))
+            # лишние (план передумал) никто не ждёт — не теряем их исключения молча
+            fut.add_done_callback(lambda f: f.cancelled() or f.exception())
+            early[cmd] = fut
+
+    state = _apply_plan(state, await _astream_plan(state, msgs, dispatch), full, sent)
+    prefetched = {}
+    for cmd in _pending_commands(state):
+        if cmd in early:
+            try:
+                prefetched[cmd] = await early[cmd]
+            except Exception:
+                pass
+    state["_prefetched"] = prefetched
+    return state
+
+
+def _execute(state: AgentState, cmd: str, password: Optional[str]) -> Dict[str, Any]:
+    if not state.get("hosts"):
+        skipped = skip_pkg_op(state["host"], state["user"], state.get("key_path"), password, cmd)
+        if skipped is not None:
+            return {**skipped, "kind": "change"}
+    if not state.get("hosts") and is_long_running(cmd):
+        # во fleet-режиме задачи не отвязываем: там параллелизм уже по хостам
+        job = start_job(state["host"], state["user"], state.get("key_path"), password, cmd)
+        return {**started_result(job), "_job": job}
+    if state.get("hosts"):
+        return run_ssh_fleet(
+            hosts=state["hosts"],
+            user=state["user"],
+            key_path=state.get("key_path"),
+            password=password,
+            cmd=cmd,
+            concurrency=state.get("concurrency", FLEET_CONCURRENCY),
+        )
+    res = run_ssh(
         host=state["host"],
         user=state["user"],
         key_path=state.get("key_path"),
-        password=state.get("password"),
+        password=password,
         cmd=cmd,
     )
-    result["rationale"] = state.get("_rationale", "")
-    result["success_criteria"] = state.get("_success_criteria", "")
-    result["ts"] = time.time()
-    state["steps"].append(result)
+    record_pkg_op(state["host"], state["user"], cmd, res.get("ok"))
+    return res
+
+
+def _pending_commands(state: AgentState) -> List[str]:
+    return state.get("_next_commands") or (
+        [state["_next_command"]] if state.get("_next_command") else []
+    )
+
+
+def _take_prefetched(state: AgentState) -> Dict[str, Dict[str, Any]]:
+    """Результаты, полученные ещё во время генерации плана (см. planner_node)."""
+    done = dict(state.get("_prefetched") or {})
+    for r in done.values():
+        r["early"] = True
+    # поле без reducer: пустой dict, иначе в графе останется старое значение
+    state["_prefetched"] = {}
+    return done
+
+
+def _poll_jobs(state: AgentState, password: Optional[str], wait: bool = False) -> List[Dict[str, Any]]:
+    """
+    Опрос фоновых задач (wait — до их завершения). Завершённые уходят из
+    _jobs и возвращаются шагами с полным выводом.
+    """
+    running, finished = [], []
+    for job in state.get("_jobs") or []:
+        job = (wait_job if wait else poll_job)(job, state.get("key_path"), password)
+        (running if job["status"] == "running" else finished).append(job)
+    state["_jobs"] = running
+    for job in finished:
+        record_pkg_op(job["host"], job["user"], job["cmd"], job["status"] == "done" and job.get("exit_code") == 0)
+        if FACTS_ENABLED:
+            FACTS.invalidate(job["host"], job["cmd"])
+    return [job_result(j) for j in finished]
+
+
+def _needs_wait(state: AgentState, cmds: List[str]) -> bool:
+    # две изменяющие команды разом не пускаем: apt lock, да и порядок изменений важен
+    return bool(state.get("_jobs")) and any(classify_command(c) == "change" for c in cmds)
+
+
+def _record_results(state: AgentState, results: List[Dict[str, Any]]) -> AgentState:
+    state["_round"] = state.get("_round", 0) + 1
+    for result in results:
+        job = result.pop("_job", None)
+        if job is not None and job["status"] == "running":
+            state["_jobs"] = (state.get("_jobs") or []) + [job]
+        result.setdefault("rationale", state.get("_rationale", ""))
+        result.setdefault("success_criteria", state.get("_success_criteria", ""))
+        result["ts"] = time.time()
+        result["round"] = state["_round"]
+        if len(results) > 1:
+            result["batch_size"] = len(results)
+        # шаг сразу уходит в отчёт и STEPS; в состоянии — только ссылка
+        state["steps"].append(STEPS.add(state["_report_path"], result, _render_step))
     return state
 
 
+def executor_node(state: AgentState) -> AgentState:
+    cmds = _pending_commands(state)
+    password = get_config()["configurable"].get("ssh_password")
+    if not cmds:
+        if state.get("_jobs"):
+            # план ждёт фоновые задачи или прогон кончается: дочитываем их итог
+            return _record_results(state, _poll_jobs(state, password, wait=True))
+        state["done"] = True
+        return state
+
+    finished = _poll_jobs(state, password, wait=_needs_wait(state, cmds))
+    done = _take_prefetched(state)
+    todo = [c for c in cmds if c not in done]
+    if len(todo) <= 1 or state.get("hosts"):
+        # во fleet-режиме параллелизм уже по хостам
+        fresh = [_execute(state, c, password) for c in todo]
+    else:
+        # пачка read-only: параллельные каналы поверх одного соединения из пула
+        with ThreadPoolExecutor(max_workers=len(todo)) as ex:
+            fresh = list(ex.map(lambda c: _execute(state, c, password), todo))
+    done.update(zip(todo, fresh))
+    return _record_results(state, finished + [done[c] for c in cmds])
+
+
+async def aexecutor_node(state: AgentState) -> AgentState:
+    cmds = _pending_commands(state)
+    password = get_config()["configurable"].get("ssh_password")
+    if not cmds:
+        if state.get("_jobs"):
+            finished = await run_blocking(_poll_jobs, state, password, True)
+            return await run_blocking(_record_results, state, finished)
+        state["done"] = True
+        return state
+
+    finished = await run_blocking(_poll_jobs, state, password, _needs_wait(state, cmds))
+    done = _take_prefetched(state)
+    todo = [c for c in cmds if c not in done]
+    # paramiko блокирующий: команды уходят на общий ограниченный пул потоков
+    if len(todo) <= 1 or state.get("hosts"):
+        fresh = [await run_blocking(_execute, state, c, password) for c in todo]
+    else:
+        fresh = list(
+            await asyncio.gather(*(run_blocking(_execute, state, c, password) for c in todo))
+        )
+    done.update(zip(todo, fresh))
+    # запись отчёта с fsync тоже блокирующая — не на event loop
+    return await run_blocking(_record_results, state, finished + [done[c] for c in cmds])
+
+
 def critic_node(state: AgentState) -> AgentState:
     if not state["steps"]:
         return state
 
-    last = state["steps"][-1]
-    if last.get("kind") == "deny":
+    # пачку оцениваем целиком: раунд провален, только если упали все его команды
+    rounds: Dict[int, List[Dict[str, Any]]] = {}
+    for i, s in enumerate(state["steps"]):
+        rounds.setdefault(s.get("round", i), []).append(s)
+    ordered = list(rounds.values())
+
+    last = ordered[-1]
+    if any(s.get("kind") == "deny" for s in last):
         state["done"] = True
         return state
 
-    tail = state["steps"][-3:]
-    if len(tail) == 3 and all(not s.get("ok", False) for s in tail):
+    tail = ordered[-3:]
+    if len(tail) == 3 and all(not any(s.get("ok", False) for s in r) for r in tail):
         state["done"] = True
 
+    # фоновая задача с той же командой упала второй раз — повторять её дорого и бессмысленно
+    failed_jobs = [s["cmd"] for s in state["steps"] if s.get("background") and not s.get("ok")]
+    if any(s.get("background") and not s.get("ok") and failed_jobs.count(s["cmd"]) >= 2 for s in last):
+        state["done"] = True
+        _note(state, "critic", "background job failed twice with the same command")
+
     return state
 
 
+async def acritic_node(state: AgentState) -> AgentState:
+    # без I/O; async-узел, чтобы ainvoke не гонял его через пул потоков
+    return critic_node(state)
+
+
 def route_next(state: AgentState) -> str:
     return END if state["done"] else "planner"
 
 
-def reporter_node(state: AgentState) -> AgentState:
-    lines: List[str] = []
-    lines.append(f"# Отчёт: {state['goal']}")
-    lines.append("")
-    lines.append(f"- Host: `{state['host']}`")
-    lines.append(f"- User: `{state['user']}`")
-    lines.append(f"- Steps: {len(state['steps'])}/{state['max_steps']}")
-    lines.append("")
+def _report_header(goal: str, host: str, hosts: Optional[List[str]], user: str) -> List[str]:
+    lines = [f"# Отчёт: {goal}", "", f"- Host: `{host}`"]
+    if hosts:
+        lines.append(f"- Fleet: {len(hosts)} hosts")
+    lines.append(f"- User: `{user}`")
+    return lines
+
 
-    for i, s in enumerate(state["steps"], 1):
-        lines.append(f"## Step {i}: `{s.get('cmd', '')}`")
+def _output_link(item: Dict[str, Any]) -> List[str]:
+    refs = [item[k] for k in ("stdout_file", "stderr_file") if item.get(k)]
+    return ["Full output: " + ", ".join(f"[{r}]({r})" for r in refs)] if refs else []
+
+
+def _render_step(i: int, s: Dict[str, Any]) -> List[str]:
+    lines: List[str] = []
+    lines.append(f"## Step {i}: `{s.get('cmd', '')}`")
+    lines.append(
+        f"- Kind: `{s.get('kind')}`  Exit: `{s.get('exit_code', 'n/a')}`  OK: `{s.get('ok')}`"
+    )
+    if s.get("cached"):
+        lines.append(f"- Cached: yes ({s.get('cache_age_s')}s old)")
+    if s.get("early"):
+        lines.append("- Started early: while the plan was still streaming")
+    if s.get("job"):
+        what = "finished" if s.get("background") else "started"
+        lines.append(
+            f"- Background job `{s['job']}`: {what}, status `{s.get('job_status')}`"
+            + (f", {s['duration_s']}s" if s.get("background") and s.get("duration_s") is not None else "")
+        )
+    if s.get("batch_size"):
         lines.append(
-            f"- Kind: `{s.get('kind')}`  Exit: `{s.get('exit_code', 'n/a')}`  OK: `{s.get('ok')}`"
+            f"- Batch: round {s.get('round')}, {s['batch_size']} parallel commands"
         )
-        if s.get("rationale"):
-            lines.append(f"- Why: {s['rationale']}")
-        if s.get("success_criteria"):
-            lines.append(f"- Success criteria: {s['success_criteria']}")
+    if s.get("rationale"):
+        lines.append(f"- Why: {s['rationale']}")
+    if s.get("success_criteria"):
+        lines.append(f"- Success criteria: {s['success_criteria']}")
 
-        if s.get("error"):
-            lines.append("")
-            lines.append("**Policy/Error:**")
-            lines.append("```")
-            lines.append(str(s["error"]))
-            lines.append("```")
-        else:
+    if s.get("error"):
+        lines.append("")
+        lines.append("**Policy/Error:**")
+        lines.append("```")
+        lines.append(str(s["error"]))
+        lines.append("```")
+    elif s.get("groups"):
+        for g in s["groups"]:
             lines.append("")
-            lines.append("### STDOUT")
-            lines.append("```")
-            lines.append((s.get("stdout") or "").strip()[:8000])
+            lines.append(
+                f"### {len(g['hosts'])} host(s), Exit: `{g.get('exit_code', 'n/a')}`"
+            )
+            lines.append("Hosts: " + ", ".join(f"`{h}`" for h in g["hosts"]))
+            if g.get("error"):
+                lines.append(f"Error: {g['error']}")
             lines.append("```")
-            lines.append("### STDERR")
-            lines.append("```")
-            lines.append((s.get("stderr") or "").strip()[:8000])
+            lines.append((g.get("stdout") or "").strip())
             lines.append("```")
+            if (g.get("stderr") or "").strip():
+                lines.append("STDERR:")
+                lines.append("```")
+                lines.append(g["stderr"].strip())
+                lines.append("```")
+            lines.extend(_output_link(g))
+    else:
         lines.append("")
+        lines.append("### STDOUT")
+        lines.append("```")
+        lines.append((s.get("stdout") or "").strip())
+        lines.append("```")
+        lines.append("### STDERR")
+        lines.append("```")
+        lines.append((s.get("stderr") or "").strip())
+        lines.append("```")
+        lines.extend(_output_link(s))
+    lines.append("")
+    return lines
+
+
+def _update_playbook(state: AgentState) -> Optional[str]:
+    """Учесть повтор плейбука или записать новый из успешного прогона."""
+    if not PLAYBOOKS_ENABLED:
+        return None
+    note = state.get("_pb_note")
+    if state.get("_stopped_by") == "playbook":
+        PLAYBOOKS.replayed(state["_playbook"]["id"])
+        return note
+    steps = state["steps"]
+    last = [s for s in steps if s.get("round") == state.get("_round")]
+    # успех = планировщик сам решил остановиться, и последний раунд прошёл
+    if state.get("_stopped_by") == "planner" and last and all(s.get("ok") for s in last):
+        pb = PLAYBOOKS.record(state["goal"], state.get("host_facts"), steps)
+        if pb:
+            saved = f"saved {pb['id']} ({len(pb['rounds'])} rounds)"
+            return f"{note}; {saved}" if note else saved
+    return note
 
-    state["_report_md"] = "\n".join(lines)
+
+def reporter_node(state: AgentState) -> AgentState:
+    # шаги уже в отчёте (их дописывает executor) — здесь только сводка
+    summary = [f"- Steps: {len(state['steps'])}/{state['max_steps']}"]
+    cache = get_llm_cache()
+    if cache is not None:
+        base = state.get("_llm_cache_base") or {"hits": 0, "misses": 0}
+        now = cache.stats()
+        summary.append(
+            f"- LLM cache: {now['hits'] - base['hits']} hits, "
+            f"{now['misses'] - base['misses']} misses"
+        )
+    if state.get("_tokens"):
+        summary.append(f"- Tokens: {usage_line(state['_tokens'])}")
+    note = _update_playbook(state)
+    if note:
+        summary.append(f"- Playbook: {note}")
+    for job in state.get("_jobs") or []:
+        summary.append(f"- Background job still running: `{job['id']}` `{job['cmd']}`")
+
+    path = ReportWriter(state["_report_path"]).finalize(summary)
+    state["_report_md"] = path.read_text(encoding="utf-8")
+    STEPS.close(state["_report_path"])
     return state
 
 
-def build_graph():
-    g = StateGraph(AgentState)
-    g.add_node("planner", planner_node)
-    g.add_node("executor", executor_node)
-    g.add_node("critic", critic_node)
-    g.add_node("reporter", reporter_node)
+async def areporter_node(state: AgentState) -> AgentState:
+    # финал отчёта, запись плейбука и чтение отчёта — файловые, не на event loop
+    return await run_blocking(reporter_node, state)
+
 
-    g.set_entry_point("planner")
+def _compile(bootstrap, planner, executor, critic, reporter, checkpointer=None):
+    g = StateGraph(AgentState)
+    g.add_node("bootstrap", bootstrap)
+    g.add_node("planner", planner)
+    g.add_node("executor", executor)
+    g.add_node("critic", critic)
+    g.add_node("reporter", reporter)
+
+    g.set_entry_point("bootstrap")
+    g.add_edge("bootstrap", "planner")
     g.add_edge("planner", "executor")
     g.add_edge("executor", "critic")
     g.add_conditional_edges(
@@ -374,7 +948,95 @@ def build_graph():
     )
     g.add_edge("reporter", END)
 
-    return g.compile()
+    return g.compile(checkpointer=checkpointer)
+
+
+def build_graph(checkpointer=None):
+    return _compile(
+        bootstrap_node, planner_node, executor_node, critic_node, reporter_node, checkpointer
+    )
+
+
+def build_async_graph(checkpointer=None):
+    """Граф для ainvoke: LLM — нативный async, SSH — на SSH_EXECUTOR."""
+    return _compile(
+        abootstrap_node, aplanner_node, aexecutor_node, acritic_node, areporter_node, checkpointer
+    )
+
+
+def _prepare_run(
+    goal: str,
+    host: str,
+    user: str,
+    key_path: Optional[str],
+    password: Optional[str],
+    max_steps: int,
+    hosts: Optional[List[str]],
+    concurrency: int,
+    resume: Optional[str],
+) -> Tuple[Optional[str], Optional[AgentState], Dict[str, Any]]:
+    """(run_id, начальное состояние или None при --resume, config графа)."""
+    runs = get_run_store()
+    cache = get_llm_cache()
+
+    if resume:
+        # граф продолжит с узла, на котором прогон остановился
+        run_id = resume
+        init: Optional[AgentState] = None
+    else:
+        init = {
+            "goal": goal,
+            "host": host,
+            "hosts": hosts or [],
+            "concurrency": concurrency,
+            "user": user,
+            "key_path": key_path,
+            "steps": [],
+            "done": False,
+            "max_steps": max_steps,
+            "_llm_cache_base": cache.stats() if cache is not None else {},
+        }
+        params = {
+            "goal": goal,
+            "host": host,
+            "user": user,
+            "key_path": key_path,
+            "max_steps": max_steps,
+            "hosts": hosts,
+            "concurrency": concurrency,
+        }
+        run_id = runs.create("agent", params) if runs is not None else None
+        header = _report_header(goal, host, hosts, user)
+        init["_report_path"] = str(
+            ReportWriter.create(report_path(host, hosts, run_id), header).path
+        )
+
+    config = {"configurable": {"thread_id": run_id or "-", "ssh_password": password}}
+    return run_id, init, config
+
+
+def _rate_limited(run_id: Optional[str], report: str, e: Exception) -> str:
+    runs = get_run_store()
+    if runs is None:
+        record_report(report)
+        raise e
+    runs.set_status(run_id, "interrupted", str(e))
+    record_report(report)
+    return (
+        f"LLM rate limit hit: {e}\n\n"
+        f"Run {run_id} is saved; continue with: python agent.py --resume {run_id}"
+    )
+
+
+def _finished(run_id: Optional[str], report: str, error: Optional[BaseException] = None) -> None:
+    runs = get_run_store()
+    if runs is not None:
+        if error is None:
+            runs.set_status(run_id, "done")
+        else:
+            runs.set_status(run_id, "failed", f"{type(error).__name__}: {error}")
+    # в историю — уже с итоговым статусом
+    record_report(report)
 
 
 def run(
@@ -384,20 +1046,53 @@ def run(
     key_path: Optional[str],
     password: Optional[str],
     max_steps: int = 25,
+    hosts: Optional[List[str]] = None,
+    concurrency: int = FLEET_CONCURRENCY,
+    resume: Optional[str] = None,
 ) -> str:
-    app = build_graph()
-    init: AgentState = {
-        "goal": goal,
-        "host": host,
-        "user": user,
-        "key_path": key_path,
-        "password": password,
-        "steps": [],
-        "transcript": [],
-        "done": False,
-        "max_steps": max_steps,
-    }
-    out = app.invoke(init)
+    run_id, init, config = _prepare_run(
+        goal, host, user, key_path, password, max_steps, hosts, concurrency, resume
+    )
+    report = init["_report_path"] if init else str(report_path(host, hosts, run_id))
+    app = build_graph(checkpointer=get_checkpointer())
+    try:
+        out = app.invoke(init, config=config)
+    except openai.RateLimitError as e:
+        return _rate_limited(run_id, report, e)
+    except BaseException as e:
+        _finished(run_id, report, e)
+        raise
+    _finished(run_id, report)
+    return out.get("_report_md", "")
+
+
+async def arun(
+    goal: str,
+    host: str,
+    user: str,
+    key_path: Optional[str],
+    password: Optional[str],
+    max_steps: int = 25,
+    hosts: Optional[List[str]] = None,
+    concurrency: int = FLEET_CONCURRENCY,
+    resume: Optional[str] = None,
+) -> str:
+    """То же, что run(), но на event loop: много сессий в одном процессе."""
+    # строка в RunStore и файл отчёта — блокирующие, как и _finished ниже
+    run_id, init, config = await run_blocking(
+        _prepare_run, goal, host, user, key_path, password, max_steps, hosts, concurrency, resume
+    )
+    report = init["_report_path"] if init else str(report_path(host, hosts, run_id))
+    app = build_async_graph(checkpointer=get_checkpointer())
+    try:
+        out = await app.ainvoke(init, config=config)
+    # статус и импорт в историю — блокирующий sqlite, не на event loop
+    except openai.RateLimitError as e:
+        return await run_blocking(_rate_limited, run_id, report, e)
+    except BaseException as e:
+        await run_blocking(_finished, run_id, report, e)
+        raise
+    await run_blocking(_finished, run_id, report)
     return out.get("_report_md", "")
 
 
@@ -405,20 +1100,39 @@ if __name__ == "__main__":
     import argparse
 
     p = argparse.ArgumentParser()
-    p.add_argument("--goal", required=True)
-    p.add_argument("--host", required=True)
-    p.add_argument("--user", required=True)
+    p.add_argument("--goal")
+    target = p.add_mutually_exclusive_group()
+    target.add_argument("--host")
+    target.add_argument("--inventory", help="файл со списком хостов (fleet-режим)")
+    p.add_argument("--concurrency", type=int, default=FLEET_CONCURRENCY)
+    p.add_argument("--user")
     p.add_argument("--password", default=None)
     p.add_argument("--key", default=None)
     p.add_argument("--max-steps", type=int, default=25)
+    p.add_argument("--resume", metavar="RUN_ID", help="продолжить сохранённый прогон")
+    p.add_argument("--async", dest="use_async", action="store_true", help="async-граф (ainvoke)")
     args = p.parse_args()
-
-    md = run(
-        goal=args.goal,
-        host=args.host,
-        user=args.user,
-        key_path=args.key,
-        password=args.password,
-        max_steps=args.max_steps,
-    )
+    runner = (lambda **kw: asyncio.run(arun(**kw))) if args.use_async else run
+
+    if args.resume:
+        runs = get_run_store()
+        saved = runs.get(args.resume) if runs is not None else None
+        if saved is None or saved["agent"] != "agent":
+            p.error(f"run {args.resume} not found")
+        # пароль не сохраняется — его передают заново
+        md = runner(**saved["params"], password=args.password, resume=args.resume)
+    else:
+        if not (args.goal and args.user and (args.host or args.inventory)):
+            p.error("--goal, --user and --host/--inventory are required")
+        hosts = load_inventory(args.inventory) if args.inventory else None
+        md = runner(
+            goal=args.goal,
+            host=args.host or f"fleet ({len(hosts)} hosts)",
+            user=args.user,
+            key_path=args.key,
+            password=args.password,
+            max_steps=args.max_steps,
+            hosts=hosts,
+            concurrency=args.concurrency,
+        )
     print(md)
@@ -1,79 +1,122 @@
 #!/usr/bin/env python3
+import asyncio
+import functools
 import json
 import os
-import re
+import threading
 import time
-from datetime import datetime
-from pathlib import Path
-from typing import Any, Dict, List, Optional
+import uuid
+from typing import Any, Callable, Dict, List, Optional
 
 import openai  # для перехвата openai.RateLimitError
-import paramiko
 from dotenv import load_dotenv
 from langchain_core.messages import SystemMessage
-from langchain_core.tools import tool
-from langchain_openai import ChatOpenAI
+from langchain_core.tools import StructuredTool
 from langgraph.prebuilt import create_react_agent
 
+from bootstrap import ENABLED as BOOTSTRAP_ENABLED
+from bootstrap import bundle as bootstrap_bundle
+from bootstrap import for_llm as facts_for_llm
+from checkpoints import get_checkpointer, get_run_store
+from context_budget import TokenMeter, make_history_trimmer, usage_line
+from facts_cache import ENABLED as FACTS_ENABLED
+from facts_cache import FACTS
+from fleet import (
+    FLEET_CONCURRENCY,
+    compact_groups,
+    group_results,
+    hosts_label,
+    load_inventory,
+    run_on_fleet,
+)
+from history import record_report
+from jobs import is_long_running, job_result, read_output, started_result
+from jobs import load as load_job
+from jobs import poll as poll_job
+from jobs import save as save_job
+from jobs import start as start_job
+from jobs import wait as wait_for_job
+from llm_cache import get_llm_cache
+from llm_scheduler import ScheduledChatModel, get_llm, model_chain
+from output_delta import OutputTracker
+from parsers import for_llm, parse_output
+from pkgops import COALESCER, prepare
+from pkgops import record as record_pkg_op
+from pkgops import skip as skip_pkg_op
+from policy import POLICY
+from report_stream import ReportWriter, report_path
+from runlog import RUN_ID, get_run_logger
+from ssh_pool import CHANGE_LOCK_TIMEOUT_S, CHANGE_LOCKS, POOL, run_blocking
+from ssh_stream import read_channel
+
 load_dotenv()
 
 # -------------------------
-# Config
+# Session
 # -------------------------
-LOG_PATH = os.environ.get("AGENT_LOG", "agent_run.log")
-REPORT_DIR = Path(os.environ.get("AGENT_REPORT_DIR", "reports"))
-REPORT_DIR.mkdir(parents=True, exist_ok=True)
 
-OPENROUTER_MODEL = os.environ.get("OPENROUTER_MODEL", "openai/gpt-4o-mini")
 
-# Сохраняем все шаги в памяти, потом делаем отчёт
-RUN_STEPS: List[Dict[str, Any]] = []
+class Session:
+    """
+    Состояние одного прогона: шаги, отчёт, фоновые задачи. Своё у каждого
+    прогона, поэтому в процессе их может идти сколько угодно (см. batch.py).
+    """
+
+    def __init__(self, run_id: Optional[str] = None):
+        self.run_id = run_id
+        # без хранилища прогонов id всё равно нужен: имя отчёта, ключ склейки пакетов
+        self.id = run_id or time.strftime("%Y%m%d-%H%M%S-") + uuid.uuid4().hex[:6]
+        # шаги с урезанными выводами; полные — в отчёте
+        self.steps: List[Dict[str, Any]] = []
+        self.report: Optional[ReportWriter] = None
+        # фоновые задачи, которые ещё идут: id -> описание (см. jobs.py)
+        self.jobs: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()  # ToolNode выполняет параллельные tool calls в потоках
+
+    def record_step(self, step: Dict[str, Any]) -> None:
+        """Шаг сразу уходит в отчёт; в steps остаётся версия с урезанным выводом."""
+        with self._lock:
+            if self.report is not None:
+                step = self.report.add_step(step, _render_step)
+            self.steps.append(step)
 
 
 def log(event: str, data: Dict[str, Any]):
-    rec = {"ts": time.time(), "event": event, **data}
-    line = json.dumps(rec, ensure_ascii=False)
-    print(line, flush=True)
-    with open(LOG_PATH, "a", encoding="utf-8") as f:
-        f.write(line + "\n")
+    # запись и эхо в stdout — в фоновом потоке runlog, здесь только очередь
+    get_run_logger().log(event, data)
 
 
-# -------------------------
-# Policy
-# -------------------------
+if get_llm_cache() is not None:
+    get_llm_cache().listeners.append(log)
 
-DENY_PATTERNS = [
-    r"\brm\s+-rf\b",
-    r"\bmkfs\b",
-    r"\bdd\b",
-    r"\bshutdown\b",
-    r"\breboot\b",
-    r"\biptables\s+-F\b",
-    r"\bnft\s+flush\b",
-    r"curl\s+.*\|\s*sh",
-    r"wget\s+.*\|\s*sh",
-    r":\(\)\s*\{",  # fork bomb
-    r"\bssh\s+",  # запрещаем ssh внутри ssh
-]
 
-# Запрещаем объединение команд (одна команда = один шаг)
-DENY_TOKENS = ["&&", "||", ";", "`", "$(", "|"]
+# Потребители потокового вывода команд (лог, отчёт, LLM):
+# fn(host, cmd, stream, text) вызывается по мере поступления данных.
+OUTPUT_CONSUMERS: List[Callable[[str, str, str, str], None]] = []
 
 
-def policy_check(cmd: str) -> Optional[str]:
-    c = cmd.strip()
-    if not c:
-        return "Empty command"
+def register_output_consumer(fn: Callable[[str, str, str, str], None]):
+    OUTPUT_CONSUMERS.append(fn)
+    return fn
 
-    for tok in DENY_TOKENS:
-        if tok in c:
-            return f"Chaining/token '{tok}' is not allowed. One command per step."
 
-    for pat in DENY_PATTERNS:
-        if re.search(pat, c):
-            return f"Command denied by policy (matched: {pat})"
+if os.environ.get("AGENT_STREAM_LOG"):
 
-    return None
+    @register_output_consumer
+    def _log_output(host: str, cmd: str, stream: str, text: str):
+        log("ssh_output", {"host": host, "cmd": cmd, "stream": stream, "text": text})
+
+
+# -------------------------
+# Policy
+# -------------------------
+
+# Правила — в policy.json (общие с agent.py), см. policy.py
+
+
+def policy_check(cmd: str) -> Optional[str]:
+    verdict = POLICY.check(cmd)
+    return verdict.reason if verdict.denied else None
 
 
 # -------------------------
@@ -88,6 +131,7 @@ def _ssh_exec(
     key_path: Optional[str],
     cmd: str,
     timeout: int = 600,  # apt может быть долгим
+    session: Optional[Session] = None,  # куда писать шаг; fleet-режим пишет один сводный
 ) -> Dict[str, Any]:
     err = policy_check(cmd)
     if err:
@@ -101,88 +145,106 @@ def _ssh_exec(
             "duration_s": 0.0,
             "error": err,
         }
-        RUN_STEPS.append(step)
+        if session is not None:
+            session.record_step(step)
         log("ssh_denied", {"cmd": cmd, "error": err})
         return {"ok": False, "error": err, "cmd": cmd}
 
-    log("ssh_start", {"host": host, "user": user, "cmd": cmd, "timeout": timeout})
-
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    kind = POLICY.check(cmd).kind
+    if FACTS_ENABLED and kind == "readonly":
+        hit = FACTS.get(host, user, cmd)
+        if hit:
+            r = hit["result"]
+            log("cache_hit", {"host": host, "cmd": cmd, "age_s": hit["age_s"]})
+            parsed = parse_output(cmd, r["stdout"])
+            step = {
+                "ts": time.time(),
+                "cmd": cmd,
+                "exit_code": r["exit_code"],
+                "ok": True,
+                "stdout": r["stdout"],
+                "stderr": r["stderr"],
+                "duration_s": 0.0,
+                "cached": True,
+                "cache_age_s": hit["age_s"],
+            }
+            if parsed is not None:
+                step["parsed"] = parsed
+            if session is not None:
+                session.record_step(step)
+            return {
+                "ok": True,
+                "exit_code": r["exit_code"],
+                "cmd": cmd,
+                "stdout": r["stdout"],
+                "stderr": r["stderr"],
+                "duration_s": 0.0,
+                "cached": True,
+                "cache_age_s": hit["age_s"],
+                "parsed": parsed,
+            }
 
-    connect_kwargs: Dict[str, Any] = {
-        "hostname": host,
-        "username": user,
-        "timeout": 10,
-        "allow_agent": False,
-        "look_for_keys": False,
-    }
-    if key_path:
-        connect_kwargs["key_filename"] = key_path
-    else:
-        connect_kwargs["password"] = password
+    log("ssh_start", {"host": host, "user": user, "cmd": cmd, "timeout": timeout})
 
     t0 = time.time()
-    ssh.connect(**connect_kwargs)
-
-    stdin, stdout, stderr = ssh.exec_command(cmd, timeout=timeout)
-
-    channel = stdout.channel
-    channel.settimeout(timeout)
-
-    out_chunks = []
-    err_chunks = []
-
-    start = time.time()
-
-    while not channel.exit_status_ready():
-        if channel.recv_ready():
-            out_chunks.append(channel.recv(4096).decode(errors="replace"))
-        if channel.recv_stderr_ready():
-            err_chunks.append(channel.recv_stderr(4096).decode(errors="replace"))
-        if time.time() - start > timeout:
-            break
-        time.sleep(0.1)
-
-    # дочитываем остатки
-    while channel.recv_ready():
-        out_chunks.append(channel.recv(4096).decode(errors="replace"))
-    while channel.recv_stderr_ready():
-        err_chunks.append(channel.recv_stderr(4096).decode(errors="replace"))
-
-    code = channel.recv_exit_status()
-
-    out = "".join(out_chunks)
-    errout = "".join(err_chunks)
-    ssh.close()
+    with POOL.session(
+        host,
+        user,
+        key_path=key_path,
+        password=password,
+        allow_agent=False,
+        look_for_keys=False,
+    ) as channel:
+        channel.exec_command(cmd)
+        consumers = [
+            functools.partial(fn, host, cmd) for fn in OUTPUT_CONSUMERS
+        ]
+        res = read_channel(channel, timeout, consumers=consumers)
+
+    code = res["exit_code"]
+    out = res["stdout"]
+    errout = res["stderr"]
+    if res["timed_out"]:
+        errout += f"\n[timeout: command did not finish in {timeout}s]"
+    if res["capped"]:
+        errout += f"\n[output cap reached after {res['bytes_in']} bytes, command stopped]"
 
     dt = time.time() - t0
 
     payload = {
+        "host": host,
         "cmd": cmd,
         "exit_code": code,
         "ok": code == 0,
         "duration_s": round(dt, 3),
         "stdout_len": len(out),
         "stderr_len": len(errout),
+        "timed_out": res["timed_out"],
+        "bytes_in": res["bytes_in"],
+        "dropped": res["stdout_dropped"] + res["stderr_dropped"],
     }
     if code != 0:
         payload["stdout_head"] = out[:800]
         payload["stderr_head"] = errout[:800]
     log("ssh_done", payload)
 
+    parsed = parse_output(cmd, out)
     step = {
         "ts": time.time(),
         "cmd": cmd,
         "exit_code": code,
         "ok": code == 0,
-        "stdout": out[:12000],
-        "stderr": errout[:6000],
+        # полный вывод уходит в отчёт (длинный — в файл), в памяти остаётся превью
+        "stdout": out,
+        "stderr": errout,
         "duration_s": dt,
     }
-    RUN_STEPS.append(step)
+    if parsed is not None:
+        step["parsed"] = parsed
+    if session is not None:
+        session.record_step(step)
 
-    return {
+    result = {
         "ok": code == 0,
         "exit_code": code,
         "cmd": cmd,
@@ -190,6 +252,65 @@ def _ssh_exec(
         "stderr": errout,
         "duration_s": dt,
     }
+    if FACTS_ENABLED:
+        if kind == "readonly":
+            FACTS.put(host, user, cmd, result)
+        else:
+            # agent_tc пускает и unknown (systemctl start, enable, ...): всё, что не
+            # readonly, могло изменить хост
+            dropped = FACTS.invalidate(host, cmd)
+            if dropped:
+                log("cache_invalidated", {"host": host, "cmd": cmd, "entries": dropped})
+    return {**result, "parsed": parsed}
+
+
+def _ssh_exec_fleet(
+    hosts: List[str],
+    user: str,
+    password: Optional[str],
+    key_path: Optional[str],
+    cmd: str,
+    concurrency: int = FLEET_CONCURRENCY,
+    session: Optional[Session] = None,
+) -> Dict[str, Any]:
+    err = policy_check(cmd)
+    if err:
+        # политика не зависит от хоста — проверяем один раз за весь флот
+        return _ssh_exec(hosts[0], user, password, key_path, cmd, session=session)
+
+    t0 = time.time()
+    results = run_on_fleet(
+        hosts,
+        lambda h: _ssh_exec(h, user, password, key_path, cmd),
+        concurrency=concurrency,
+    )
+    dt = time.time() - t0
+    groups = group_results(results)
+    ok = all(g["ok"] for g in groups)
+    exit_code = groups[0]["exit_code"] if len(groups) == 1 else "mixed"
+    log(
+        "fleet_done",
+        {"cmd": cmd, "hosts": len(hosts), "groups": len(groups), "ok": ok},
+    )
+
+    if session is not None:
+        session.record_step(
+            {
+                "ts": time.time(),
+                "cmd": cmd,
+                "exit_code": exit_code,
+                "ok": ok,
+                "groups": groups,
+                "duration_s": dt,
+            }
+        )
+    return {
+        "ok": ok,
+        "exit_code": exit_code,
+        "cmd": cmd,
+        "groups": groups,
+        "duration_s": dt,
+    }
 
 
 # -------------------------
@@ -197,12 +318,12 @@ def _ssh_exec(
 # -------------------------
 
 
-def should_stop_due_to_apt_failures() -> Optional[str]:
+def should_stop_due_to_apt_failures(steps: List[Dict[str, Any]]) -> Optional[str]:
     """
     Если apt несколько раз подряд возвращает 100 — стопаемся,
     чтобы агент не крутился бесконечно.
     """
-    recent = RUN_STEPS[-10:]
+    recent = steps[-10:]
     apt_100 = 0
     for s in recent:
         c = s.get("cmd") or ""
@@ -228,70 +349,272 @@ def should_stop_due_to_apt_failures() -> Optional[str]:
 # -------------------------
 
 
-def make_agent(host: str, user: str, password: Optional[str], key_path: Optional[str]):
-    @tool("run_remote")
+def _tool_text(session: Session, res: Dict[str, Any]) -> str:
+    """Ответ инструмента run_remote для модели."""
+    # Анти-луп по apt
+    stop_reason = should_stop_due_to_apt_failures(session.steps)
+    if stop_reason:
+        return "FATAL: " + stop_reason
+
+    res = for_llm(res)
+    if "groups" in res:
+        return _format_fleet_result(res)
+
+    delta = f"delta: {res['delta']}\n" if res.get("delta") else ""
+    if not res.get("ok"):
+        return (
+            f"ERROR\n"
+            f"cmd: {res.get('cmd')}\n"
+            f"exit: {res.get('exit_code')}\n"
+            f"{delta}"
+            f"stdout:\n{_stdout_text(res, 1200)}\n"
+            f"stderr:\n{(res.get('stderr') or '')[:800]}\n"
+        )
+
+    out = _stdout_text(res, 4000)
+    err = (res.get("stderr") or "")[:1200]
+    # время и возраст кэша — грубо: точные значения ломают совпадение промптов в кэше LLM
+    cached = (
+        f"cached: yes, {int(res.get('cache_age_s') or 0) // 60} min old\n"
+        if res.get("cached")
+        else ""
+    )
+    return (
+        f"OK exit={res.get('exit_code')}\n"
+        f"cmd: {res.get('cmd')}\n"
+        f"duration_s: {round(res.get('duration_s') or 0)}\n"
+        f"{cached}"
+        f"{delta}"
+        f"stdout:\n{out}\n"
+        f"stderr:\n{err}\n"
+    )
+
+
+def _stdout_text(res: Dict[str, Any], limit: int) -> str:
+    # разобранная таблица (parsers.py) вместо сырого вывода
+    if "stdout" not in res and res.get("parsed") is not None:
+        return "(parsed) " + json.dumps(res["parsed"], ensure_ascii=False)
+    return (res.get("stdout") or "")[:limit]
+
+
+def _format_fleet_result(res: Dict[str, Any]) -> str:
+    groups = compact_groups(res["groups"], stdout_limit=4000, stderr_limit=1200)
+    lines = [
+        f"{'OK' if res.get('ok') else 'ERROR'} groups={len(groups)}",
+        f"cmd: {res.get('cmd')}",
+        f"duration_s: {round(res.get('duration_s', 0.0), 3)}",
+    ]
+    if res.get("delta"):
+        lines.append(f"delta: {res['delta']}")
+    for i, g in enumerate(groups, 1):
+        lines.append(f"--- group {i}: {g['hosts']}")
+        lines.append(f"exit: {g.get('exit_code')}")
+        if g.get("error"):
+            lines.append(f"error: {g['error']}")
+        lines.append(f"stdout:\n{_stdout_text(g, 4000)}")
+        lines.append(f"stderr:\n{g['stderr']}")
+    return "\n".join(lines) + "\n"
+
+
+def _job_text(job: Dict[str, Any]) -> str:
+    """Ответ инструментов о фоновой задаче; новый вывод — с места, где модель читала в прошлый раз."""
+    new = read_output(job, "out", job.get("read_off", 0))
+    job["read_off"] = job["out_off"]
+    save_job(job)
+    return (
+        f"JOB {job['status'].upper()} id={job['id']}\n"
+        f"cmd: {job['cmd']}\n"
+        f"running_s: {round(time.time() - job['started'])}\n"
+        f"new output:\n{new[-4000:]}\n"
+    )
+
+
+def _settle_job(session: Session, job: Dict[str, Any]) -> str:
+    """Итог задачи: шаг в отчёт, сброс кэша фактов; для модели — обычный ответ run_remote."""
+    if job["status"] == "running":
+        return _job_text(job)
+    if session.jobs.pop(job["id"], None) is None:
+        # итог уже записан (повторный job_status)
+        return _tool_text(session, job_result(job))
+    # хост держали с запуска задачи
+    CHANGE_LOCKS.release([job["host"]], session)
+    res = job_result(job)
+    session.record_step(res)
+    log("job_done", {"id": job["id"], "cmd": job["cmd"], "status": job["status"], "exit_code": job.get("exit_code")})
+    record_pkg_op(job["host"], job["user"], job["cmd"], res["ok"])
+    if FACTS_ENABLED:
+        FACTS.invalidate(job["host"], job["cmd"])
+    return _tool_text(session, res)
+
+
+def _wait_running_jobs(session: Session, key_path: Optional[str], password: Optional[str]) -> None:
+    # следующая изменяющая команда ждёт фоновые: apt lock, да и порядок изменений важен
+    for job in list(session.jobs.values()):
+        _settle_job(session, wait_for_job(job, key_path, password))
+
+
+def make_llm() -> ScheduledChatModel:
+    # общий клиент процесса: 429 переживаем повторами и fallback-моделями,
+    # наверх RateLimitError доходит, только когда попытки кончились
+    llm = get_llm()
+    if log not in llm.listeners:
+        llm.listeners.append(log)
+    return llm
+
+
+def make_agent(
+    host: str,
+    user: str,
+    password: Optional[str],
+    key_path: Optional[str],
+    hosts: Optional[List[str]] = None,
+    concurrency: int = FLEET_CONCURRENCY,
+    meter: Optional[TokenMeter] = None,
+    run_id: Optional[str] = None,
+    facts: Optional[Dict[str, Any]] = None,
+    session: Optional[Session] = None,
+):
+    if session is None:
+        session = Session(run_id)
+    # повтор команды отдаётся модели дельтой к прошлому выводу; в отчёте — полный
+    outputs = OutputTracker()
+    target = "fleet" if hosts else host
+    outputs.seed(target, session.steps)
+
     def run_remote(command: str) -> str:
         """
         Run ONE safe command on the remote server.
         Tool already connects to host/user — do NOT use ssh inside.
         """
-        cmd = command.strip()
-
-        # Авто-правка для Debian apt:
-        # - делаем noninteractive
-        # - добавляем sudo (иначе apt почти всегда падает)
-        if cmd.startswith("apt-get "):
-            if not cmd.startswith("sudo "):
-                cmd = "sudo " + cmd
-
-            # -y обязательно для install/upgrade/remove
-            if " -y" not in cmd and (
-                cmd.startswith("sudo apt-get install")
-                or cmd.startswith("sudo apt-get upgrade")
-                or cmd.startswith("sudo apt-get remove")
-            ):
-                cmd = cmd + " -y"
-
-            if "DEBIAN_FRONTEND=noninteractive" not in cmd:
-                cmd = "DEBIAN_FRONTEND=noninteractive " + cmd
-
-        res = _ssh_exec(
-            host=host, user=user, password=password, key_path=key_path, cmd=cmd
-        )
-
-        # Анти-луп по apt
-        stop_reason = should_stop_due_to_apt_failures()
-        if stop_reason:
-            return "FATAL: " + stop_reason
-
-        if not res.get("ok"):
+        # sudo, -y и DEBIAN_FRONTEND=noninteractive для apt-get/dnf/yum
+        cmd = prepare(command)
+        if not hosts:
+            skipped = skip_pkg_op(host, user, key_path, password, cmd)
+            if skipped is not None:
+                session.record_step({**skipped, "ts": time.time()})
+                return _tool_text(session, skipped)
+        # одновременные install/remove (параллельные tool calls) — одной транзакцией
+        return COALESCER.run(f"{session.id}:{target}", cmd, execute)
+
+    def execute(cmd: str) -> str:
+        if POLICY.check(cmd).kind != "change":
+            return run_command(cmd)
+        if not hosts:
+            _wait_running_jobs(session, key_path, password)
+        # другой прогон (batch.py) может менять тот же хост — ждём его
+        targets = hosts or [host]
+        if not CHANGE_LOCKS.acquire(targets, session, CHANGE_LOCK_TIMEOUT_S):
+            log("change_lock_timeout", {"cmd": cmd, "hosts": len(targets)})
             return (
-                f"ERROR\n"
-                f"cmd: {res.get('cmd')}\n"
-                f"exit: {res.get('exit_code')}\n"
-                f"stdout:\n{(res.get('stdout') or '')[:1200]}\n"
-                f"stderr:\n{(res.get('stderr') or '')[:800]}\n"
+                f"ERROR\ncmd: {cmd}\nanother run kept changing the host for "
+                f"{CHANGE_LOCK_TIMEOUT_S:.0f}s; the command was not run\n"
+            )
+        try:
+            return run_command(cmd)
+        finally:
+            CHANGE_LOCKS.release(targets, session)
+
+    def run_command(cmd: str) -> str:
+        if not hosts and is_long_running(cmd):
+            job = start_job(host, user, key_path, password, cmd)
+            session.record_step(started_result(job))
+            log("job_start", {"id": job["id"], "cmd": cmd, "status": job["status"]})
+            if job["status"] != "running":
+                return f"ERROR\ncmd: {cmd}\nbackground job failed to start: {job.get('error')}\n"
+            # хост остаётся за сессией до итога задачи (см. _settle_job)
+            CHANGE_LOCKS.acquire([host], session)
+            session.jobs[job["id"]] = job
+            return (
+                _job_text(job)
+                + "The command keeps running on the host. Use job_status(job_id) for new output "
+                "and wait_job(job_id) for the result; read-only commands may run meanwhile.\n"
             )
 
-        out = (res.get("stdout") or "")[:4000]
-        err = (res.get("stderr") or "")[:1200]
-        return (
-            f"OK exit={res.get('exit_code')}\n"
-            f"cmd: {res.get('cmd')}\n"
-            f"duration_s: {res.get('duration_s')}\n"
-            f"stdout:\n{out}\n"
-            f"stderr:\n{err}\n"
-        )
+        if hosts:
+            res = _ssh_exec_fleet(
+                hosts=hosts,
+                user=user,
+                password=password,
+                key_path=key_path,
+                cmd=cmd,
+                concurrency=concurrency,
+                session=session,
+            )
+        else:
+            res = _ssh_exec(
+                host=host,
+                user=user,
+                password=password,
+                key_path=key_path,
+                cmd=cmd,
+                session=session,
+            )
+            record_pkg_op(host, user, cmd, res.get("ok"))
+
+        return _tool_text(session, outputs.encode(target, res))
+
+    async def arun_remote(command: str) -> str:
+        # paramiko блокирующий — на общий ограниченный пул, event loop не ждёт SSH
+        return await run_blocking(run_remote, command)
+
+    remote_tool = StructuredTool.from_function(
+        func=run_remote, coroutine=arun_remote, name="run_remote"
+    )
+
+    def _job(job_id: str) -> Optional[Dict[str, Any]]:
+        # после --resume описание задачи берём из локального хранилища jobs.py
+        job = session.jobs.get(job_id)
+        if job is None:
+            job = load_job(job_id)
+            if job is not None and job["status"] == "running":
+                session.jobs[job_id] = job
+        return job
+
+    def job_status(job_id: str) -> str:
+        """
+        Check a background job started by run_remote: status and output since the last check.
+        """
+        job = _job(job_id.strip())
+        if job is None:
+            return f"ERROR\nunknown job: {job_id}\n"
+        return _settle_job(session, poll_job(job, key_path, password))
 
-    api_key = os.environ["OPENROUTER_API_KEY"]
+    def wait_job(job_id: str, timeout_s: int = 600) -> str:
+        """
+        Wait until a background job finishes (or timeout_s passes) and return its result.
+        """
+        job = _job(job_id.strip())
+        if job is None:
+            return f"ERROR\nunknown job: {job_id}\n"
+        return _settle_job(session, wait_for_job(job, key_path, password, timeout=timeout_s))
+
+    async def ajob_status(job_id: str) -> str:
+        return await run_blocking(job_status, job_id)
+
+    async def await_job(job_id: str, timeout_s: int = 600) -> str:
+        return await run_blocking(wait_job, job_id, timeout_s)
+
+    job_tools = [
+        StructuredTool.from_function(func=job_status, coroutine=ajob_status, name="job_status"),
+        StructuredTool.from_function(func=wait_job, coroutine=await_job, name="wait_job"),
+    ]
+
+    fleet_rule = (
+        f"- Команда выполняется сразу на {len(hosts)} хостах; одинаковые результаты "
+        "приходят одной группой с пометкой 'same on N hosts'.\n"
+        if hosts
+        else ""
+    )
 
-    llm = ChatOpenAI(
-        model=OPENROUTER_MODEL,
-        api_key=api_key,
-        base_url="https://openrouter.ai/api/v1",
-        temperature=0.1,
+    facts_block = (
+        "\n\nФакты о хосте (bootstrap-проба до начала работы; повторно их не собирай):\n"
+        + json.dumps(facts_for_llm(facts), ensure_ascii=False)
+        if facts
+        else ""
     )
 
+    llm = make_llm()
+
     system = SystemMessage(
         content=f"""
 Ты — автономный помощник системного администратора для Debian 12.
@@ -302,15 +625,27 @@ def make_agent(host: str, user: str, password: Optional[str], key_path: Optional
 - Одна команда за шаг (никаких && ; | $() backticks).
 - Сначала диагностика, потом изменения.
 - Для установки/обновления используй apt-get (инструмент сам добавит sudo, -y и DEBIAN_FRONTEND=noninteractive).
+- Ставь нужные пакеты одной командой (apt-get install a b c). apt-get update при свежих индексах вернёт "[skipped: ...]" — это успех.
 - После изменений всегда проверяй результат (dpkg -l, systemctl is-active/status, nginx -v).
-- Если получаешь "FATAL: APT repeatedly failed..." — остановись и дай чёткие рекомендации что проверить.
+- Вывод df, free, ps, ss, systemctl --failed, journalctl -p и dpkg -l приходит разобранным: stdout "(parsed) {...}".
+- Долгие apt-get/dnf/yum install/upgrade/update запускаются фоновой задачей: run_remote сразу вернёт "JOB RUNNING id=...".
+  Пока она идёт, делай read-only диагностику; итог — job_status(job_id) или wait_job(job_id). Не завершай работу, не узнав итог.
+- Повтор команды возвращает "delta": вывод "[unchanged since previous run]" или unified diff к прошлому выводу.
+{fleet_rule}- Если получаешь "FATAL: APT repeatedly failed..." — остановись и дай чёткие рекомендации что проверить.
 
 Важно про лимиты:
 - Если модельный лимит (429) — завершайся кратко и не пытайся делать ещё шаги.
 """.strip()
+        + facts_block
     )
 
-    agent = create_react_agent(model=llm, tools=[run_remote])
+    # старые результаты run_remote сжимаются перед каждым вызовом модели
+    agent = create_react_agent(
+        model=llm,
+        tools=[remote_tool] + ([] if hosts else job_tools),
+        pre_model_hook=make_history_trimmer(meter=meter),
+        checkpointer=get_checkpointer() if run_id else None,
+    )
     return agent, system
 
 
@@ -319,51 +654,87 @@ def make_agent(host: str, user: str, password: Optional[str], key_path: Optional
 # -------------------------
 
 
-def write_report(goal: str, host: str, user: str, final_text: str) -> Path:
-    ts = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
-    report_path = REPORT_DIR / f"report_{host}_{ts}.md"
+def _report_header(goal: str, host: str, hosts: Optional[List[str]], user: str) -> List[str]:
+    lines = ["# Agent report", "", f"- Goal: {goal}", f"- Host: `{host}`"]
+    if hosts:
+        lines.append(f"- Fleet: {len(hosts)} hosts")
+    lines.append(f"- User: `{user}`")
+    lines.append("- Model: " + " → ".join(f"`{m}`" for m in model_chain()))
+    return lines
+
+
+def _output_link(item: Dict[str, Any]) -> List[str]:
+    refs = [item[k] for k in ("stdout_file", "stderr_file") if item.get(k)]
+    return ["Full output: " + ", ".join(f"[{r}]({r})" for r in refs)] if refs else []
+
 
+def _render_step(i: int, s: Dict[str, Any]) -> List[str]:
     lines: List[str] = []
-    lines.append("# Agent report")
-    lines.append("")
-    lines.append(f"- Goal: {goal}")
-    lines.append(f"- Host: `{host}`")
-    lines.append(f"- User: `{user}`")
-    lines.append(f"- Model: `{OPENROUTER_MODEL}`")
-    lines.append(f"- Steps: {len(RUN_STEPS)}")
+    lines.append(f"## Step {i}")
+    lines.append(f"**Command:** `{s.get('cmd', '')}`")
+    lines.append(
+        f"- Exit: `{s.get('exit_code')}`  OK: `{s.get('ok')}`  Duration: `{round(float(s.get('duration_s', 0.0)), 3)}s`"
+    )
+    if s.get("cached"):
+        lines.append(f"- Cached: yes ({s.get('cache_age_s')}s old)")
+    if s.get("error"):
+        lines.append("")
+        lines.append("**Policy/Error:**")
+        lines.append("```")
+        lines.append(str(s["error"]))
+        lines.append("```")
+    if s.get("groups"):
+        for g in s["groups"]:
+            lines.append("")
+            lines.append(f"### Exit `{g.get('exit_code')}` — {hosts_label(g['hosts'])}")
+            lines.append("Hosts: " + ", ".join(f"`{h}`" for h in g["hosts"]))
+            if g.get("error"):
+                lines.append(f"Error: {g['error']}")
+            if not g.get("ok", False):
+                lines.append("```")
+                lines.append((g.get("stdout") or "").strip())
+                lines.append("```")
+                lines.append("STDERR:")
+                lines.append("```")
+                lines.append((g.get("stderr") or "").strip())
+                lines.append("```")
+                lines.extend(_output_link(g))
+    elif not s.get("ok", False):
+        lines.append("")
+        lines.append("### STDOUT (head)")
+        lines.append("```")
+        lines.append((s.get("stdout") or "").strip())
+        lines.append("```")
+        lines.append("### STDERR (head)")
+        lines.append("```")
+        lines.append((s.get("stderr") or "").strip())
+        lines.append("```")
+        lines.extend(_output_link(s))
     lines.append("")
-
-    for i, s in enumerate(RUN_STEPS, 1):
-        lines.append(f"## Step {i}")
-        lines.append(f"**Command:** `{s.get('cmd', '')}`")
+    return lines
+
+
+def _report_summary(
+    session: Session,
+    final_text: str,
+    llm_cache_stats: Optional[Dict[str, int]] = None,
+    token_usage: Optional[Dict[str, int]] = None,
+) -> List[str]:
+    lines = [f"- Steps: {len(session.steps)}"]
+    for job in session.jobs.values():
+        lines.append(f"- Background job still running: `{job['id']}` `{job['cmd']}`")
+    if llm_cache_stats is not None:
         lines.append(
-            f"- Exit: `{s.get('exit_code')}`  OK: `{s.get('ok')}`  Duration: `{round(float(s.get('duration_s', 0.0)), 3)}s`"
+            f"- LLM cache: {llm_cache_stats['hits']} hits, {llm_cache_stats['misses']} misses"
         )
-        if s.get("error"):
-            lines.append("")
-            lines.append("**Policy/Error:**")
-            lines.append("```")
-            lines.append(str(s["error"]))
-            lines.append("```")
-        if not s.get("ok", False):
-            lines.append("")
-            lines.append("### STDOUT (head)")
-            lines.append("```")
-            lines.append((s.get("stdout") or "").strip())
-            lines.append("```")
-            lines.append("### STDERR (head)")
-            lines.append("```")
-            lines.append((s.get("stderr") or "").strip())
-            lines.append("```")
-        lines.append("")
-
-    lines.append("## Final agent message")
+    if token_usage is not None:
+        lines.append(f"- Tokens: {usage_line(token_usage)}")
+    lines.append("")
+    lines.append("### Final agent message")
     lines.append("```")
     lines.append((final_text or "").strip())
     lines.append("```")
-
-    report_path.write_text("\n".join(lines), encoding="utf-8")
-    return report_path
+    return lines
 
 
 # -------------------------
@@ -371,75 +742,348 @@ def write_report(goal: str, host: str, user: str, final_text: str) -> Path:
 # -------------------------
 
 
-def run(
+def _open_run(
     goal: str,
     host: str,
     user: str,
+    key: Optional[str],
+    max_steps: int,
+    hosts: Optional[List[str]],
+    concurrency: int,
+    resume: Optional[str],
+) -> Session:
+    """Запись в RunStore и отчёт прогона (файлы и sqlite — блокирующие)."""
+    runs = get_run_store()
+    if resume:
+        run_id: Optional[str] = resume
+    else:
+        params = {
+            "goal": goal,
+            "host": host,
+            "user": user,
+            "key": key,
+            "max_steps": max_steps,
+            "hosts": hosts,
+            "concurrency": concurrency,
+        }
+        run_id = runs.create("agent_tc", params) if runs is not None else None
+
+    session = Session(run_id)
+    session.report = ReportWriter.create(
+        report_path(host, hosts, session.id), _report_header(goal, host, hosts, user)
+    )
+    # после --resume прошлые шаги берём из сайдкара отчёта (нужны анти-лупу apt)
+    session.steps.extend(session.report.read_steps())
+    return session
+
+
+def _bootstrap(
+    session: Session,
+    host: str,
+    user: str,
     password: Optional[str],
     key: Optional[str],
-    max_steps: int = 35,
-) -> str:
-    RUN_STEPS.clear()
+    hosts: Optional[List[str]],
+    concurrency: int,
+) -> Dict[str, Any]:
+    """Bootstrap-проба хоста (SSH) и её раздел в отчёте."""
+    facts = bootstrap_bundle(host, user, key, password, hosts, concurrency)
+    log("bootstrap", {"host": host, "facts": facts})
+    session.report.add_section(
+        "Host facts", ["```json", json.dumps(facts, ensure_ascii=False, indent=2), "```"]
+    )
+    return facts
+
 
-    agent, system = make_agent(host=host, user=user, password=password, key_path=key)
+def _context(session: Session) -> Dict[str, Any]:
+    """Контекст прогона, которого хватает _finish() даже при сбое подготовки."""
+    cache = get_llm_cache()
+    return {
+        "run_id": session.run_id,
+        "runs": get_run_store(),
+        "session": session,
+        "cache": cache,
+        "cache_base": cache.stats() if cache is not None else None,
+        "meter": TokenMeter(),
+    }
+
+
+def _start(
+    ctx: Dict[str, Any],
+    goal: str,
+    host: str,
+    user: str,
+    password: Optional[str],
+    key: Optional[str],
+    max_steps: int,
+    hosts: Optional[List[str]],
+    concurrency: int,
+    resume: Optional[str],
+) -> None:
+    """Подготовка run(): bootstrap, агент, вход графа и config — в ctx."""
+    # при --resume системный промпт с фактами уже в сохранённой истории
+    facts = None
+    if BOOTSTRAP_ENABLED and not resume:
+        facts = _bootstrap(ctx["session"], host, user, password, key, hosts, concurrency)
+    _assemble(ctx, goal, host, user, password, key, max_steps, hosts, concurrency, resume, facts)
+
+
+async def _astart(
+    ctx: Dict[str, Any],
+    goal: str,
+    host: str,
+    user: str,
+    password: Optional[str],
+    key: Optional[str],
+    max_steps: int,
+    hosts: Optional[List[str]],
+    concurrency: int,
+    resume: Optional[str],
+) -> None:
+    """_start() для arun(): bootstrap — на SSH_EXECUTOR, не в event loop."""
+    facts = None
+    if BOOTSTRAP_ENABLED and not resume:
+        facts = await run_blocking(
+            _bootstrap, ctx["session"], host, user, password, key, hosts, concurrency
+        )
+    _assemble(ctx, goal, host, user, password, key, max_steps, hosts, concurrency, resume, facts)
+
+
+def _assemble(
+    ctx: Dict[str, Any],
+    goal: str,
+    host: str,
+    user: str,
+    password: Optional[str],
+    key: Optional[str],
+    max_steps: int,
+    hosts: Optional[List[str]],
+    concurrency: int,
+    resume: Optional[str],
+    facts: Optional[Dict[str, Any]],
+) -> None:
+    run_id = ctx["run_id"]
+    agent, system = make_agent(
+        host=host,
+        user=user,
+        password=password,
+        key_path=key,
+        hosts=hosts,
+        concurrency=concurrency,
+        meter=ctx["meter"],
+        run_id=run_id,
+        facts=facts,
+        session=ctx["session"],
+    )
 
     log(
         "agent_start",
-        {"goal": goal, "host": host, "user": user, "max_steps": max_steps},
+        {
+            "run_id": run_id,
+            "resumed": bool(resume),
+            "goal": goal,
+            "host": host,
+            "hosts": len(hosts) if hosts else 1,
+            "user": user,
+            "max_steps": max_steps,
+        },
+    )
+    ctx.update(
+        goal=goal,
+        host=host,
+        user=user,
+        hosts=hosts,
+        agent=agent,
+        # при --resume вход None: граф продолжает сохранённую историю сообщений
+        input=None if resume else {"messages": [system, ("user", goal)]},
+        config={"recursion_limit": max_steps, "configurable": {"thread_id": run_id}},
     )
 
-    final = ""
-    try:
-        result = agent.invoke(
-            {"messages": [system, ("user", goal)]},
-            config={"recursion_limit": max_steps},
-        )
+
+def _finish(
+    ctx: Dict[str, Any],
+    result: Optional[Dict[str, Any]] = None,
+    error: Optional[Exception] = None,
+) -> Dict[str, Any]:
+    runs, run_id, meter, session = ctx["runs"], ctx["run_id"], ctx["meter"], ctx["session"]
+
+    if error is None:
+        status = "done"
         messages = result.get("messages", [])
+        meter.add_usage(messages)
         final = (
             str(messages[-1].content or "")
             if messages
             else "(No final message returned by agent.)"
         )
+        if runs is not None:
+            runs.set_status(run_id, status)
 
-    except openai.RateLimitError as e:
+    elif isinstance(error, openai.RateLimitError):
         # ВАЖНО: не падаем. Сохраняем отчёт о том, что уже успели сделать.
+        status = "interrupted"
         final = (
             "LLM rate limit hit (OpenRouter free tier). "
             "Commands already executed on the server are captured in the report.\n\n"
-            f"Error: {e}"
+            f"Error: {error}"
         )
-        log("llm_rate_limited", {"error": str(e)})
+        if runs is not None:
+            runs.set_status(run_id, status, str(error))
+            final += f"\n\nContinue with: python agent_tc.py --resume {run_id}"
+        log("llm_rate_limited", {"error": str(error)})
+
+    else:
+        status = "failed"
+        # без агента граф не стартовал: чекпоинта нет, --resume продолжать нечего
+        started = "agent" in ctx
+        what = "LLM call failed" if started else "Run setup failed"
+        final = f"{what}: {type(error).__name__}: {error}"
+        if runs is not None:
+            runs.set_status(run_id, status, f"{type(error).__name__}: {error}")
+            if started:
+                final += f"\n\nContinue with: python agent_tc.py --resume {run_id}"
+        log(
+            "llm_error" if started else "setup_error",
+            {"error": str(error), "type": type(error).__name__},
+        )
+
+    cache_stats = None
+    if ctx["cache"] is not None:
+        now = ctx["cache"].stats()
+        cache_stats = {k: now[k] - ctx["cache_base"][k] for k in now}
+        log("llm_cache_stats", cache_stats)
+    token_usage = meter.as_dict()
+    log("token_usage", token_usage)
+
+    # шаги уже в отчёте — дописываем только сводку
+    report_file = session.report.finalize(
+        _report_summary(session, final, cache_stats, token_usage)
+    )
+    log("report_written", {"path": str(report_file)})
+    record_report(report_file)
+    # незавершённые фоновые задачи хост больше не держат: итог узнает --resume
+    CHANGE_LOCKS.release_all(session)
+
+    log("agent_done", {"final_len": len(final), "steps": len(session.steps)})
+    get_run_logger().flush()
+    return {
+        "run_id": run_id,
+        "status": status,
+        "final": final,
+        "report": str(report_file),
+        "steps": len(session.steps),
+        "jobs_running": list(session.jobs),
+        "tokens": token_usage,
+        "text": final + f"\n\n[Report saved to {report_file}]",
+    }
+
+
+def run(
+    goal: str,
+    host: str,
+    user: str,
+    password: Optional[str],
+    key: Optional[str],
+    max_steps: int = 35,
+    hosts: Optional[List[str]] = None,
+    concurrency: int = FLEET_CONCURRENCY,
+    resume: Optional[str] = None,
+) -> str:
+    return run_result(goal, host, user, password, key, max_steps, hosts, concurrency, resume)["text"]
+
 
+def run_result(
+    goal: str,
+    host: str,
+    user: str,
+    password: Optional[str],
+    key: Optional[str],
+    max_steps: int = 35,
+    hosts: Optional[List[str]] = None,
+    concurrency: int = FLEET_CONCURRENCY,
+    resume: Optional[str] = None,
+) -> Dict[str, Any]:
+    """run() с итогом словарём: status, final, report, run_id, ... (для batch.py)."""
+    session = _open_run(goal, host, user, key, max_steps, hosts, concurrency, resume)
+    RUN_ID.set(session.run_id)
+    ctx = _context(session)
+    try:
+        _start(ctx, goal, host, user, password, key, max_steps, hosts, concurrency, resume)
+        result = ctx["agent"].invoke(ctx["input"], config=ctx["config"])
     except Exception as e:
-        final = f"LLM call failed: {type(e).__name__}: {e}"
-        log("llm_error", {"error": str(e), "type": type(e).__name__})
+        return _finish(ctx, error=e)
+    return _finish(ctx, result=result)
 
-    report_path = write_report(goal=goal, host=host, user=user, final_text=final)
-    log("report_written", {"path": str(report_path)})
 
-    log("agent_done", {"final_len": len(final), "steps": len(RUN_STEPS)})
-    return final + f"\n\n[Report saved to {report_path}]"
+async def arun(
+    goal: str,
+    host: str,
+    user: str,
+    password: Optional[str],
+    key: Optional[str],
+    max_steps: int = 35,
+    hosts: Optional[List[str]] = None,
+    concurrency: int = FLEET_CONCURRENCY,
+    resume: Optional[str] = None,
+) -> str:
+    """
+    Async-вариант run(): модель вызывается через ainvoke, run_remote — на
+    SSH_EXECUTOR. Состояние прогона — в своей Session, так что параллельных
+    сессий в процессе может быть сколько угодно.
+    """
+    session = await run_blocking(
+        _open_run, goal, host, user, key, max_steps, hosts, concurrency, resume
+    )
+    # RUN_ID ставим здесь: run_blocking работает в копии контекста
+    RUN_ID.set(session.run_id)
+    ctx = _context(session)
+    try:
+        await _astart(ctx, goal, host, user, password, key, max_steps, hosts, concurrency, resume)
+        result = await ctx["agent"].ainvoke(ctx["input"], config=ctx["config"])
+    # статус, отчёт с fsync, импорт в историю — блокирующие, не на event loop
+    except Exception as e:
+        return (await run_blocking(_finish, ctx, error=e))["text"]
+    return (await run_blocking(_finish, ctx, result=result))["text"]
 
 
 if __name__ == "__main__":
     import argparse
 
     p = argparse.ArgumentParser()
-    p.add_argument("--goal", required=True)
-    p.add_argument("--host", required=True)
-    p.add_argument("--user", required=True)
+    p.add_argument("--goal")
+    target = p.add_mutually_exclusive_group()
+    target.add_argument("--host")
+    target.add_argument("--inventory", help="файл со списком хостов (fleet-режим)")
+    p.add_argument("--concurrency", type=int, default=FLEET_CONCURRENCY)
+    p.add_argument("--user")
     p.add_argument("--password", default=None)
     p.add_argument("--key", default=None)
     p.add_argument("--max-steps", type=int, default=35)
+    p.add_argument("--resume", metavar="RUN_ID", help="продолжить сохранённый прогон")
+    p.add_argument("--async", dest="use_async", action="store_true", help="async-граф (ainvoke)")
     args = p.parse_args()
-
-    print(
-        run(
-            goal=args.goal,
-            host=args.host,
-            user=args.user,
-            password=args.password,
-            key=args.key,
-            max_steps=args.max_steps,
+    runner = (lambda **kw: asyncio.run(arun(**kw))) if args.use_async else run
+
+    if args.resume:
+        runs = get_run_store()
+        saved = runs.get(args.resume) if runs is not None else None
+        if saved is None or saved["agent"] != "agent_tc":
+            p.error(f"run {args.resume} not found")
+        # пароль не сохраняется — его передают заново
+        print(runner(**saved["params"], password=args.password, resume=args.resume))
+    else:
+        if not (args.goal and args.user and (args.host or args.inventory)):
+            p.error("--goal, --user and --host/--inventory are required")
+        hosts = load_inventory(args.inventory) if args.inventory else None
+        print(
+            runner(
+                goal=args.goal,
+                host=args.host or f"fleet ({len(hosts)} hosts)",
+                user=args.user,
+                password=args.password,
+                key=args.key,
+                max_steps=args.max_steps,
+                hosts=hosts,
+                concurrency=args.concurrency,
+            )
         )
-    )
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""
+Пакетный прогон agent_tc по очереди заявок из JSONL.
+
+Строка входа — заявка:
+
+    {"id": "T-101", "goal": "...", "host": "web1", "user": "admin",
+     "key": "~/.ssh/id_ed25519", "max_steps": 35}
+
+Вместо host можно дать "hosts" (список) или "inventory" (файл) —
+fleet-режим. Пароль в файле заявок не держим: --password действует на все
+заявки. Заявки идут на пуле из --workers потоков; это общий предел
+одновременных прогонов. На одном хосте одновременно идёт не больше
+--per-host прогонов. Изменяющие команды разных прогонов на одном хосте и так
+идут по одной (CHANGE_LOCKS в ssh_pool). Итог каждой заявки — строка JSONL
+в --out в порядке завершения. Заявки, уже записанные туда со status "done",
+при повторном запуске пропускаются.
+
+    python batch.py tickets.jsonl --out results.jsonl --workers 8 --per-host 2
+"""
+
+import json
+import os
+import threading
+import time
+from collections import Counter
+from typing import Any, Dict, List, Optional, Set
+
+import agent_tc
+from fleet import FLEET_CONCURRENCY, load_inventory
+from runlog import get_run_logger
+
+BATCH_WORKERS = int(os.environ.get("AGENT_BATCH_WORKERS", "4"))
+BATCH_PER_HOST = int(os.environ.get("AGENT_BATCH_PER_HOST", "1"))
+
+
+def log(event: str, data: Dict[str, Any]):
+    get_run_logger().log(event, data)
+
+
+# -------------------------
+# Заявки
+# -------------------------
+
+
+def load_requests(path: str) -> List[Dict[str, Any]]:
+    """Заявки из JSONL; у каждой есть id (по умолчанию — номер строки) и goal."""
+    reqs = []
+    with open(path, encoding="utf-8") as f:
+        for n, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            req = json.loads(line)
+            req.setdefault("id", str(n))
+            if not req.get("goal"):
+                raise ValueError(f"{path}:{n}: goal is required")
+            if not (req.get("host") or req.get("hosts") or req.get("inventory")):
+                raise ValueError(f"{path}:{n}: host, hosts or inventory is required")
+            if req.get("inventory"):
+                req["hosts"] = load_inventory(req["inventory"])
+            reqs.append(req)
+    return reqs
+
+
+def done_ids(path: str) -> Set[str]:
+    """id заявок, которые уже завершились в прошлый запуск."""
+    ids: Set[str] = set()
+    try:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue  # строка, оборванная на прошлом запуске
+                if rec.get("status") == "done":
+                    ids.add(str(rec.get("id")))
+    except OSError:
+        pass
+    return ids
+
+
+def _hosts(req: Dict[str, Any]) -> List[str]:
+    return list(req.get("hosts") or [req["host"]])
+
+
+# -------------------------
+# Очередь
+# -------------------------
+
+
+class HostQueue:
+    """
+    Очередь заявок с пределом прогонов на хост: take() отдаёт первую заявку,
+    все хосты которой свободны, и ждёт, если таких нет. Хосты заявки, которая
+    ждёт, придержаны за ней: более поздние заявки на них не обгоняют её, иначе
+    поток одиночных заявок вечно откладывал бы fleet-заявку.
+    """
+
+    def __init__(self, reqs: List[Dict[str, Any]], per_host: int):
+        self.pending = list(reqs)
+        self.per_host = max(1, per_host)
+        self.active: Counter = Counter()
+        self._cond = threading.Condition()
+
+    def take(self) -> Optional[Dict[str, Any]]:
+        with self._cond:
+            while self.pending:
+                held: Set[str] = set()
+                for i, req in enumerate(self.pending):
+                    hosts = _hosts(req)
+                    if held.isdisjoint(hosts) and all(
+                        self.active[h] < self.per_host for h in hosts
+                    ):
+                        del self.pending[i]
+                        self.active.update(hosts)
+                        return req
+                    held.update(hosts)
+                self._cond.wait()
+            return None
+
+    def done(self, req: Dict[str, Any]) -> None:
+        with self._cond:
+            self.active.subtract(_hosts(req))
+            self._cond.notify_all()
+
+
+# -------------------------
+# Прогон
+# -------------------------
+
+
+def run_request(req: Dict[str, Any], password: Optional[str]) -> Dict[str, Any]:
+    hosts = req.get("hosts")
+    # paramiko не раскрывает ~ в key_filename
+    key = os.path.expanduser(req["key"]) if req.get("key") else None
+    t0 = time.time()
+    try:
+        res = agent_tc.run_result(
+            goal=req["goal"],
+            host=req.get("host") or f"fleet ({len(hosts)} hosts)",
+            user=req["user"],
+            password=password,
+            key=key,
+            max_steps=int(req.get("max_steps", 35)),
+            hosts=hosts,
+            concurrency=int(req.get("concurrency", FLEET_CONCURRENCY)),
+        )
+    except Exception as e:
+        # сбой до графа (SSH в bootstrap, отчёт, ...) — заявке, а не всему пакету
+        res = {"status": "error", "final": f"{type(e).__name__}: {e}"}
+    res.pop("text", None)
+    return {"id": req["id"], **res, "duration_s": round(time.time() - t0, 3)}
+
+
+def run_batch(
+    reqs: List[Dict[str, Any]],
+    out_path: str,
+    password: Optional[str] = None,
+    workers: int = BATCH_WORKERS,
+    per_host: int = BATCH_PER_HOST,
+) -> Dict[str, int]:
+    """Выполняет заявки и дописывает итоги в out_path; возвращает счётчик статусов."""
+    queue = HostQueue(reqs, per_host)
+    statuses: Counter = Counter()
+    write_lock = threading.Lock()
+    log("batch_start", {"requests": len(reqs), "workers": workers, "per_host": per_host})
+
+    def worker() -> None:
+        while True:
+            req = queue.take()
+            if req is None:
+                return
+            try:
+                rec = run_request(req, password)
+            finally:
+                queue.done(req)
+            line = json.dumps(rec, ensure_ascii=False) + "\n"
+            with write_lock:
+                with open(out_path, "a", encoding="utf-8") as f:
+                    f.write(line)
+                statuses[rec["status"]] += 1
+            log("batch_request_done", {"id": rec["id"], "status": rec["status"]})
+
+    threads = [
+        threading.Thread(target=worker, name=f"batch-{i}", daemon=True)
+        for i in range(max(1, min(workers, len(reqs))))
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    log("batch_done", dict(statuses))
+    get_run_logger().flush()
+    return dict(statuses)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    p = argparse.ArgumentParser()
+    p.add_argument("requests", help="JSONL с заявками")
+    p.add_argument("--out", default="results.jsonl")
+    p.add_argument("--workers", type=int, default=BATCH_WORKERS, help="прогонов одновременно")
+    p.add_argument("--per-host", type=int, default=BATCH_PER_HOST, help="прогонов на один хост")
+    p.add_argument("--user", help="user для заявок без своего")
+    p.add_argument("--key", default=None, help="ключ для заявок без своего")
+    p.add_argument("--password", default=None)
+    args = p.parse_args()
+
+    reqs = load_requests(args.requests)
+    skip = done_ids(args.out)
+    todo = [r for r in reqs if str(r["id"]) not in skip]
+    for r in todo:
+        r.setdefault("user", args.user)
+        r.setdefault("key", args.key and os.path.expanduser(args.key))
+        if not r["user"]:
+            p.error(f"request {r['id']}: user is required (in the file or --user)")
+    print(f"{len(todo)} to run, {len(reqs) - len(todo)} already done")
+    print(run_batch(todo, args.out, args.password, args.workers, args.per_host))
@@ -0,0 +1,84 @@
+"""
+Микробенчмарк чтения канала: накладные расходы на команду для старого цикла
+(recv 4 KB + sleep 0.1) и для событийного ssh_stream.read_channel.
+
+    python -m bench.bench_reader [--runs 20] [--size 0,16384,65536] [--latency 0.03]
+
+Старый цикл читает по 4 KB раз в 100 мс, поэтому на мегабайтных выводах
+он занимает десятки секунд на прогон — крупные размеры задавайте явно.
+"""
+
+import argparse
+import statistics
+import time
+
+from bench.fake_ssh import FakeSSHServer, Reply
+from ssh_pool import SSHPool
+from ssh_stream import read_channel
+
+
+def legacy_read(channel, timeout: float):
+    # копия цикла из agent_tc._ssh_exec до перехода на read_channel
+    out_chunks, err_chunks = [], []
+    start = time.time()
+    while not channel.exit_status_ready():
+        if channel.recv_ready():
+            out_chunks.append(channel.recv(4096).decode(errors="replace"))
+        if channel.recv_stderr_ready():
+            err_chunks.append(channel.recv_stderr(4096).decode(errors="replace"))
+        if time.time() - start > timeout:
+            break
+        time.sleep(0.1)
+    while channel.recv_ready():
+        out_chunks.append(channel.recv(4096).decode(errors="replace"))
+    while channel.recv_stderr_ready():
+        err_chunks.append(channel.recv_stderr(4096).decode(errors="replace"))
+    code = channel.recv_exit_status()
+    return {"stdout": "".join(out_chunks), "exit_code": code}
+
+
+def measure(pool: SSHPool, addr: str, cmd: str, reader, runs: int):
+    samples = []
+    cpu0 = time.process_time()
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        with pool.session(addr, "bench", password="x") as chan:
+            chan.exec_command(cmd)
+            reader(chan, 60)
+        samples.append(time.perf_counter() - t0)
+    cpu = time.process_time() - cpu0
+    return samples, cpu / runs
+
+
+def main() -> None:
+    p = argparse.ArgumentParser()
+    p.add_argument("--runs", type=int, default=20)
+    p.add_argument("--size", default="0,16384,65536")
+    p.add_argument("--latency", type=float, default=0.03)  # "время работы" команды
+    args = p.parse_args()
+
+    sizes = [int(x) for x in args.size.split(",")]
+    script = {f"out {n}": Reply(stdout="x" * n) for n in sizes}
+    srv = FakeSSHServer(script=script, latency_s=args.latency).start()
+    pool = SSHPool()
+
+    print(f"{'size':>9} {'reader':>8} {'p50 ms':>8} {'p95 ms':>8} {'cpu ms':>8}")
+    try:
+        for n in sizes:
+            cmd = f"out {n}"
+            # прогрев соединения, чтобы мерить только канал
+            measure(pool, srv.address, cmd, read_channel, 1)
+            for name, reader in (("legacy", legacy_read), ("event", read_channel)):
+                samples, cpu = measure(pool, srv.address, cmd, reader, args.runs)
+                q = statistics.quantiles(samples, n=20)
+                print(
+                    f"{n:>9} {name:>8} {statistics.median(samples) * 1000:>8.1f} "
+                    f"{q[18] * 1000:>8.1f} {cpu * 1000:>8.2f}"
+                )
+    finally:
+        pool.close_all()
+        srv.stop()
+
+
+if __name__ == "__main__":
+    main()
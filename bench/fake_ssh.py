@@ -0,0 +1,177 @@
+"""
+Локальный SSH-сервер на paramiko для бенчмарков: отвечает на exec-запросы
+заранее заданными выводами с настраиваемой задержкой и размером вывода,
+считает байты на проводе в обе стороны.
+"""
+
+import socket
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Union
+
+import paramiko
+
+
+@dataclass
+class Reply:
+    stdout: str = ""
+    stderr: str = ""
+    exit_code: int = 0
+    latency_s: float = 0.0
+
+
+def filler(nbytes: int, line: str = "Feb 22 14:28:01 vm kernel: [ 1.000000] filler\n") -> str:
+    """Правдоподобный многострочный вывод примерно nbytes байт."""
+    reps = max(1, nbytes // len(line))
+    return line * reps
+
+
+class _CountingSocket:
+    """Обёртка над сокетом для paramiko.Transport: считает байты на проводе."""
+
+    def __init__(self, sock: socket.socket, owner: "FakeSSHServer"):
+        self._sock = sock
+        self._owner = owner
+
+    def send(self, data, *args):
+        n = self._sock.send(data, *args)
+        self._owner._count(wire_out=n)
+        return n
+
+    def sendall(self, data, *args):
+        self._sock.sendall(data, *args)
+        self._owner._count(wire_out=len(data))
+
+    def recv(self, n, *args):
+        data = self._sock.recv(n, *args)
+        self._owner._count(wire_in=len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._sock, name)
+
+
+Script = Dict[str, Union[Reply, Callable[[str], Reply]]]
+
+
+class _Server(paramiko.ServerInterface):
+    def __init__(self, owner: "FakeSSHServer"):
+        self.owner = owner
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return "password,publickey"
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        cmd = command.decode("utf-8", errors="replace")
+        threading.Thread(
+            target=self.owner._reply, args=(channel, cmd), daemon=True
+        ).start()
+        return True
+
+
+class FakeSSHServer:
+    """
+    script: команда -> Reply (или функция cmd -> Reply).
+    Неизвестные команды получают default(cmd).
+    """
+
+    def __init__(
+        self,
+        script: Optional[Script] = None,
+        default: Optional[Callable[[str], Reply]] = None,
+        latency_s: float = 0.0,
+        host: str = "127.0.0.1",
+        host_key: Optional[paramiko.PKey] = None,
+    ):
+        self.script: Script = dict(script or {})
+        self.default = default or (lambda cmd: Reply(stdout=f"{cmd}\n"))
+        self.latency_s = latency_s
+        self.bind_host = host
+        # генерация RSA-ключа дорогая — для флота передавайте один общий
+        self.host_key = host_key or paramiko.RSAKey.generate(2048)
+        self.commands: List[str] = []
+        self.connections = 0
+        self.bytes_sent = 0  # полезная нагрузка stdout/stderr
+        self.wire_in = 0
+        self.wire_out = 0
+        self._lock = threading.Lock()
+        self._sock: Optional[socket.socket] = None
+        self._transports: List[paramiko.Transport] = []
+
+    @property
+    def address(self) -> str:
+        assert self._sock is not None
+        host, port = self._sock.getsockname()[:2]
+        return f"{host}:{port}"
+
+    def start(self, port: int = 0) -> "FakeSSHServer":
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.bind_host, port))
+        sock.listen(128)
+        self._sock = sock
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        if self._sock is not None:
+            self._sock.close()
+        for t in self._transports:
+            t.close()
+
+    def _accept_loop(self) -> None:
+        while True:
+            try:
+                client, _ = self._sock.accept()
+            except OSError:
+                return
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            t = paramiko.Transport(_CountingSocket(client, self))
+            t.add_server_key(self.host_key)
+            t.start_server(server=_Server(self))
+            with self._lock:
+                self.connections += 1
+                self._transports.append(t)
+
+    def _count(self, wire_in: int = 0, wire_out: int = 0) -> None:
+        with self._lock:
+            self.wire_in += wire_in
+            self.wire_out += wire_out
+
+    def _reply(self, channel: paramiko.Channel, cmd: str) -> None:
+        with self._lock:
+            self.commands.append(cmd)
+        entry = self.script.get(cmd, self.default)
+        reply = entry(cmd) if callable(entry) else entry
+
+        delay = self.latency_s + reply.latency_s
+        if delay:
+            time.sleep(delay)
+
+        out = reply.stdout.encode()
+        err = reply.stderr.encode()
+        try:
+            if out:
+                channel.sendall(out)
+            if err:
+                channel.sendall_stderr(err)
+            channel.send_exit_status(reply.exit_code)
+            # close не шлём: он может обогнать ответ на exec-request, и клиент
+            # увидит "Channel closed"; канал закроет сам клиент
+            channel.shutdown_write()
+        except (OSError, EOFError, paramiko.SSHException):
+            return
+        with self._lock:
+            self.bytes_sent += len(out) + len(err)
@@ -0,0 +1,296 @@
+"""
+Офлайн end-to-end бенчмарк обоих агентов: локальные fake SSH-серверы +
+заглушка LLM, без VM и OpenRouter.
+
+    python -m bench.run_bench [--scenario diagnosis,nginx,fleet-50]
+                              [--agent agent,agent_tc] [--llm-latency 0]
+                              [--json bench_output.json]
+
+Для каждой пары (сценарий, агент) печатает шаги/сек, перцентили
+латентности шага (время между завершениями соседних шагов: планирование +
+политика + SSH), пиковый RSS процесса и байты на проводе.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Sequence, Union
+
+import paramiko
+
+from bench.fake_ssh import FakeSSHServer, Reply, filler
+from bench.stub_llm import StubChatModel, plan_script, tool_call_script
+
+# -------------------------
+# Scenarios
+# -------------------------
+
+OUTPUTS = {
+    "journalctl": "Feb 22 14:27:11 vm kernel: ata1.00: failed command: READ FPDMA QUEUED\n"
+    * 20,
+    "systemctl --failed": "  UNIT LOAD ACTIVE SUB DESCRIPTION\n0 loaded units listed.\n",
+    "free": "               total        used        free      shared  buff/cache   available\n"
+    "Mem:           3.8Gi       1.1Gi       1.9Gi        12Mi       1.0Gi       2.7Gi\n"
+    "Swap:          975Mi          0B       975Mi\n",
+    "df": "Filesystem      Size  Used Avail Use% Mounted on\n"
+    "/dev/vda1        20G  6.1G   13G  33% /\ntmpfs           1.9G     0  1.9G   0% /dev/shm\n",
+    "uptime": " 14:28:01 up 3 days,  2:11,  1 user,  load average: 0.08, 0.03, 0.01\n",
+    "uname": "Linux vm 6.1.0-18-arm64 #1 SMP Debian 6.1.76-1 (2024-02-01) aarch64 GNU/Linux\n",
+    "cat /etc/os-release": 'PRETTY_NAME="Debian GNU/Linux 12 (bookworm)"\nVERSION_ID="12"\nID=debian\n',
+    "ps": "USER PID %CPU %MEM VSZ RSS TTY STAT START TIME COMMAND\n"
+    + "root 1 0.0 0.3 167000 13000 ? Ss Feb19 0:05 /sbin/init\n" * 60,
+    "du": "1.2G\t/var/log\n",
+    "apt-get update": filler(6000, "Get:1 http://deb.debian.org/debian bookworm InRelease [151 kB]\n"),
+    "apt-get install": filler(20000, "Setting up nginx-common (1.22.1-9) ...\n"),
+    "systemctl restart": "",
+    "systemctl status": "● nginx.service - A high performance web server\n"
+    "     Active: active (running) since Sun 2026-02-22 14:30:01 UTC\n",
+    "dpkg -l": "ii  nginx  1.22.1-9  arm64  small, powerful, scalable web/proxy server\n",
+}
+
+PROBE_OUTPUT = (
+    "@@uname\nLinux 6.1.0-18-arm64 aarch64\n"
+    "@@os_release\n" + OUTPUTS["cat /etc/os-release"]
+    + "@@hostname\nvm\n"
+    "@@uptime\n266400.12 1050000.00\n0.08 0.03 0.01 1/120 4242\n"
+    "@@nproc\n2\n"
+    "@@meminfo\nMemTotal: 3984000 kB\nMemAvailable: 2831000 kB\n"
+    "SwapTotal: 998396 kB\nSwapFree: 998396 kB\n"
+    "@@df\nFilesystem 1024-blocks Used Available Capacity Mounted on\n"
+    "/dev/vda1 20511312 6396408 13049944 33% /\n"
+    "@@failed_units\n"
+    "@@errors\n" + OUTPUTS["journalctl"][:400]
+    + "@@pkg\n/usr/bin/apt-get\n"
+)
+
+
+def responder(cmd: str) -> Reply:
+    from bootstrap import PROBE
+    from policy import normalize_command
+
+    if cmd == PROBE:
+        return Reply(stdout=PROBE_OUTPUT)
+    c = normalize_command(cmd)
+    for prefix in sorted(OUTPUTS, key=len, reverse=True):
+        if c.startswith(prefix):
+            return Reply(stdout=OUTPUTS[prefix])
+    return Reply(stderr=f"bash: {c.split()[0]}: command not found\n", exit_code=127)
+
+
+@dataclass
+class Scenario:
+    name: str
+    goal: str
+    # команда или пачка read-only команд (только agent.py) на шаг
+    steps: List[Union[str, Sequence[str]]]
+    hosts: int = 1
+    ssh_latency_s: float = 0.02
+    extra: Dict[str, Any] = field(default_factory=dict)
+
+
+DIAGNOSIS = [
+    "journalctl -p err -n 20 --no-pager",
+    "free -h",
+    "df -h",
+    "uptime",
+    "uname -a",
+    "cat /etc/os-release",
+    "ps aux --sort=-%mem",
+    "du -sh /var/log",
+    "journalctl -p warning -n 50 --no-pager",
+    "systemctl status ssh",
+]
+
+SCENARIOS = {
+    "diagnosis": Scenario(
+        "diagnosis",
+        "Проверь систему на ошибки, диагностика памяти и диска",
+        DIAGNOSIS,
+    ),
+    "nginx": Scenario(
+        "nginx",
+        "Установи nginx и проверь, что он работает",
+        [
+            "uname -a",
+            "apt-get update",
+            "apt-get install nginx",
+            "systemctl restart nginx",
+            "systemctl status nginx",
+        ],
+    ),
+    "fleet-50": Scenario(
+        "fleet-50",
+        "Проверь память и диск на всём флоте",
+        ["free -h", "df -h", "uptime", "journalctl -p err -n 20 --no-pager"],
+        hosts=50,
+    ),
+}
+
+
+# -------------------------
+# Runner
+# -------------------------
+
+
+def _percentiles(samples: List[float]) -> Dict[str, float]:
+    if not samples:
+        return {"p50": 0.0, "p95": 0.0, "p99": 0.0}
+    if len(samples) == 1:
+        v = samples[0] * 1000
+        return {"p50": v, "p95": v, "p99": v}
+    q = statistics.quantiles(samples, n=100, method="inclusive")
+    return {
+        "p50": statistics.median(samples) * 1000,
+        "p95": q[94] * 1000,
+        "p99": q[98] * 1000,
+    }
+
+
+def _peak_rss_mb() -> float:
+    kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return kb / 1024 if sys.platform != "darwin" else kb / 1024 / 1024
+
+
+def run_one(scn: Scenario, agent_name: str, llm_latency: float, host_key) -> Dict[str, Any]:
+    import agent
+    import agent_tc
+
+    servers = [
+        FakeSSHServer(default=responder, latency_s=scn.ssh_latency_s, host_key=host_key).start()
+        for _ in range(scn.hosts)
+    ]
+    addrs = [s.address for s in servers]
+    fleet = addrs if scn.hosts > 1 else None
+    step_done: List[float] = []
+
+    if agent_name == "agent":
+        stub = StubChatModel(script=plan_script(scn.steps), latency_s=llm_latency)
+        stub.fallback = plan_script([])[-1]
+        orig_exec = agent.executor_node
+
+        def timed_executor(state):
+            has_work = bool(state.get("_next_commands") or state.get("_next_command"))
+            out = orig_exec(state)
+            if has_work:  # последний вызов после stop ничего не выполняет
+                step_done.append(time.perf_counter())
+            return out
+
+        patches = {"make_llm": lambda: stub, "executor_node": timed_executor}
+        module = agent
+    else:
+        # react-агент выполняет по одной команде за вызов инструмента
+        cmds = [c if isinstance(c, str) else c[0] for c in scn.steps]
+        stub = StubChatModel(script=tool_call_script(cmds), latency_s=llm_latency)
+        stub.fallback = "Готово."
+        orig_exec = agent_tc._ssh_exec_fleet if fleet else agent_tc._ssh_exec
+        name = "_ssh_exec_fleet" if fleet else "_ssh_exec"
+
+        def timed_ssh(*args, **kwargs):
+            out = orig_exec(*args, **kwargs)
+            if kwargs.get("session") is not None:  # шаг fleet-хоста не считаем
+                step_done.append(time.perf_counter())
+            return out
+
+        patches = {"make_llm": lambda: stub, name: timed_ssh}
+        module = agent_tc
+
+    saved = {k: getattr(module, k) for k in patches}
+    for k, v in patches.items():
+        setattr(module, k, v)
+    try:
+        t0 = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            if agent_name == "agent":
+                agent.run(
+                    goal=scn.goal,
+                    host=addrs[0] if not fleet else f"fleet ({len(addrs)} hosts)",
+                    user="bench",
+                    key_path=None,
+                    password="bench",
+                    max_steps=len(scn.steps) + 5,
+                    hosts=fleet,
+                )
+            else:
+                agent_tc.run(
+                    goal=scn.goal,
+                    host=addrs[0] if not fleet else f"fleet ({len(addrs)} hosts)",
+                    user="bench",
+                    password="bench",
+                    key=None,
+                    max_steps=4 * len(scn.steps) + 10,
+                    hosts=fleet,
+                )
+        wall = time.perf_counter() - t0
+    finally:
+        for k, v in saved.items():
+            setattr(module, k, v)
+        for s in servers:
+            s.stop()
+
+    marks = [t0] + step_done
+    lat = [b - a for a, b in zip(marks, marks[1:])]
+    return {
+        "scenario": scn.name,
+        "agent": agent_name,
+        "hosts": scn.hosts,
+        "steps": len(step_done),
+        "ssh_commands": sum(len(s.commands) for s in servers),
+        "llm_calls": stub.calls,
+        "wall_s": wall,
+        "steps_per_s": len(step_done) / wall if wall else 0.0,
+        **{f"step_{k}_ms": v for k, v in _percentiles(lat).items()},
+        "peak_rss_mb": _peak_rss_mb(),
+        "wire_bytes": sum(s.wire_in + s.wire_out for s in servers),
+        "payload_bytes": sum(s.bytes_sent for s in servers),
+    }
+
+
+def main() -> int:
+    p = argparse.ArgumentParser()
+    p.add_argument("--scenario", default=",".join(SCENARIOS))
+    p.add_argument("--agent", default="agent,agent_tc")
+    p.add_argument("--llm-latency", type=float, default=0.0)
+    p.add_argument("--json", default=None, help="куда сохранить результаты")
+    args = p.parse_args()
+
+    # изоляция от рабочих кэшей, отчётов и логов
+    tmp = tempfile.mkdtemp(prefix="agent-bench-")
+    os.environ.setdefault("OPENROUTER_API_KEY", "bench")
+    os.environ["AGENT_FACTS_CACHE"] = "0"
+    os.environ["AGENT_LLM_CACHE"] = "0"
+    os.environ["AGENT_CACHE_DIR"] = os.path.join(tmp, "cache")
+    os.environ["AGENT_REPORT_DIR"] = os.path.join(tmp, "reports")
+    os.environ["AGENT_LOG"] = os.path.join(tmp, "agent_run.log")
+    os.environ["AGENT_LOG_STDOUT"] = "0"  # эхо пишет фоновый поток, мимо redirect_stdout
+    # фейковый сервер не исполняет обёртку jobs.py: apt-команды меряем синхронно, как раньше
+    os.environ["AGENT_JOBS"] = "0"
+
+    host_key = paramiko.RSAKey.generate(2048)
+    results = []
+    cols = ("scenario", "agent", "steps", "wall_s", "steps_per_s", "step_p50_ms",
+            "step_p95_ms", "step_p99_ms", "peak_rss_mb", "wire_bytes")
+    print(" ".join(f"{c:>12}" for c in cols))
+    for name in args.scenario.split(","):
+        for agent_name in args.agent.split(","):
+            r = run_one(SCENARIOS[name], agent_name, args.llm_latency, host_key)
+            results.append(r)
+            print(" ".join(
+                f"{r[c]:>12.2f}" if isinstance(r[c], float) else f"{r[c]:>12}" for c in cols
+            ))
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
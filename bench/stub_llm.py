@@ -0,0 +1,111 @@
+"""
+Заглушка чат-модели для офлайн-бенчмарков: отдаёт заранее заданные ответы
+(JSON-планы для agent.py, tool calls для agent_tc.py) с настраиваемой
+"задержкой модели".
+"""
+
+import json
+import threading
+import time
+from typing import Any, Callable, Iterator, List, Optional, Sequence, Union
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from pydantic import PrivateAttr
+
+Scripted = Union[AIMessage, str, Callable[[List[BaseMessage]], AIMessage]]
+
+
+class StubChatModel(BaseChatModel):
+    script: List[Any]
+    latency_s: float = 0.0
+    # когда сценарий кончился — отвечаем этим (для agent.py — stop=true)
+    fallback: Any = None
+
+    _pos: int = PrivateAttr(default=0)
+    _lock: Any = PrivateAttr(default_factory=threading.Lock)
+
+    @property
+    def _llm_type(self) -> str:
+        return "stub"
+
+    @property
+    def calls(self) -> int:
+        return self._pos
+
+    def bind_tools(self, tools: Sequence[Any], **kwargs: Any):
+        # инструменты нам не нужны: tool calls уже записаны в сценарии
+        return self
+
+    def _next(self, messages: List[BaseMessage]) -> AIMessage:
+        with self._lock:
+            item = self.script[self._pos] if self._pos < len(self.script) else self.fallback
+            self._pos += 1
+        if item is None:
+            raise RuntimeError("StubChatModel: script exhausted")
+        if callable(item):
+            item = item(messages)
+        if isinstance(item, str):
+            item = AIMessage(content=item)
+        return item
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Any = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        if self.latency_s:
+            time.sleep(self.latency_s)
+        return ChatResult(generations=[ChatGeneration(message=self._next(messages))])
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Any = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        msg = self._next(messages)
+        text = msg.content if isinstance(msg.content, str) else ""
+        pieces = [text[i : i + 16] for i in range(0, len(text), 16)] or [""]
+        delay = self.latency_s / len(pieces) if self.latency_s else 0.0
+        for piece in pieces:
+            if delay:
+                time.sleep(delay)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=piece))
+
+
+def plan_script(commands: Sequence[Union[str, Sequence[str]]]) -> List[str]:
+    """JSON-ответы планировщика agent.py: команда (или пачка) на шаг, затем stop."""
+    out = []
+    for c in commands:
+        # порядок ключей — как в схеме из SYSTEM: команда раньше success_criteria
+        plan: dict = {"rationale": "bench"}
+        if isinstance(c, str):
+            plan["next_command"] = c
+        else:
+            plan["next_command"] = c[0]
+            plan["next_commands"] = list(c)
+        plan["success_criteria"] = "exit 0"
+        plan["stop"] = False
+        out.append(json.dumps(plan, ensure_ascii=False))
+    out.append(json.dumps({"rationale": "done", "next_command": "", "stop": True}))
+    return out
+
+
+def tool_call_script(commands: Sequence[str], final: str = "Готово.") -> List[AIMessage]:
+    """Ответы react-агента agent_tc: вызов run_remote на шаг, затем финальный текст."""
+    out = [
+        AIMessage(
+            content="",
+            tool_calls=[
+                {"name": "run_remote", "args": {"command": c}, "id": f"call_{i}"}
+            ],
+        )
+        for i, c in enumerate(commands)
+    ]
+    out.append(AIMessage(content=final))
+    return out
@@ -0,0 +1,282 @@
+"""
+Bootstrap-проба хоста: базовые факты одним SSH-вызовом до первого шага.
+
+Почти каждый прогон начинался с uname / os-release / uptime / free / df /
+systemctl --failed / journalctl — по отдельному ходу LLM и SSH на каждую.
+Здесь это один фиксированный read-only скрипт с маркерами секций (@@name);
+вывод разбирается локально в JSON, который получают планировщик agent.py
+и системный промпт agent_tc.
+
+Скрипт содержит ; и | и потому не пройдёт обычные правила политики —
+его одобряет запись "trusted" в policy.json по sha256 точного текста.
+Поменяли PROBE — обновите хэш (python bootstrap.py --hash), иначе проба
+будет отклонена.
+"""
+
+import hashlib
+import os
+import re
+from typing import Any, Dict, List, Optional
+
+from fleet import FLEET_CONCURRENCY, run_on_fleet
+from policy import POLICY
+from ssh_pool import POOL
+from ssh_stream import read_channel
+
+ENABLED = os.environ.get("AGENT_BOOTSTRAP", "1") != "0"
+TIMEOUT_S = 30
+MAX_ERRORS = 10
+
+# Без одинарных кавычек внутри: скрипт целиком в sh -c '...'
+_SCRIPT = """
+echo @@uname; uname -srm 2>&1
+echo @@os_release; cat /etc/os-release 2>&1
+echo @@hostname; hostname 2>&1
+echo @@uptime; cat /proc/uptime /proc/loadavg 2>&1
+echo @@nproc; nproc 2>&1
+echo @@meminfo; grep -E "^(MemTotal|MemAvailable|SwapTotal|SwapFree):" /proc/meminfo 2>&1
+echo @@df; df -P -k -x tmpfs -x devtmpfs -x squashfs -x overlay 2>&1
+echo @@failed_units; systemctl --failed --no-legend --plain 2>&1
+echo @@errors; journalctl -p err -n 20 --no-pager -o short-iso 2>&1
+echo @@pkg; command -v apt-get dnf yum 2>/dev/null
+exit 0
+""".strip()
+
+PROBE = f"sh -c '{_SCRIPT}'"
+PROBE_SHA256 = hashlib.sha256(PROBE.encode("utf-8")).hexdigest()
+
+_SECTION = re.compile(r"^@@(\w+)$")
+
+
+def sections(text: str) -> Dict[str, List[str]]:
+    out: Dict[str, List[str]] = {}
+    cur: Optional[List[str]] = None
+    for line in text.splitlines():
+        m = _SECTION.match(line.strip())
+        if m:
+            cur = out.setdefault(m.group(1), [])
+        elif cur is not None and line.strip():
+            cur.append(line.rstrip())
+    return out
+
+
+def _os_release(lines: List[str]) -> Dict[str, str]:
+    kv = {}
+    for line in lines:
+        if "=" in line:
+            k, v = line.split("=", 1)
+            kv[k.strip()] = v.strip().strip('"')
+    return {k.lower(): kv[k] for k in ("ID", "VERSION_ID", "PRETTY_NAME") if k in kv}
+
+
+def _meminfo(lines: List[str]) -> Dict[str, int]:
+    names = {
+        "MemTotal": "total_mb",
+        "MemAvailable": "available_mb",
+        "SwapTotal": "swap_total_mb",
+        "SwapFree": "swap_free_mb",
+    }
+    out = {}
+    for line in lines:
+        parts = line.replace(":", " ").split()
+        if len(parts) >= 2 and parts[0] in names and parts[1].isdigit():
+            out[names[parts[0]]] = int(parts[1]) // 1024
+    return out
+
+
+def _disks(lines: List[str]) -> List[Dict[str, Any]]:
+    out = []
+    for line in lines[1:]:  # заголовок df
+        parts = line.split()
+        if len(parts) < 6 or not parts[1].isdigit():
+            continue
+        out.append(
+            {
+                "mount": parts[5],
+                "size_gb": round(int(parts[1]) / 1024 / 1024, 1),
+                "avail_gb": round(int(parts[3]) / 1024 / 1024, 1),
+                "used_pct": int(parts[4].rstrip("%") or 0),
+            }
+        )
+    return out
+
+
+def parse_probe(text: str) -> Dict[str, Any]:
+    """Вывод PROBE -> факты. Отсутствующие секции просто не попадают в результат."""
+    s = sections(text)
+    facts: Dict[str, Any] = {}
+    if s.get("uname"):
+        facts["kernel"] = s["uname"][0]
+    if s.get("os_release"):
+        facts["os"] = _os_release(s["os_release"])
+    if s.get("hostname"):
+        facts["hostname"] = s["hostname"][0]
+    up = s.get("uptime") or []
+    if up and up[0].split()[0].replace(".", "", 1).isdigit():
+        facts["uptime_h"] = round(float(up[0].split()[0]) / 3600, 1)
+    if len(up) > 1:
+        facts["load"] = up[1].split()[:3]
+    if s.get("nproc") and s["nproc"][0].isdigit():
+        facts["cpus"] = int(s["nproc"][0])
+    if s.get("meminfo"):
+        facts["mem"] = _meminfo(s["meminfo"])
+    if s.get("df"):
+        facts["disks"] = _disks(s["df"])
+    if "failed_units" in s:
+        facts["failed_units"] = [ln.split()[0] for ln in s["failed_units"]]
+    if "errors" in s:
+        # "-- No entries --" и т.п. служебные строки не интересны
+        errs = [ln for ln in s["errors"] if not ln.startswith("--")]
+        facts["recent_errors"] = errs[-MAX_ERRORS:]
+    if s.get("pkg"):
+        facts["pkg_manager"] = os.path.basename(s["pkg"][0])
+    return facts
+
+
+def collect(
+    host: str,
+    user: str,
+    key_path: Optional[str] = None,
+    password: Optional[str] = None,
+) -> Dict[str, Any]:
+    """Факты одного хоста; при ошибке — {"error": ...}, прогон идёт дальше без них."""
+    verdict = POLICY.check(PROBE)
+    if verdict.kind != "readonly":
+        return {"error": f"bootstrap probe is not trusted by policy (sha256 {PROBE_SHA256})"}
+    try:
+        with POOL.session(host, user, key_path=key_path, password=password) as chan:
+            chan.exec_command(PROBE)
+            res = read_channel(chan, TIMEOUT_S)
+    except Exception as e:
+        return {"error": f"{type(e).__name__}: {e}"}
+    facts = parse_probe(res["stdout"])
+    if not facts:
+        return {"error": f"probe returned no facts (exit {res['exit_code']})"}
+    return facts
+
+
+def collect_fleet(
+    hosts: List[str],
+    user: str,
+    key_path: Optional[str] = None,
+    password: Optional[str] = None,
+    concurrency: int = FLEET_CONCURRENCY,
+) -> Dict[str, Dict[str, Any]]:
+    results = run_on_fleet(
+        hosts,
+        lambda h: {"facts": collect(h, user, key_path, password)},
+        concurrency=concurrency,
+    )
+    return {r["host"]: r.get("facts") or {"error": r.get("error")} for r in results}
+
+
+def _counts(values: List[Any]) -> Dict[str, int]:
+    out: Dict[str, int] = {}
+    for v in values:
+        out[str(v)] = out.get(str(v), 0) + 1
+    return dict(sorted(out.items(), key=lambda kv: -kv[1]))
+
+
+def summarize_fleet(by_host: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    """Свёртка фактов флота для контекста LLM: распределения и худшие хосты."""
+    ok = {h: f for h, f in by_host.items() if "error" not in f}
+    summary: Dict[str, Any] = {"hosts": len(by_host), "probed": len(ok)}
+    failed = sorted(h for h in by_host if h not in ok)
+    if failed:
+        summary["probe_failed"] = failed
+    if not ok:
+        return summary
+    summary["os"] = _counts([f.get("os", {}).get("pretty_name") for f in ok.values()])
+    summary["kernel"] = _counts([f.get("kernel") for f in ok.values()])
+
+    mem = [(f["mem"].get("available_mb", 0), h) for h, f in ok.items() if f.get("mem")]
+    if mem:
+        summary["lowest_mem_available_mb"] = dict((h, v) for v, h in sorted(mem)[:3])
+    disk = [
+        (d["used_pct"], f"{h}:{d['mount']}")
+        for h, f in ok.items()
+        for d in f.get("disks", [])
+    ]
+    if disk:
+        summary["fullest_disks_pct"] = dict((k, v) for v, k in sorted(disk, reverse=True)[:3])
+    units = [u for f in ok.values() for u in f.get("failed_units", [])]
+    if units:
+        summary["failed_units"] = _counts(units)
+    errs = sum(1 for f in ok.values() if f.get("recent_errors"))
+    summary["hosts_with_recent_errors"] = errs
+    return summary
+
+
+# -------------------------
+# Факты для LLM
+# -------------------------
+
+# время в начале строки journalctl (short-iso или syslog) и pid в "sshd[1234]:"
+_ERR_TIME = re.compile(r"^(?:\d{4}-\d\d-\d\dT\S+|[A-Z][a-z]{2} +\d+ [\d:]+)\s+")
+_ERR_PID = re.compile(r"\[\d+\]")
+
+
+def _bucket(value: Any, step: int) -> Any:
+    return int(value // step * step) if isinstance(value, (int, float)) else value
+
+
+def for_llm(facts: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Факты для промпта. Uptime, load, свободная память и время в строках журнала
+    меняются от прогона к прогону; с точными значениями одинаковые проверки
+    не попадают в кэш LLM, поэтому здесь они огрублены. Точные — в отчёте.
+    """
+    out = dict(facts or {})
+    if "uptime_h" in out:
+        out["uptime_days"] = int(out.pop("uptime_h") // 24)
+    if out.get("load"):
+        try:
+            out["load"] = [round(float(x)) for x in out["load"]]
+        except ValueError:
+            out.pop("load")
+    if isinstance(out.get("mem"), dict):
+        out["mem"] = {
+            k: _bucket(v, 256) if k in ("available_mb", "swap_free_mb") else v
+            for k, v in out["mem"].items()
+        }
+    if out.get("disks"):
+        out["disks"] = [{**d, "avail_gb": _bucket(d.get("avail_gb"), 1)} for d in out["disks"]]
+    if out.get("recent_errors"):
+        errs = [_ERR_PID.sub("", _ERR_TIME.sub("", ln)) for ln in out["recent_errors"]]
+        out["recent_errors"] = list(dict.fromkeys(errs))
+    if isinstance(out.get("lowest_mem_available_mb"), dict):
+        out["lowest_mem_available_mb"] = {
+            h: _bucket(v, 256) for h, v in out["lowest_mem_available_mb"].items()
+        }
+    return out
+
+
+def bundle(
+    host: str,
+    user: str,
+    key_path: Optional[str],
+    password: Optional[str],
+    hosts: Optional[List[str]] = None,
+    concurrency: int = FLEET_CONCURRENCY,
+) -> Dict[str, Any]:
+    """Факты для промпта: хост целиком или сводка по флоту."""
+    if hosts:
+        return summarize_fleet(collect_fleet(hosts, user, key_path, password, concurrency))
+    return collect(host, user, key_path, password)
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    p = argparse.ArgumentParser(description="Bootstrap-проба хоста")
+    p.add_argument("--hash", action="store_true", help="sha256 PROBE для policy.json")
+    p.add_argument("--host")
+    p.add_argument("--user")
+    p.add_argument("--key", default=None)
+    p.add_argument("--password", default=None)
+    args = p.parse_args()
+    if args.hash or not args.host:
+        print(PROBE_SHA256)
+    else:
+        print(json.dumps(collect(args.host, args.user, args.key, args.password), indent=2))
@@ -0,0 +1,394 @@
+"""
+Сохранение прогонов между запусками: SQLite-checkpointer для LangGraph
+и таблица с параметрами прогонов (для --resume).
+
+Каждый шаг графа пишется в checkpoints (состояние сериализует serde
+LangGraph — msgpack через ormsgpack), промежуточные записи узлов — в
+writes. После 429 или падения процесса прогон продолжается тем же
+thread_id: граф доигрывает с узла, на котором остановился, уже
+выполненные шаги не повторяются.
+
+Для продолжения нужен только последний чекпойнт, поэтому после каждого put
+у thread_id остаются CHECKPOINT_KEEP последних (AGENT_CHECKPOINT_KEEP,
+по умолчанию 3; 0 — хранить все) вместе с их writes.
+
+Пароли в базу не попадают: их передают заново при --resume.
+"""
+
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Dict, Iterator, Optional, Sequence, Tuple
+
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import (
+    WRITES_IDX_MAP,
+    BaseCheckpointSaver,
+    ChannelVersions,
+    Checkpoint,
+    CheckpointMetadata,
+    CheckpointTuple,
+    get_checkpoint_id,
+    get_serializable_checkpoint_metadata,
+)
+
+DB_PATH = Path(
+    os.environ.get(
+        "AGENT_RUNS_DB",
+        Path(os.environ.get("AGENT_CACHE_DIR", ".agent_cache")) / "runs.sqlite",
+    )
+)
+ENABLED = os.environ.get("AGENT_CHECKPOINTS", "1") != "0"
+CHECKPOINT_KEEP = int(os.environ.get("AGENT_CHECKPOINT_KEEP", "3"))
+
+# ключи configurable, которые LangGraph иначе скопировал бы в метаданные чекпойнта
+SECRET_CONFIG_KEYS = {"ssh_password"}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS checkpoints (
+    thread_id TEXT NOT NULL,
+    checkpoint_ns TEXT NOT NULL DEFAULT '',
+    checkpoint_id TEXT NOT NULL,
+    parent_checkpoint_id TEXT,
+    type TEXT,
+    checkpoint BLOB,
+    metadata_type TEXT,
+    metadata BLOB,
+    PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id)
+);
+CREATE TABLE IF NOT EXISTS writes (
+    thread_id TEXT NOT NULL,
+    checkpoint_ns TEXT NOT NULL DEFAULT '',
+    checkpoint_id TEXT NOT NULL,
+    task_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    channel TEXT NOT NULL,
+    type TEXT,
+    value BLOB,
+    task_path TEXT NOT NULL DEFAULT '',
+    PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id, task_id, idx)
+);
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY,
+    agent TEXT NOT NULL,
+    params TEXT NOT NULL,
+    status TEXT NOT NULL,
+    error TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+"""
+
+
+def _connect(path: Path) -> sqlite3.Connection:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # граф пишет промежуточные записи из фоновых потоков — соединение общее под локом
+    conn = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(_SCHEMA)
+    return conn
+
+
+class SqliteCheckpointer(BaseCheckpointSaver[str]):
+    def __init__(self, path: Path = DB_PATH, *, serde=None, keep: int = CHECKPOINT_KEEP):
+        super().__init__(serde=serde)
+        self.path = Path(path)
+        self.keep = keep
+        self.conn = _connect(self.path)
+        self.lock = threading.Lock()
+
+    # ---- чтение ----
+
+    def _tuple(self, thread_id: str, ns: str, row: Tuple[Any, ...]) -> CheckpointTuple:
+        checkpoint_id, parent_id, typ, blob, mtyp, mblob = row
+        with self.lock:
+            writes = self.conn.execute(
+                "SELECT task_id, channel, type, value FROM writes "
+                "WHERE thread_id=? AND checkpoint_ns=? AND checkpoint_id=? "
+                "ORDER BY task_id, idx",
+                (thread_id, ns, checkpoint_id),
+            ).fetchall()
+
+        def cfg(cid: str) -> RunnableConfig:
+            return {
+                "configurable": {
+                    "thread_id": thread_id,
+                    "checkpoint_ns": ns,
+                    "checkpoint_id": cid,
+                }
+            }
+
+        return CheckpointTuple(
+            config=cfg(checkpoint_id),
+            checkpoint=self.serde.loads_typed((typ, blob)),
+            metadata=self.serde.loads_typed((mtyp, mblob)),
+            parent_config=cfg(parent_id) if parent_id else None,
+            pending_writes=[
+                (task_id, channel, self.serde.loads_typed((t, v)))
+                for task_id, channel, t, v in writes
+            ],
+        )
+
+    def get_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        thread_id = config["configurable"]["thread_id"]
+        ns = config["configurable"].get("checkpoint_ns", "")
+        cols = "checkpoint_id, parent_checkpoint_id, type, checkpoint, metadata_type, metadata"
+        with self.lock:
+            if checkpoint_id := get_checkpoint_id(config):
+                row = self.conn.execute(
+                    f"SELECT {cols} FROM checkpoints "
+                    "WHERE thread_id=? AND checkpoint_ns=? AND checkpoint_id=?",
+                    (thread_id, ns, checkpoint_id),
+                ).fetchone()
+            else:
+                row = self.conn.execute(
+                    f"SELECT {cols} FROM checkpoints WHERE thread_id=? AND checkpoint_ns=? "
+                    "ORDER BY checkpoint_id DESC LIMIT 1",
+                    (thread_id, ns),
+                ).fetchone()
+        return self._tuple(thread_id, ns, row) if row else None
+
+    def list(
+        self,
+        config: Optional[RunnableConfig],
+        *,
+        filter: Optional[Dict[str, Any]] = None,
+        before: Optional[RunnableConfig] = None,
+        limit: Optional[int] = None,
+    ) -> Iterator[CheckpointTuple]:
+        where, args = [], []
+        if config:
+            where.append("thread_id=?")
+            args.append(config["configurable"]["thread_id"])
+            if (ns := config["configurable"].get("checkpoint_ns")) is not None:
+                where.append("checkpoint_ns=?")
+                args.append(ns)
+            if checkpoint_id := get_checkpoint_id(config):
+                where.append("checkpoint_id=?")
+                args.append(checkpoint_id)
+        if before and (before_id := get_checkpoint_id(before)):
+            where.append("checkpoint_id<?")
+            args.append(before_id)
+        sql = (
+            "SELECT thread_id, checkpoint_ns, checkpoint_id, parent_checkpoint_id, "
+            "type, checkpoint, metadata_type, metadata FROM checkpoints"
+        )
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY checkpoint_id DESC"
+        with self.lock:
+            rows = self.conn.execute(sql, args).fetchall()
+
+        for thread_id, ns, *row in rows:
+            if limit is not None and limit <= 0:
+                break
+            tup = self._tuple(thread_id, ns, tuple(row))
+            if filter and not all(tup.metadata.get(k) == v for k, v in filter.items()):
+                continue
+            if limit is not None:
+                limit -= 1
+            yield tup
+
+    # ---- запись ----
+
+    def put(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        thread_id = config["configurable"]["thread_id"]
+        ns = config["configurable"].get("checkpoint_ns", "")
+        typ, blob = self.serde.dumps_typed(checkpoint)
+        meta = get_serializable_checkpoint_metadata(config, metadata)
+        for k in SECRET_CONFIG_KEYS:
+            meta.pop(k, None)
+        mtyp, mblob = self.serde.dumps_typed(meta)
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    thread_id,
+                    ns,
+                    checkpoint["id"],
+                    config["configurable"].get("checkpoint_id"),
+                    typ,
+                    blob,
+                    mtyp,
+                    mblob,
+                ),
+            )
+            if self.keep > 0:
+                self._prune(thread_id, ns)
+        return {
+            "configurable": {
+                "thread_id": thread_id,
+                "checkpoint_ns": ns,
+                "checkpoint_id": checkpoint["id"],
+            }
+        }
+
+    def put_writes(
+        self,
+        config: RunnableConfig,
+        writes: Sequence[Tuple[str, Any]],
+        task_id: str,
+        task_path: str = "",
+    ) -> None:
+        thread_id = config["configurable"]["thread_id"]
+        ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoint_id = config["configurable"]["checkpoint_id"]
+        rows = []
+        for idx, (channel, value) in enumerate(writes):
+            typ, blob = self.serde.dumps_typed(value)
+            rows.append(
+                (
+                    thread_id,
+                    ns,
+                    checkpoint_id,
+                    task_id,
+                    WRITES_IDX_MAP.get(channel, idx),
+                    channel,
+                    typ,
+                    blob,
+                    task_path,
+                )
+            )
+        # служебные записи (ошибки, прерывания; idx < 0) перезаписываются, обычные — нет
+        with self.lock:
+            for verb, part in (
+                ("REPLACE", [r for r in rows if r[4] < 0]),
+                ("IGNORE", [r for r in rows if r[4] >= 0]),
+            ):
+                if part:
+                    self.conn.executemany(
+                        f"INSERT OR {verb} INTO writes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        part,
+                    )
+
+    def _prune(self, thread_id: str, ns: str) -> None:
+        """Старше keep последних чекпойнтов потока — удалить вместе с writes (под lock)."""
+        row = self.conn.execute(
+            "SELECT checkpoint_id FROM checkpoints WHERE thread_id=? AND checkpoint_ns=? "
+            "ORDER BY checkpoint_id DESC LIMIT 1 OFFSET ?",
+            (thread_id, ns, self.keep - 1),
+        ).fetchone()
+        if row is None:
+            return
+        for table in ("checkpoints", "writes"):
+            self.conn.execute(
+                f"DELETE FROM {table} WHERE thread_id=? AND checkpoint_ns=? AND checkpoint_id<?",
+                (thread_id, ns, row[0]),
+            )
+
+    def delete_thread(self, thread_id: str) -> None:
+        with self.lock:
+            self.conn.execute("DELETE FROM checkpoints WHERE thread_id=?", (thread_id,))
+            self.conn.execute("DELETE FROM writes WHERE thread_id=?", (thread_id,))
+
+    def get_next_version(self, current: Optional[str], channel: None) -> str:
+        if current is None:
+            current_v = 0
+        elif isinstance(current, int):
+            current_v = current
+        else:
+            current_v = int(current.split(".")[0])
+        return f"{current_v + 1:032}.{random.random():016}"
+
+    # async-варианты — те же синхронные вызовы: sqlite локальный и быстрый
+
+    async def aget_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        return self.get_tuple(config)
+
+    async def alist(self, config, *, filter=None, before=None, limit=None):
+        for tup in self.list(config, filter=filter, before=before, limit=limit):
+            yield tup
+
+    async def aput(self, config, checkpoint, metadata, new_versions) -> RunnableConfig:
+        return self.put(config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(self, config, writes, task_id, task_path: str = "") -> None:
+        self.put_writes(config, writes, task_id, task_path)
+
+    async def adelete_thread(self, thread_id: str) -> None:
+        self.delete_thread(thread_id)
+
+
+# -------------------------
+# Runs (параметры для --resume)
+# -------------------------
+
+
+class RunStore:
+    def __init__(self, path: Path = DB_PATH):
+        self.conn = _connect(Path(path))
+        self.lock = threading.Lock()
+
+    def create(self, agent: str, params: Dict[str, Any]) -> str:
+        run_id = time.strftime("%Y%m%d-%H%M%S-") + uuid.uuid4().hex[:6]
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO runs VALUES (?, ?, ?, 'running', NULL, ?, ?)",
+                (run_id, agent, json.dumps(params, ensure_ascii=False), now, now),
+            )
+        return run_id
+
+    def get(self, run_id: str) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT run_id, agent, params, status, error, created, updated "
+                "FROM runs WHERE run_id=?",
+                (run_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        return {
+            "run_id": row[0],
+            "agent": row[1],
+            "params": json.loads(row[2]),
+            "status": row[3],
+            "error": row[4],
+            "created": row[5],
+            "updated": row[6],
+        }
+
+    def set_status(self, run_id: str, status: str, error: Optional[str] = None) -> None:
+        with self.lock:
+            self.conn.execute(
+                "UPDATE runs SET status=?, error=?, updated=? WHERE run_id=?",
+                (status, error, time.time(), run_id),
+            )
+
+
+_SAVER: Optional[SqliteCheckpointer] = None
+_RUNS: Optional[RunStore] = None
+_LOCK = threading.Lock()
+
+
+def get_checkpointer() -> Optional[SqliteCheckpointer]:
+    """Общий checkpointer процесса или None, если AGENT_CHECKPOINTS=0."""
+    global _SAVER
+    if not ENABLED:
+        return None
+    with _LOCK:
+        if _SAVER is None:
+            _SAVER = SqliteCheckpointer()
+        return _SAVER
+
+
+def get_run_store() -> Optional[RunStore]:
+    global _RUNS
+    if not ENABLED:
+        return None
+    with _LOCK:
+        if _RUNS is None:
+            _RUNS = RunStore()
+        return _RUNS
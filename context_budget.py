@@ -0,0 +1,202 @@
+"""
+Сжатие контекста LLM под бюджет токенов.
+
+Планировщик agent.py: последние шаги идут как есть, более старые — короткой
+сводкой (команда, код выхода, ключевые строки). История react-агента
+agent_tc: перед каждым вызовом модели старые результаты run_remote
+заменяются сводками, пока история не уложится в бюджет. Пары tool_call /
+ToolMessage не трогаем — меняем только текст результатов.
+
+Токены считаем грубо (байты UTF-8 / 4): точный токенайзер модели через
+OpenRouter нам неизвестен, а для бюджета важен порядок величины.
+"""
+
+import json
+import os
+import re
+import threading
+from typing import Any, Dict, List, Optional
+
+from langchain_core.messages import BaseMessage, ToolMessage
+
+PLANNER_BUDGET = int(os.environ.get("AGENT_CONTEXT_TOKENS", "6000"))
+HISTORY_BUDGET = int(os.environ.get("AGENT_HISTORY_TOKENS", "12000"))
+KEEP_RECENT = int(os.environ.get("AGENT_CONTEXT_KEEP_RECENT", "3"))
+
+KEY_LINE = re.compile(
+    r"error|fail|fatal|critical|denied|warn|oom|killed|panic|not found|no space|refused|timeout|"
+    r"ошибк|не найден",
+    re.IGNORECASE,
+)
+MAX_KEY_LINES = 5
+
+
+def estimate_tokens(obj: Any) -> int:
+    text = obj if isinstance(obj, str) else json.dumps(obj, ensure_ascii=False)
+    return len(text.encode("utf-8")) // 4 + 1
+
+
+def key_lines(text: str, limit: int = MAX_KEY_LINES) -> List[str]:
+    lines = [ln.strip() for ln in (text or "").splitlines() if ln.strip()]
+    hits = [ln[:200] for ln in lines if KEY_LINE.search(ln)]
+    if not hits:
+        hits = [ln[:200] for ln in lines[-2:]]  # нечего выделить — хвост вывода
+    return hits[:limit]
+
+
+def summarize_step(step: Dict[str, Any]) -> Dict[str, Any]:
+    out: Dict[str, Any] = {
+        "cmd": step.get("cmd"),
+        "exit_code": step.get("exit_code"),
+        "ok": step.get("ok"),
+        "summarized": True,
+    }
+    if step.get("error"):
+        out["error"] = step["error"]
+    if step.get("groups"):
+        out["groups"] = [
+            {"hosts": g.get("hosts"), "exit_code": g.get("exit_code")}
+            for g in step["groups"]
+        ]
+        return out
+    text = (step.get("stdout") or "") + "\n" + (step.get("stderr") or "")
+    out["key_lines"] = key_lines(text)
+    out["output_lines"] = text.count("\n")
+    return out
+
+
+def _shrink(step: Dict[str, Any], limit: int) -> Dict[str, Any]:
+    s = dict(step)
+    for k in ("stdout", "stderr"):
+        v = s.get(k) or ""
+        if len(v) > limit:
+            half = limit // 2
+            s[k] = v[:half] + f"\n[... {len(v) - limit} chars cut ...]\n" + v[-half:]
+    return s
+
+
+def compact_steps(
+    steps: List[Dict[str, Any]],
+    budget: int = PLANNER_BUDGET,
+    keep_recent: int = KEEP_RECENT,
+) -> List[Dict[str, Any]]:
+    """Последние keep_recent шагов как есть, остальные — сводки; всё в пределах budget."""
+    recent = steps[-keep_recent:] if keep_recent else []
+    older = [summarize_step(s) for s in steps[: len(steps) - len(recent)]]
+
+    # свежие шаги важнее: урезаем их вывод, пока не влезут хотя бы в бюджет
+    limit = 8000
+    while recent and estimate_tokens(recent) > budget and limit > 200:
+        recent = [_shrink(s, limit) for s in recent]
+        limit //= 2
+
+    used = estimate_tokens(recent)
+    kept: List[Dict[str, Any]] = []
+    for s in reversed(older):
+        cost = estimate_tokens(s)
+        if used + cost > budget:
+            break
+        kept.append(s)
+        used += cost
+    dropped = len(older) - len(kept)
+    kept.reverse()
+    if dropped:
+        kept.insert(0, {"omitted_steps": dropped})
+    return kept + recent
+
+
+def summarize_text(text: str, head_lines: int = 3) -> str:
+    lines = (text or "").splitlines()
+    if len(lines) <= head_lines + MAX_KEY_LINES:
+        return text
+    head = lines[:head_lines]
+    keys = [ln for ln in key_lines("\n".join(lines[head_lines:])) if ln not in head]
+    return "\n".join(
+        head + keys + [f"[compacted: {len(lines)} lines -> summary]"]
+    )
+
+
+def empty_usage() -> Dict[str, int]:
+    return {
+        "llm_calls": 0,
+        "est_prompt_tokens_full": 0,
+        "est_prompt_tokens_sent": 0,
+        "input_tokens": 0,
+        "output_tokens": 0,
+    }
+
+
+def count_call(
+    usage: Dict[str, int], full: int, sent: int, message: Optional[BaseMessage] = None
+) -> Dict[str, int]:
+    """Добавляет один вызов модели: оценки до/после сжатия и usage_metadata ответа."""
+    usage["llm_calls"] += 1
+    usage["est_prompt_tokens_full"] += full
+    usage["est_prompt_tokens_sent"] += sent
+    meta = getattr(message, "usage_metadata", None) or {}
+    usage["input_tokens"] += meta.get("input_tokens", 0)
+    usage["output_tokens"] += meta.get("output_tokens", 0)
+    return usage
+
+
+def usage_line(usage: Dict[str, int]) -> str:
+    saved = usage["est_prompt_tokens_full"] - usage["est_prompt_tokens_sent"]
+    return (
+        f"{usage['llm_calls']} calls, ~{usage['est_prompt_tokens_sent']} prompt tokens "
+        f"sent (~{saved} saved by compaction), "
+        f"provider usage: {usage['input_tokens']} in / {usage['output_tokens']} out"
+    )
+
+
+class TokenMeter:
+    """Счётчик токенов за прогон react-агента (hook вызывается из потоков графа)."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.usage = empty_usage()
+
+    def add_estimate(self, full: int, sent: int) -> None:
+        with self._lock:
+            count_call(self.usage, full, sent)
+
+    def add_usage(self, messages: List[BaseMessage]) -> None:
+        # фактический usage приходит в AIMessage, оценки уже посчитаны в hook
+        with self._lock:
+            for m in messages:
+                meta = getattr(m, "usage_metadata", None) or {}
+                self.usage["input_tokens"] += meta.get("input_tokens", 0)
+                self.usage["output_tokens"] += meta.get("output_tokens", 0)
+
+    def as_dict(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.usage)
+
+
+def make_history_trimmer(
+    budget: int = HISTORY_BUDGET,
+    keep_recent: int = KEEP_RECENT,
+    meter: Optional[TokenMeter] = None,
+):
+    """pre_model_hook для create_react_agent: сжимает старые ToolMessage."""
+
+    def trim(state: Dict[str, Any]) -> Dict[str, Any]:
+        messages: List[BaseMessage] = list(state["messages"])
+        full = sum(estimate_tokens(str(m.content)) for m in messages)
+        total = full
+
+        tool_idx = [i for i, m in enumerate(messages) if isinstance(m, ToolMessage)]
+        for i in tool_idx[: max(0, len(tool_idx) - keep_recent)]:
+            if total <= budget:
+                break
+            m = messages[i]
+            short = summarize_text(str(m.content))
+            if short == m.content:
+                continue
+            total -= estimate_tokens(str(m.content)) - estimate_tokens(short)
+            messages[i] = m.model_copy(update={"content": short})
+
+        if meter is not None:
+            meter.add_estimate(full, total)
+        return {"llm_input_messages": messages}
+
+    return trim
@@ -0,0 +1,153 @@
+"""
+Дисковый кэш результатов read-only команд по хостам.
+
+У каждой кэшируемой команды свой TTL (os-release живёт днями, free — секунды).
+Команда класса "change" сбрасывает связанные записи хоста: после apt-get
+install не имеет смысла верить старому dpkg -l или df -h.
+"""
+
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from policy import normalize_command
+
+CACHE_DIR = Path(os.environ.get("AGENT_CACHE_DIR", ".agent_cache"))
+ENABLED = os.environ.get("AGENT_FACTS_CACHE", "1") != "0"
+
+MINUTE = 60
+HOUR = 60 * MINUTE
+DAY = 24 * HOUR
+
+# (префикс команды, TTL в секундах); первый совпавший выигрывает.
+# Команд, которых здесь нет, кэш не касается (date, tail, ping и т.п.).
+TTL_RULES: List[Tuple[str, float]] = [
+    ("cat /etc/os-release", 7 * DAY),
+    ("uname", DAY),
+    ("id", DAY),
+    ("whoami", DAY),
+    ("ip a", 5 * MINUTE),
+    ("ip r", 5 * MINUTE),
+    ("dpkg -l", HOUR),
+    ("df", MINUTE),
+    ("du ", MINUTE),
+    ("systemctl --failed", 30),
+    ("systemctl status", 15),
+    ("journalctl", 30),
+    ("ss ", 15),
+    ("free", 10),
+    ("uptime", 5),
+    ("ps", 5),
+    ("top -b -n1", 5),
+]
+
+_PKG = ["dpkg", "rpm", "apt", "df", "du ", "systemctl", "ps", "ss ", "ls ", "stat "]
+_SVC = ["systemctl", "journalctl", "ps", "ss ", "free", "top -b -n1"]
+
+# (префикс change-команды, какие префиксы кэша она сбрасывает)
+INVALIDATION_RULES: List[Tuple[str, List[str]]] = [
+    ("apt-get upgrade", _PKG + ["cat /etc/os-release"]),
+    ("dnf update", _PKG + ["cat /etc/os-release"]),
+    ("yum update", _PKG + ["cat /etc/os-release"]),
+    ("apt-get update", ["apt"]),
+    ("apt-get", _PKG),
+    ("dnf", _PKG),
+    ("yum", _PKG),
+    ("systemctl", _SVC),
+]
+
+
+def ttl_for(cmd: str) -> Optional[float]:
+    c = normalize_command(cmd)
+    for prefix, ttl in TTL_RULES:
+        if c.startswith(prefix):
+            return ttl
+    return None
+
+
+def _invalidated_prefixes(change_cmd: str) -> Optional[List[str]]:
+    c = normalize_command(change_cmd)
+    for prefix, targets in INVALIDATION_RULES:
+        if c.startswith(prefix):
+            return targets
+    return None  # неизвестное изменение — сбрасываем всё
+
+
+class FactsCache:
+    def __init__(self, root: Path = CACHE_DIR / "facts"):
+        self.root = root
+        self._lock = threading.Lock()
+
+    def _path(self, host: str) -> Path:
+        # файл на хост, внутри — записи по пользователям (id/whoami у всех разные)
+        safe = re.sub(r"[^A-Za-z0-9._-]", "_", host)
+        digest = hashlib.sha1(host.encode()).hexdigest()[:8]
+        return self.root / f"{safe}_{digest}.json"
+
+    def _load(self, path: Path) -> Dict[str, Any]:
+        try:
+            return json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, path: Path, data: Dict[str, Any]) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp.write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, path)
+
+    def get(self, host: str, user: str, cmd: str) -> Optional[Dict[str, Any]]:
+        """Свежая запись {'result', 'stored_at', 'age_s'} или None."""
+        ttl = ttl_for(cmd)
+        if ttl is None:
+            return None
+        with self._lock:
+            data = self._load(self._path(host))
+        entry = data.get(user, {}).get(normalize_command(cmd))
+        if not entry:
+            return None
+        age = time.time() - entry["stored_at"]
+        if age > ttl:
+            return None
+        return {**entry, "age_s": round(age, 1)}
+
+    def put(self, host: str, user: str, cmd: str, result: Dict[str, Any]) -> None:
+        if ttl_for(cmd) is None or not result.get("ok"):
+            return
+        keep = ("exit_code", "stdout", "stderr")
+        with self._lock:
+            path = self._path(host)
+            data = self._load(path)
+            data.setdefault(user, {})[normalize_command(cmd)] = {
+                "stored_at": time.time(),
+                "result": {k: result.get(k) for k in keep},
+            }
+            self._save(path, data)
+
+    def invalidate(self, host: str, change_cmd: str) -> int:
+        """Сбрасывает записи хоста (всех пользователей), на которые могла повлиять change-команда."""
+        targets = _invalidated_prefixes(change_cmd)
+        dropped = 0
+        with self._lock:
+            path = self._path(host)
+            data = self._load(path)
+            for entries in data.values():
+                drop = [
+                    k
+                    for k in entries
+                    if targets is None or any(k.startswith(t) for t in targets)
+                ]
+                for k in drop:
+                    del entries[k]
+                dropped += len(drop)
+            if dropped:
+                self._save(path, data)
+        return dropped
+
+
+FACTS = FactsCache()
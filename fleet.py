@@ -0,0 +1,121 @@
+"""
+Fleet-режим: одна цель на N хостов.
+
+Команду, выбранную планировщиком, выполняем на всех хостах параллельно
+(с ограничением concurrency), а одинаковые результаты схлопываем в группы:
+планировщик видит один представительный вывод и "same on N hosts"
+вместо N копий.
+"""
+
+import contextvars
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+
+FLEET_CONCURRENCY = 16
+# сколько имён хостов показываем модели в группе, остальное — счётчиком
+HOSTS_SHOWN = 5
+
+
+def load_inventory(path: str) -> List[str]:
+    """
+    Файл инвентаря: один хост (host или host:port) на строку,
+    пустые строки и комментарии (#) игнорируются, дубли убираются.
+    """
+    hosts: List[str] = []
+    seen = set()
+    for raw in Path(path).read_text(encoding="utf-8").splitlines():
+        line = raw.split("#", 1)[0].strip()
+        if not line or line in seen:
+            continue
+        seen.add(line)
+        hosts.append(line)
+    if not hosts:
+        raise ValueError(f"Inventory {path} has no hosts")
+    return hosts
+
+
+def run_on_fleet(
+    hosts: List[str],
+    fn: Callable[[str], Dict[str, Any]],
+    concurrency: int = FLEET_CONCURRENCY,
+) -> List[Dict[str, Any]]:
+    """fn(host) -> result; исключения превращаем в результат с error."""
+
+    def one(host: str) -> Dict[str, Any]:
+        try:
+            res = fn(host)
+        except Exception as e:
+            res = {"ok": False, "exit_code": None, "error": f"{type(e).__name__}: {e}"}
+        return {**res, "host": host}
+
+    with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(hosts)))) as ex:
+        # контекст (run_id журнала) — в каждый поток своя копия
+        futures = [ex.submit(contextvars.copy_context().run, one, h) for h in hosts]
+        return [f.result() for f in futures]
+
+
+def _result_key(r: Dict[str, Any]) -> str:
+    h = hashlib.sha256()
+    for part in (
+        str(r.get("exit_code")),
+        (r.get("stdout") or "").strip(),
+        (r.get("stderr") or "").strip(),
+        str(r.get("error") or ""),
+    ):
+        h.update(part.encode("utf-8", errors="replace"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def group_results(results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Группы одинаковых результатов, крупные — первыми.
+    Каждая группа: представительный результат + список хостов.
+    """
+    groups: Dict[str, Dict[str, Any]] = {}
+    for r in results:
+        k = _result_key(r)
+        g = groups.get(k)
+        if g is None:
+            g = {
+                "hosts": [],
+                "ok": r.get("ok", False),
+                "exit_code": r.get("exit_code"),
+                "stdout": r.get("stdout", ""),
+                "stderr": r.get("stderr", ""),
+            }
+            if r.get("error"):
+                g["error"] = r["error"]
+            if r.get("parsed") is not None:
+                g["parsed"] = r["parsed"]
+            groups[k] = g
+        g["hosts"].append(r["host"])
+    return sorted(groups.values(), key=lambda g: -len(g["hosts"]))
+
+
+def hosts_label(hosts: List[str]) -> str:
+    shown = ", ".join(hosts[:HOSTS_SHOWN])
+    if len(hosts) > HOSTS_SHOWN:
+        shown += f", ... (+{len(hosts) - HOSTS_SHOWN})"
+    return f"same on {len(hosts)} hosts: {shown}"
+
+
+def compact_groups(
+    groups: List[Dict[str, Any]], stdout_limit: int = 4000, stderr_limit: int = 1200
+) -> List[Dict[str, Any]]:
+    """Представление групп для контекста LLM."""
+    out = []
+    for g in groups:
+        item: Dict[str, Any] = {"hosts": hosts_label(g["hosts"]), "exit_code": g.get("exit_code")}
+        # без stdout группа приходит, когда вместо него разобранная запись (parsers.for_llm)
+        if "stdout" in g:
+            item["stdout"] = (g.get("stdout") or "")[:stdout_limit]
+        if g.get("parsed") is not None:
+            item["parsed"] = g["parsed"]
+        item["stderr"] = (g.get("stderr") or "")[:stderr_limit]
+        if g.get("error"):
+            item["error"] = g["error"]
+        out.append(item)
+    return out
@@ -0,0 +1,597 @@
+"""
+История прогонов: все отчёты из reports/ в одной SQLite-базе с FTS5.
+
+    runs       — прогон: цель, хост, модель, время, статус, финальное сообщение
+    steps      — шаг: команда, хосты (fleet-группа), код выхода, stdout/stderr
+    runs_fts   — полнотекст по цели, хосту и итогу
+    steps_fts  — полнотекст по команде, хостам и выводу
+
+Импорт инкрементальный: отчёт перечитывается, только если изменились его
+mtime или размер. Шаги берутся из JSONL-сайдкара (report_stream), полные
+выводы — из вынесенных файлов. У старых отчётов сайдкара нет, для них
+разбирается сам Markdown (backfill).
+
+    python history.py ingest [--dir reports]
+    python history.py search "oom killed" --host 10.0.0.5 --since 2026-02-01
+    python history.py runs --host 10.0.0.5 --status failed
+"""
+
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from facts_cache import CACHE_DIR
+from report_stream import REPORT_DIR
+from runlog import get_run_logger
+
+DB_PATH = Path(os.environ.get("AGENT_HISTORY_DB", CACHE_DIR / "history.sqlite"))
+ENABLED = os.environ.get("AGENT_HISTORY", "1") != "0"
+# сколько вывода одного потока индексировать (полный лежит в файлах отчёта)
+MAX_OUTPUT_CHARS = int(os.environ.get("AGENT_HISTORY_MAX_OUTPUT", str(256 * 1024)))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    report TEXT UNIQUE NOT NULL,
+    run_id TEXT,
+    agent TEXT,
+    goal TEXT,
+    host TEXT,
+    user TEXT,
+    model TEXT,
+    started REAL,
+    status TEXT,
+    n_steps INTEGER,
+    n_failed INTEGER,
+    final TEXT,
+    source TEXT,
+    mtime REAL,
+    size INTEGER
+);
+CREATE INDEX IF NOT EXISTS runs_host ON runs(host);
+CREATE INDEX IF NOT EXISTS runs_started ON runs(started);
+
+CREATE TABLE IF NOT EXISTS steps (
+    id INTEGER PRIMARY KEY,
+    run INTEGER NOT NULL REFERENCES runs(id) ON DELETE CASCADE,
+    idx INTEGER,
+    cmd TEXT,
+    hosts TEXT,
+    exit_code TEXT,
+    ok INTEGER,
+    ts REAL,
+    duration_s REAL,
+    stdout TEXT,
+    stderr TEXT
+);
+CREATE INDEX IF NOT EXISTS steps_run ON steps(run);
+
+-- все хосты прогона (во fleet-режиме их много): фильтр --host без скана шагов
+CREATE TABLE IF NOT EXISTS run_hosts (
+    run INTEGER NOT NULL REFERENCES runs(id) ON DELETE CASCADE,
+    host TEXT NOT NULL,
+    PRIMARY KEY (host, run)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS run_hosts_run ON run_hosts(run);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS runs_fts USING fts5(
+    goal, host, final, content='runs', content_rowid='id',
+    tokenize='unicode61 remove_diacritics 2'
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS steps_fts USING fts5(
+    cmd, hosts, stdout, stderr, content='steps', content_rowid='id',
+    tokenize='unicode61 remove_diacritics 2'
+);
+
+CREATE TRIGGER IF NOT EXISTS runs_ai AFTER INSERT ON runs BEGIN
+    INSERT INTO runs_fts(rowid, goal, host, final) VALUES (new.id, new.goal, new.host, new.final);
+END;
+CREATE TRIGGER IF NOT EXISTS runs_ad AFTER DELETE ON runs BEGIN
+    INSERT INTO runs_fts(runs_fts, rowid, goal, host, final)
+    VALUES ('delete', old.id, old.goal, old.host, old.final);
+END;
+CREATE TRIGGER IF NOT EXISTS steps_ai AFTER INSERT ON steps BEGIN
+    INSERT INTO steps_fts(rowid, cmd, hosts, stdout, stderr)
+    VALUES (new.id, new.cmd, new.hosts, new.stdout, new.stderr);
+END;
+CREATE TRIGGER IF NOT EXISTS steps_ad AFTER DELETE ON steps BEGIN
+    INSERT INTO steps_fts(steps_fts, rowid, cmd, hosts, stdout, stderr)
+    VALUES ('delete', old.id, old.cmd, old.hosts, old.stdout, old.stderr);
+END;
+"""
+
+_RUN_ID = re.compile(r"(\d{8}-\d{6}-[0-9a-f]{6})$")
+_TS_SUFFIX = re.compile(r"(\d{8})[_-](\d{6})")
+
+
+# -------------------------
+# Разбор отчёта
+# -------------------------
+
+
+def _header(lines: List[str]) -> Dict[str, Any]:
+    meta: Dict[str, Any] = {}
+    for line in lines:
+        if line.startswith("## "):
+            break
+        if line.startswith("# Отчёт: "):
+            meta["goal"] = line[len("# Отчёт: ") :].strip()
+        m = re.match(r"- (Goal|Host|User|Model): (.*)", line)
+        if m:
+            value = m.group(2).strip()
+            if m.group(1) == "Model":
+                value = " → ".join(re.findall(r"`([^`]*)`", value)) or value
+            else:
+                value = value.strip("`")
+            meta[m.group(1).lower()] = value
+    return meta
+
+
+def _sections(lines: List[str]) -> Iterator[Tuple[str, List[str]]]:
+    title, body = None, []
+    fence = False
+    for line in lines:
+        if line.startswith("```"):
+            fence = not fence
+        if line.startswith("## ") and not fence:
+            if title is not None:
+                yield title, body
+            title, body = line[3:].strip(), []
+        elif title is not None:
+            body.append(line)
+    if title is not None:
+        yield title, body
+
+
+def _blocks(body: List[str]) -> Iterator[Tuple[str, str]]:
+    """(заголовок перед блоком, текст) для каждого ``` блока раздела."""
+    label, buf, fence = "", [], False
+    for line in body:
+        if line.startswith("```"):
+            if fence:
+                yield label, "\n".join(buf)
+                buf = []
+            fence = not fence
+        elif fence:
+            buf.append(line)
+        elif line.strip():
+            label = line.strip()
+    if fence and buf:
+        yield label, "\n".join(buf)
+
+
+def _parse_md_step(title: str, body: List[str]) -> Dict[str, Any]:
+    """Шаг из Markdown: форматы agent.py, agent_tc и старых отчётов."""
+    step: Dict[str, Any] = {"stdout": "", "stderr": ""}
+    m = re.search(r"`(.*)`", title)
+    if m:
+        step["cmd"] = m.group(1)
+    text = "\n".join(body)
+    m = re.search(r"\*\*Command:\*\* `(.*)`", text)
+    if m:
+        step["cmd"] = m.group(1)
+    m = re.search(r"Exit: `([^`]*)`\s+OK: `(\w+)`", text)
+    if m:
+        step["exit_code"] = m.group(1)
+        step["ok"] = m.group(2) == "True"
+    m = re.search(r"Duration: `([\d.]+)s`", text)
+    if m:
+        step["duration_s"] = float(m.group(1))
+
+    # вывод: ``` блоки после "### STDOUT/STDERR", "STDERR:" или строки Hosts группы
+    groups: List[Dict[str, Any]] = []
+    target, stream, fence, buf = step, "stdout", False, []
+    group_exit = None
+    for line in body:
+        if line.startswith("```"):
+            if fence:
+                target[stream] = (target.get(stream, "") + "\n" + "\n".join(buf)).strip()
+                buf = []
+            fence = not fence
+        elif fence:
+            buf.append(line)
+        elif line.startswith("**Policy/Error"):
+            target, stream = step, "error"
+        elif line.startswith("### "):
+            m = re.search(r"Exit:? `([^`]*)`", line)
+            group_exit = m.group(1) if m else None
+            stream = "stderr" if "STDERR" in line else "stdout"
+        elif line.startswith("Hosts: "):
+            target = {"hosts": re.findall(r"`([^`]*)`", line), "stdout": "", "stderr": ""}
+            if group_exit is not None:
+                target["exit_code"] = group_exit
+            groups.append(target)
+            stream = "stdout"
+        elif line.startswith("STDERR:"):
+            stream = "stderr"
+    if groups:
+        step["groups"] = groups
+    return step
+
+
+def parse_markdown(text: str) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+    """(метаданные прогона, шаги) из Markdown-отчёта любого поколения."""
+    lines = text.splitlines()
+    meta = _header(lines)
+    steps = []
+    for title, body in _sections(lines):
+        if title.startswith("Step"):
+            steps.append(_parse_md_step(title, body))
+        elif title in ("Summary", "Final agent message"):
+            blocks = [b for label, b in _blocks(body) if "Final" in label or title != "Summary"]
+            if blocks:
+                meta["final"] = blocks[-1]
+    return meta, steps
+
+
+def _read_spilled(report: Path, item: Dict[str, Any], stream: str) -> str:
+    ref = item.get(f"{stream}_file")
+    text = item.get(stream) or ""
+    if ref:
+        try:
+            with open(report.parent / ref, encoding="utf-8", errors="replace") as f:
+                text = f.read(MAX_OUTPUT_CHARS)
+        except OSError:
+            pass
+    return text[:MAX_OUTPUT_CHARS]
+
+
+def _started(report: Path, run_id: Optional[str]) -> float:
+    m = _TS_SUFFIX.search(run_id or report.stem)
+    if m:
+        try:
+            return datetime.strptime("".join(m.groups()), "%Y%m%d%H%M%S").timestamp()
+        except ValueError:
+            pass
+    return report.stat().st_mtime
+
+
+# -------------------------
+# Хранилище
+# -------------------------
+
+
+class HistoryStore:
+    def __init__(self, path: Path = DB_PATH):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA foreign_keys=ON")
+        self._db.executescript(_SCHEMA)
+
+    # ---- импорт ----
+
+    def ingest_report(self, report: Path, force: bool = False) -> bool:
+        """Импортировать отчёт; False — не менялся с прошлого раза."""
+        report = Path(report)
+        st = report.stat()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT mtime, size FROM runs WHERE report = ?", (str(report),)
+            ).fetchone()
+        if row and not force and row["mtime"] == st.st_mtime and row["size"] == st.st_size:
+            return False
+
+        meta, md_steps = parse_markdown(report.read_text(encoding="utf-8", errors="replace"))
+        sidecar = report.with_suffix(".jsonl")
+        if sidecar.exists():
+            source = "sidecar"
+            steps = []
+            with open(sidecar, encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        steps.append(json.loads(line))
+        else:
+            source, steps = "markdown", md_steps
+
+        m = _RUN_ID.search(report.stem)
+        run_id = m.group(1) if m else None
+        status, agent = _run_status(run_id)
+        rows = list(_step_rows(report, meta.get("host"), steps))
+        run = {
+            "report": str(report),
+            "run_id": run_id,
+            "agent": agent,
+            "goal": meta.get("goal"),
+            "host": meta.get("host"),
+            "user": meta.get("user"),
+            "model": meta.get("model"),
+            "started": _started(report, run_id),
+            "status": status or _status_from_final(meta.get("final")),
+            "n_steps": len(steps),
+            "n_failed": sum(1 for r in rows if not r["ok"]),
+            "final": meta.get("final"),
+            "source": source,
+            "mtime": st.st_mtime,
+            "size": st.st_size,
+        }
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM runs WHERE report = ?", (str(report),))
+            cur = self._db.execute(
+                f"INSERT INTO runs ({', '.join(run)}) VALUES ({', '.join('?' * len(run))})",
+                list(run.values()),
+            )
+            self._db.executemany(
+                "INSERT INTO steps (run, idx, cmd, hosts, exit_code, ok, ts, duration_s, "
+                "stdout, stderr) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (cur.lastrowid, r["idx"], r["cmd"], r["hosts"], r["exit_code"], r["ok"],
+                     r["ts"], r["duration_s"], r["stdout"], r["stderr"])
+                    for r in rows
+                ],
+            )
+            hosts = {meta.get("host")} | {h for r in rows for h in r["hosts"].split()}
+            self._db.executemany(
+                "INSERT INTO run_hosts (run, host) VALUES (?, ?)",
+                [(cur.lastrowid, h) for h in hosts if h],
+            )
+        return True
+
+    def ingest_dir(self, root: Path = REPORT_DIR, force: bool = False) -> Dict[str, int]:
+        stats = {"seen": 0, "ingested": 0, "errors": 0}
+        for report in sorted(Path(root).glob("report_*.md")):
+            stats["seen"] += 1
+            try:
+                stats["ingested"] += self.ingest_report(report, force=force)
+            except (OSError, ValueError, sqlite3.Error) as e:
+                stats["errors"] += 1
+                get_run_logger().log(
+                    "history_ingest_error",
+                    {"path": str(report), "type": type(e).__name__, "error": str(e)},
+                )
+        return stats
+
+    # ---- запросы ----
+
+    def search(
+        self,
+        text: str,
+        host: Optional[str] = None,
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+        failed: Optional[bool] = None,
+        raw: bool = False,
+        limit: int = 50,
+    ) -> List[Dict[str, Any]]:
+        """Шаги, чьи команда/вывод совпали с text (FTS5), свежие прогоны первыми."""
+        where, args = ["steps_fts MATCH ?"], [text if raw else fts_query(text)]
+        where, args = _run_filters(where, args, host, since, until)
+        if failed is not None:
+            where.append("s.ok = ?")
+            args.append(0 if failed else 1)
+        sql = f"""
+            SELECT r.run_id, r.report, r.goal, r.host, r.started, r.status,
+                   s.idx, s.cmd, s.hosts, s.exit_code, s.ok,
+                   snippet(steps_fts, 2, '[', ']', ' … ', 12) AS stdout_hit,
+                   snippet(steps_fts, 3, '[', ']', ' … ', 12) AS stderr_hit
+            FROM steps_fts
+            JOIN steps s ON s.id = steps_fts.rowid
+            JOIN runs r ON r.id = s.run
+            WHERE {' AND '.join(where)}
+            ORDER BY r.started DESC, s.idx
+            LIMIT ?
+        """
+        with self._lock:
+            rows = self._db.execute(sql, args + [limit]).fetchall()
+        return [dict(r) for r in rows]
+
+    def runs(
+        self,
+        text: Optional[str] = None,
+        host: Optional[str] = None,
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+        status: Optional[str] = None,
+        limit: int = 50,
+    ) -> List[Dict[str, Any]]:
+        """Прогоны по фильтрам; text ищется в цели, хосте и итоговом сообщении."""
+        where: List[str] = []
+        args: List[Any] = []
+        join = ""
+        if text:
+            join = "JOIN runs_fts ON runs_fts.rowid = r.id"
+            where.append("runs_fts MATCH ?")
+            args.append(fts_query(text))
+        where, args = _run_filters(where, args, host, since, until)
+        if status:
+            where.append("r.status = ?")
+            args.append(status)
+        sql = f"""
+            SELECT r.run_id, r.report, r.agent, r.goal, r.host, r.model, r.started,
+                   r.status, r.n_steps, r.n_failed
+            FROM runs r {join}
+            {'WHERE ' + ' AND '.join(where) if where else ''}
+            ORDER BY r.started DESC
+            LIMIT ?
+        """
+        with self._lock:
+            rows = self._db.execute(sql, args + [limit]).fetchall()
+        return [dict(r) for r in rows]
+
+
+def fts_query(text: str) -> str:
+    """Слова пользователя -> префиксный FTS5-запрос: 'oom kill' -> "oom"* "kill"*."""
+    words = re.findall(r"\w+", text)
+    return " ".join(f'"{w}"*' for w in words) or '""'
+
+
+def _run_filters(
+    where: List[str],
+    args: List[Any],
+    host: Optional[str],
+    since: Optional[float],
+    until: Optional[float],
+) -> Tuple[List[str], List[Any]]:
+    if host:
+        where.append("r.id IN (SELECT run FROM run_hosts WHERE host = ?)")
+        args.append(host)
+    if since is not None:
+        where.append("r.started >= ?")
+        args.append(since)
+    if until is not None:
+        where.append("r.started <= ?")
+        args.append(until)
+    return where, args
+
+
+def _status_from_final(final: Optional[str]) -> Optional[str]:
+    # отчёты без записи в RunStore: статус по тексту финального сообщения
+    if final is None:
+        return None
+    if final.startswith("LLM rate limit hit"):
+        return "interrupted"
+    if final.startswith("LLM call failed"):
+        return "failed"
+    return "done"
+
+
+def _run_status(run_id: Optional[str]) -> Tuple[Optional[str], Optional[str]]:
+    if not run_id:
+        return None, None
+    from checkpoints import get_run_store  # тянет langgraph — только когда есть run_id
+
+    runs = get_run_store()
+    saved = runs.get(run_id) if runs is not None else None
+    return (saved["status"], saved["agent"]) if saved else (None, None)
+
+
+def _join(*parts: Optional[str]) -> str:
+    return "\n".join(p for p in parts if p)
+
+
+def _step_rows(
+    report: Path, host: Optional[str], steps: List[Dict[str, Any]]
+) -> Iterator[Dict[str, Any]]:
+    for i, s in enumerate(steps, 1):
+        base = {
+            "idx": i,
+            "cmd": s.get("cmd"),
+            "ts": s.get("ts"),
+            "duration_s": s.get("duration_s"),
+        }
+        if s.get("groups"):
+            # fleet: строка на группу одинаковых результатов
+            for g in s["groups"]:
+                yield {
+                    **base,
+                    "hosts": " ".join(g.get("hosts") or []),
+                    "exit_code": str(g.get("exit_code")),
+                    "ok": int(bool(g.get("ok", str(g.get("exit_code")) == "0"))),
+                    "stdout": _read_spilled(report, g, "stdout"),
+                    "stderr": _join(_read_spilled(report, g, "stderr"), g.get("error")),
+                }
+            continue
+        yield {
+            **base,
+            "hosts": host or "",
+            "exit_code": str(s.get("exit_code")),
+            "ok": int(bool(s.get("ok"))),
+            "stdout": _read_spilled(report, s, "stdout"),
+            "stderr": _join(_read_spilled(report, s, "stderr"), s.get("error")),
+        }
+
+
+_STORE: Optional[HistoryStore] = None
+_STORE_LOCK = threading.Lock()
+
+
+def get_history() -> Optional[HistoryStore]:
+    global _STORE
+    if not ENABLED:
+        return None
+    with _STORE_LOCK:
+        if _STORE is None:
+            _STORE = HistoryStore()
+        return _STORE
+
+
+def record_report(path: Path) -> None:
+    """Импорт отчёта сразу после прогона; сбой индекса не должен ронять агента."""
+    store = get_history()
+    if store is None:
+        return
+    try:
+        store.ingest_report(Path(path))
+    except (OSError, ValueError, sqlite3.Error) as e:
+        get_run_logger().log(
+            "history_ingest_error",
+            {"path": str(path), "type": type(e).__name__, "error": str(e)},
+        )
+
+
+def _parse_time(value: Optional[str]) -> Optional[float]:
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+def _fmt_ts(ts: Optional[float]) -> str:
+    return time.strftime("%Y-%m-%d %H:%M", time.localtime(ts)) if ts else "-"
+
+
+if __name__ == "__main__":
+    import argparse
+
+    p = argparse.ArgumentParser(description="История прогонов агента")
+    p.add_argument("--db", default=str(DB_PATH))
+    sub = p.add_subparsers(dest="cmd", required=True)
+    ing = sub.add_parser("ingest", help="импорт новых и изменённых отчётов")
+    ing.add_argument("--dir", default=str(REPORT_DIR))
+    ing.add_argument("--force", action="store_true", help="перечитать все отчёты")
+    for name in ("search", "runs"):
+        q = sub.add_parser(name)
+        q.add_argument("text", nargs="?" if name == "runs" else None)
+        q.add_argument("--host")
+        q.add_argument("--since", help="unix-время или ISO 8601 (локальное)")
+        q.add_argument("--until")
+        q.add_argument("--limit", type=int, default=50)
+        q.add_argument("--json", action="store_true")
+        if name == "search":
+            q.add_argument("--failed", action="store_true", help="только неуспешные шаги")
+            q.add_argument("--raw", action="store_true", help="text — готовый FTS5-запрос")
+        else:
+            q.add_argument("--status")
+    args = p.parse_args()
+    store = HistoryStore(Path(args.db))
+
+    if args.cmd == "ingest":
+        t0 = time.perf_counter()
+        stats = store.ingest_dir(Path(args.dir), force=args.force)
+        print(f"{stats} in {time.perf_counter() - t0:.2f}s")
+        raise SystemExit(0)
+
+    common = dict(
+        host=args.host,
+        since=_parse_time(args.since),
+        until=_parse_time(args.until),
+        limit=args.limit,
+    )
+    if args.cmd == "search":
+        rows = store.search(args.text, failed=True if args.failed else None, raw=args.raw, **common)
+    else:
+        rows = store.runs(args.text, status=args.status, **common)
+
+    for r in rows:
+        if args.json:
+            print(json.dumps(r, ensure_ascii=False))
+        elif args.cmd == "search":
+            print(f"{_fmt_ts(r['started'])} {r['run_id'] or r['report']} step {r['idx']} "
+                  f"[{r['hosts']}] exit={r['exit_code']} $ {r['cmd']}")
+            for hit in (r["stdout_hit"], r["stderr_hit"]):
+                if hit and "[" in hit:
+                    print(f"    {hit}")
+        else:
+            print(f"{_fmt_ts(r['started'])} {r['run_id'] or '-':24} {r['status'] or '-':11} "
+                  f"{r['n_steps']:>3} steps {r['n_failed']:>3} failed  {r['host']}  {r['goal']}")
@@ -0,0 +1,325 @@
+"""
+Фоновые задачи для долгих change-команд.
+
+apt-get upgrade / install держали SSH-канал и весь прогон до 600 с. Если
+соединение рвалось, команда умирала вместе с каналом. Теперь такие команды
+запускаются на хосте отвязанными (setsid nohup). Вывод пишется в файлы в
+~/.cache/agent-jobs/<id>/, код выхода — в rc. Агент получает описание
+задачи (dict) и опрашивает её короткими сессиями. Каждый опрос возвращает
+rc, признак жизни процесса и новый кусок out/err с запомненного смещения
+(base64, чтобы смещение считалось в байтах). Каждый опрос открывает новую
+сессию из пула, поэтому обрыв SSH задаче не мешает: пул переподключится на
+следующем опросе.
+
+Прочитанный вывод копится локально в CACHE_DIR/jobs/<id>.out/.err; там же
+<id>.json с описанием задачи — по нему agent_tc находит задачу после
+--resume. Политику проходит исходная команда (только change); обёртка
+запуска и опроса — наш фиксированный скрипт. Включается AGENT_JOBS (по
+умолчанию 1).
+"""
+
+import base64
+import json
+import os
+import shlex
+import time
+import uuid
+from typing import Any, Dict, Optional
+
+from bootstrap import sections
+from facts_cache import CACHE_DIR
+from policy import POLICY, normalize_command
+from ssh_pool import POOL
+from ssh_stream import read_channel
+
+ENABLED = os.environ.get("AGENT_JOBS", "1") != "0"
+POLL_S = float(os.environ.get("AGENT_JOB_POLL_S", "2"))
+MAX_POLL_S = 15.0
+TIMEOUT_S = float(os.environ.get("AGENT_JOB_TIMEOUT", "3600"))
+SSH_TIMEOUT_S = 30
+CHUNK_BYTES = 256 * 1024  # столько нового вывода за один опрос
+TAIL_CHARS = 600
+DEAD_POLLS = 2  # процесса нет и rc нет: столько опросов подряд, прежде чем считать задачу потерянной
+
+LOCAL_DIR = CACHE_DIR / "jobs"
+REMOTE_DIR = ".cache/agent-jobs"
+
+# долгие change-команды; остальные change (systemctl restart, ...) идут как раньше
+LONG_PREFIXES = (
+    "apt-get install",
+    "apt-get upgrade",
+    "apt-get dist-upgrade",
+    "apt-get full-upgrade",
+    "apt-get update",
+    "dnf install",
+    "dnf update",
+    "dnf upgrade",
+    "yum install",
+    "yum update",
+)
+
+
+def is_long_running(cmd: str) -> bool:
+    if not ENABLED or POLICY.check(cmd).kind != "change":
+        return False
+    return normalize_command(cmd).startswith(LONG_PREFIXES)
+
+
+def _remote_dir(job_id: str) -> str:
+    return f'"$HOME"/{REMOTE_DIR}/{job_id}'
+
+
+def launch_command(job_id: str, cmd: str) -> str:
+    inner = f"{cmd} >out 2>err </dev/null; echo $? >rc.tmp; mv rc.tmp rc"
+    d = _remote_dir(job_id)
+    # setsid: своя сессия, SIGHUP при закрытии канала задачу не тронет
+    script = (
+        f"mkdir -p {d} && cd {d} && S=$(command -v setsid); "
+        f"{{ $S nohup sh -c {shlex.quote(inner)} >/dev/null 2>&1 </dev/null & echo $! >pid; }}"
+        " && echo @@started"
+    )
+    return "sh -c " + shlex.quote(script)
+
+
+def poll_command(job: Dict[str, Any]) -> str:
+    d = _remote_dir(job["id"])
+
+    def chunk(name: str, off: int) -> str:
+        return (
+            f"echo @@{name}; tail -c +{off + 1} {name} 2>/dev/null "
+            f'| head -c {CHUNK_BYTES} | base64 | tr -d "\\n"; echo'
+        )
+
+    # rc читается до вывода: если он уже есть, out и err дописаны целиком
+    script = "; ".join(
+        [
+            f"cd {d} 2>/dev/null || {{ echo @@missing; exit 0; }}",
+            "echo @@rc; cat rc 2>/dev/null; echo",
+            'echo @@alive; kill -0 "$(cat pid 2>/dev/null)" 2>/dev/null && echo 1',
+            chunk("out", job["out_off"]),
+            chunk("err", job["err_off"]),
+            "exit 0",
+        ]
+    )
+    return "sh -c " + shlex.quote(script)
+
+
+def cancel_command(job: Dict[str, Any]) -> str:
+    d = _remote_dir(job["id"])
+    # без setsid своей группы процессов нет — тогда хотя бы сам процесс
+    script = (
+        f'cd {d} 2>/dev/null && P=$(cat pid) && '
+        '{ kill -TERM -"$P" 2>/dev/null || kill -TERM "$P" 2>/dev/null; }; exit 0'
+    )
+    return "sh -c " + shlex.quote(script)
+
+
+def _run(job: Dict[str, Any], command: str, key_path: Optional[str], password: Optional[str]):
+    with POOL.session(job["host"], job["user"], key_path=key_path, password=password) as chan:
+        chan.exec_command(command)
+        return read_channel(chan, SSH_TIMEOUT_S)
+
+
+# -----------------------------
+# Локальное хранилище
+# -----------------------------
+
+
+def _local(job_id: str, suffix: str):
+    return LOCAL_DIR / f"{job_id}.{suffix}"
+
+
+def save(job: Dict[str, Any]) -> None:
+    LOCAL_DIR.mkdir(parents=True, exist_ok=True)
+    tmp = _local(job["id"], f"{os.getpid()}.tmp")
+    tmp.write_text(json.dumps(job, ensure_ascii=False), encoding="utf-8")
+    os.replace(tmp, _local(job["id"], "json"))
+
+
+def load(job_id: str) -> Optional[Dict[str, Any]]:
+    try:
+        return json.loads(_local(job_id, "json").read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+
+
+def read_output(job: Dict[str, Any], stream: str = "out", offset: int = 0) -> str:
+    """Прочитанный на данный момент вывод задачи с байтового смещения."""
+    try:
+        with open(_local(job["id"], stream), "rb") as f:
+            f.seek(offset)
+            return f.read().decode("utf-8", errors="replace")
+    except OSError:
+        return ""
+
+
+# -----------------------------
+# Жизненный цикл
+# -----------------------------
+
+
+def start(
+    host: str,
+    user: str,
+    key_path: Optional[str],
+    password: Optional[str],
+    cmd: str,
+) -> Dict[str, Any]:
+    """Запускает cmd на хосте отвязанной задачей. status: running | failed."""
+    job: Dict[str, Any] = {
+        "id": uuid.uuid4().hex[:12],
+        "host": host,
+        "user": user,
+        "cmd": cmd,
+        "started": time.time(),
+        "status": "running",
+        "exit_code": None,
+        "out_off": 0,
+        "err_off": 0,
+        "tail": "",
+        "polls": 0,
+        "poll_errors": 0,
+        "dead_polls": 0,
+    }
+    try:
+        res = _run(job, launch_command(job["id"], cmd), key_path, password)
+    except Exception as e:
+        job.update(status="failed", error=f"{type(e).__name__}: {e}")
+        return job
+    if "@@started" not in res["stdout"]:
+        job.update(status="failed", error=(res["stderr"] or "launch failed").strip()[:500])
+    save(job)
+    return job
+
+
+def _append(job: Dict[str, Any], stream: str, data: bytes) -> None:
+    LOCAL_DIR.mkdir(parents=True, exist_ok=True)
+    with open(_local(job["id"], stream), "ab") as f:
+        f.write(data)
+    job[f"{stream}_off"] += len(data)
+
+
+def poll(
+    job: Dict[str, Any], key_path: Optional[str] = None, password: Optional[str] = None
+) -> Dict[str, Any]:
+    """Один опрос: дочитывает новый вывод и обновляет status (меняет job на месте)."""
+    if job["status"] != "running":
+        return job
+    if time.time() - job["started"] > TIMEOUT_S:
+        job["error"] = f"no result after {TIMEOUT_S:.0f}s, cancelled"
+        return cancel(job, key_path, password, status="timeout")
+    try:
+        res = _run(job, poll_command(job), key_path, password)
+    except Exception as e:
+        # сеть или рестарт sshd: задача на хосте живёт, пул переподключится в следующий раз
+        job["poll_errors"] += 1
+        job["last_error"] = f"{type(e).__name__}: {e}"
+        return job
+    job["polls"] += 1
+    s = sections(res["stdout"])
+    if "missing" in s:
+        job.update(status="lost", error="job directory is gone on the host")
+        save(job)
+        return job
+
+    more = False
+    for stream in ("out", "err"):
+        data = base64.b64decode("".join(s.get(stream, [])))
+        if data:
+            _append(job, stream, data)
+            more = more or len(data) >= CHUNK_BYTES
+            if stream == "out":
+                text = job["tail"] + data.decode("utf-8", errors="replace")
+                job["tail"] = text[-TAIL_CHARS:]
+
+    rc = (s.get("rc") or [""])[0].strip()
+    if rc.lstrip("-").isdigit() and not more:
+        job.update(status="done", exit_code=int(rc), finished=time.time())
+    elif not rc and not s.get("alive"):
+        # rc дописывается сразу после выхода — один промах бывает на гонке
+        job["dead_polls"] += 1
+        if job["dead_polls"] >= DEAD_POLLS:
+            job.update(status="lost", error="process is gone without an exit code")
+    save(job)
+    return job
+
+
+def wait(
+    job: Dict[str, Any],
+    key_path: Optional[str] = None,
+    password: Optional[str] = None,
+    timeout: Optional[float] = None,
+) -> Dict[str, Any]:
+    """Опрашивает до завершения (или timeout секунд — тогда задача остаётся running)."""
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    interval = POLL_S
+    while poll(job, key_path, password)["status"] == "running":
+        if deadline is not None and time.monotonic() + interval > deadline:
+            break
+        time.sleep(interval)
+        interval = min(interval * 1.5, MAX_POLL_S)
+    return job
+
+
+def cancel(
+    job: Dict[str, Any],
+    key_path: Optional[str] = None,
+    password: Optional[str] = None,
+    status: str = "cancelled",
+) -> Dict[str, Any]:
+    try:
+        _run(job, cancel_command(job), key_path, password)
+    except Exception as e:
+        job["last_error"] = f"{type(e).__name__}: {e}"
+    job.update(status=status, finished=time.time())
+    save(job)
+    return job
+
+
+def started_result(job: Dict[str, Any]) -> Dict[str, Any]:
+    """Шаг «задача запущена» — вместо результата самой команды."""
+    res: Dict[str, Any] = {
+        "cmd": job["cmd"],
+        "kind": "change",
+        "job": job["id"],
+        "job_status": job["status"],
+        "ok": job["status"] == "running",
+        "exit_code": None,
+        "stdout": "",
+        "stderr": "",
+    }
+    if job["status"] == "running":
+        res["stdout"] = f"[started as background job {job['id']}]"
+    else:
+        res["error"] = f"background job failed to start: {job.get('error')}"
+    return res
+
+
+def job_result(job: Dict[str, Any]) -> Dict[str, Any]:
+    """Шаг с итогом завершённой задачи: полный вывод и код выхода."""
+    err = read_output(job, "err")
+    if job["status"] != "done":
+        err += f"\n[background job {job['status']}: {job.get('error', '')}]"
+    return {
+        "cmd": job["cmd"],
+        "kind": "change",
+        "job": job["id"],
+        "job_status": job["status"],
+        "background": True,
+        "exit_code": job.get("exit_code"),
+        "ok": job["status"] == "done" and job.get("exit_code") == 0,
+        "stdout": read_output(job, "out"),
+        "stderr": err,
+        "duration_s": round(job.get("finished", time.time()) - job["started"], 3),
+        "rationale": f"background job {job['id']} finished ({job['status']})",
+    }
+
+
+def brief(job: Dict[str, Any]) -> Dict[str, Any]:
+    """Задача в контексте планировщика."""
+    return {
+        "job": job["id"],
+        "cmd": job["cmd"],
+        "running_s": round(time.time() - job["started"]),
+        "output_tail": job.get("tail", "")[-300:],
+    }
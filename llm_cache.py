@@ -0,0 +1,201 @@
+"""
+Content-addressed дисковый кэш ответов LLM.
+
+Ключ — sha256 от llm_string (модель + параметры вызова, включая tools)
+и сериализованных сообщений, которые LangChain передаёт в BaseCache.
+Записи живут TTL секунд; при превышении лимита размера удаляются давно
+не читанные (LRU по mtime, который обновляется при каждом попадании).
+
+Ответы fallback-моделей (llm_scheduler помечает их FALLBACK_KEY в
+response_metadata) не кэшируются: ключ строится по основной модели, и такой
+ответ потом выдавался бы за её.
+
+Включается через AGENT_LLM_CACHE=1.
+"""
+
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from langchain_core.caches import RETURN_VAL_TYPE, BaseCache
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.load import dumps
+from langchain_core.messages import BaseMessage, message_to_dict, messages_from_dict
+from langchain_core.outputs import ChatGeneration
+
+CACHE_DIR = Path(os.environ.get("AGENT_CACHE_DIR", ".agent_cache")) / "llm"
+ENABLED = os.environ.get("AGENT_LLM_CACHE", "0") == "1"
+TTL_S = float(os.environ.get("AGENT_LLM_CACHE_TTL", str(24 * 3600)))
+MAX_BYTES = int(float(os.environ.get("AGENT_LLM_CACHE_MAX_MB", "256")) * 1024 * 1024)
+
+# response_metadata ответа, который дала не основная модель цепочки
+FALLBACK_KEY = "fallback_model"
+
+# (event, data) -> None; event: "llm_cache_hit" | "llm_cache_miss"
+CacheListener = Callable[[str, Dict[str, Any]], None]
+
+
+_MODEL_RE = re.compile(r"\('model_name', '([^']*)'\)")
+
+
+def _model_name(llm_string: str) -> Optional[str]:
+    # llm_string — это json параметров + "---" + stop; нам нужна только модель
+    try:
+        return json.loads(llm_string.split("---", 1)[0]).get("kwargs", {}).get("model_name")
+    except (ValueError, AttributeError):
+        # не-сериализуемые модели (llm_scheduler) дают str(sorted(params.items()))
+        m = _MODEL_RE.search(llm_string)
+        return m.group(1) if m else None
+
+
+class DiskLLMCache(BaseCache):
+    def __init__(
+        self, root: Path = CACHE_DIR, ttl_s: float = TTL_S, max_bytes: int = MAX_BYTES
+    ):
+        self.root = Path(root)
+        self.ttl_s = ttl_s
+        self.max_bytes = max_bytes
+        self.listeners: List[CacheListener] = []
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._size = sum(p.stat().st_size for p in self._files())
+
+    def _files(self):
+        if not self.root.exists():
+            return []
+        return [p for p in self.root.glob("*/*.json")]
+
+    def _path(self, prompt: str, llm_string: str) -> Path:
+        key = hashlib.sha256(
+            llm_string.encode("utf-8") + b"\0" + prompt.encode("utf-8")
+        ).hexdigest()
+        return self.root / key[:2] / f"{key}.json"
+
+    def _emit(self, event: str, path: Path, llm_string: str) -> None:
+        data = {"key": path.stem[:16], "model": _model_name(llm_string)}
+        for fn in self.listeners:
+            fn(event, data)
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses}
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[RETURN_VAL_TYPE]:
+        path = self._path(prompt, llm_string)
+        try:
+            entry = json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            entry = None
+
+        if entry is not None and time.time() - entry["created"] > self.ttl_s:
+            self._remove(path)
+            entry = None
+
+        if entry is None:
+            with self._lock:
+                self.misses += 1
+            self._emit("llm_cache_miss", path, llm_string)
+            return None
+
+        try:
+            os.utime(path)  # LRU: отмечаем чтение
+        except OSError:
+            pass
+        with self._lock:
+            self.hits += 1
+        self._emit("llm_cache_hit", path, llm_string)
+        return [
+            ChatGeneration(message=m) for m in messages_from_dict(entry["messages"])
+        ]
+
+    def update(self, prompt: str, llm_string: str, return_val: RETURN_VAL_TYPE) -> None:
+        gens = [g for g in return_val if isinstance(g, ChatGeneration)]
+        if not gens or any(g.message.response_metadata.get(FALLBACK_KEY) for g in gens):
+            return
+        path = self._path(prompt, llm_string)
+        body = json.dumps(
+            {"created": time.time(), "messages": [message_to_dict(g.message) for g in gens]},
+            ensure_ascii=False,
+        )
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp.write_text(body, encoding="utf-8")
+        os.replace(tmp, path)
+
+        with self._lock:
+            self._size += len(body.encode("utf-8"))
+            over = self._size > self.max_bytes
+        if over:
+            self._evict()
+
+    def _remove(self, path: Path) -> None:
+        try:
+            size = path.stat().st_size
+            path.unlink()
+        except OSError:
+            return
+        with self._lock:
+            self._size -= size
+
+    def _evict(self) -> None:
+        # удаляем самые давно читанные, пока не уложимся в 90% лимита
+        files = []
+        for p in self._files():
+            try:
+                st = p.stat()
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, p))
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        target = self.max_bytes * 0.9
+        for _, size, p in files:
+            if total <= target:
+                break
+            try:
+                p.unlink()
+            except OSError:
+                continue
+            total -= size
+        with self._lock:
+            self._size = total
+
+    def clear(self, **kwargs: Any) -> None:
+        for p in self._files():
+            try:
+                p.unlink()
+            except OSError:
+                pass
+        with self._lock:
+            self._size = 0
+
+
+def cache_key(
+    llm: BaseChatModel, messages: Sequence[BaseMessage], **kwargs: Any
+) -> Tuple[str, str]:
+    """
+    (prompt, llm_string) так же, как их строит BaseChatModel для invoke.
+    stream() кэш не смотрит — потоковые вызовы обращаются к нему сами.
+    """
+    normalized = [m.model_copy(update={"id": None}) if m.id is not None else m for m in messages]
+    return dumps(normalized), llm._get_llm_string(**kwargs)
+
+
+_CACHE: Optional[DiskLLMCache] = None
+_CACHE_LOCK = threading.Lock()
+
+
+def get_llm_cache() -> Optional[DiskLLMCache]:
+    """Общий кэш процесса или None, если кэширование выключено."""
+    global _CACHE
+    if not ENABLED:
+        return None
+    with _CACHE_LOCK:
+        if _CACHE is None:
+            _CACHE = DiskLLMCache()
+        return _CACHE
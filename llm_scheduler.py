@@ -0,0 +1,318 @@
+"""
+Общий для процесса планировщик вызовов LLM (OpenRouter).
+
+- один долгоживущий клиент на модель с общим пулом HTTP-соединений;
+- клиентский token bucket под лимит провайдера (OPENROUTER_RPM запросов
+  в минуту, всплеск до OPENROUTER_BURST): fleet- и batch-сессии делят одну
+  квоту и не ловят 429 друг за друга;
+- повтор с экспоненциальной задержкой и jitter, Retry-After / X-RateLimit-Reset
+  из ответа провайдера имеют приоритет;
+- цепочка моделей: OPENROUTER_MODEL, затем OPENROUTER_FALLBACK_MODELS
+  (через запятую). Модель, получившая 429, "остывает", пока не истечёт её
+  задержка, — запросы идут следующей по списку.
+
+Снаружи это обычная чат-модель LangChain: invoke/stream/bind_tools.
+"""
+
+import asyncio
+import email.utils
+import os
+import random
+import threading
+import time
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional, Sequence
+
+import httpx
+import openai
+from langchain_core.callbacks import (
+    AsyncCallbackManagerForLLMRun,
+    CallbackManagerForLLMRun,
+)
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+from langchain_openai import ChatOpenAI
+from pydantic import PrivateAttr
+
+from llm_cache import FALLBACK_KEY, get_llm_cache
+
+BASE_URL = "https://openrouter.ai/api/v1"
+RPM = float(os.environ.get("OPENROUTER_RPM", "20"))
+BURST = float(os.environ.get("OPENROUTER_BURST", "5"))
+MAX_ATTEMPTS = int(os.environ.get("LLM_MAX_ATTEMPTS", "6"))
+BACKOFF_BASE_S = float(os.environ.get("LLM_BACKOFF_BASE", "1.0"))
+BACKOFF_MAX_S = float(os.environ.get("LLM_BACKOFF_MAX", "60"))
+HTTP_MAX_CONNECTIONS = int(os.environ.get("LLM_HTTP_MAX_CONNECTIONS", "32"))
+
+# временные ошибки провайдера: повторяем так же, как 429
+RETRYABLE = (
+    openai.RateLimitError,
+    openai.APIConnectionError,  # включает APITimeoutError
+    openai.InternalServerError,
+)
+
+# (event, data) -> None; event: "llm_throttled" | "llm_fallback" | "llm_retry_wait"
+SchedulerListener = Callable[[str, Dict[str, Any]], None]
+
+
+class TokenBucket:
+    """Бакет с резервированием: reserve() сразу списывает токен и говорит, сколько ждать."""
+
+    def __init__(self, rate_per_s: float, burst: float):
+        self.rate = rate_per_s
+        self.burst = max(1.0, burst)
+        self._tokens = self.burst
+        self._stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            self._tokens -= 1.0
+            # ушли в минус — ждём, пока долг восполнится
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+
+def retry_after(err: Exception) -> Optional[float]:
+    """Задержка из заголовков ответа (секунды), если провайдер её сообщил."""
+    resp = getattr(err, "response", None)
+    if resp is None:
+        return None
+    headers = resp.headers
+    value = headers.get("retry-after")
+    if value:
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            parsed = email.utils.parsedate_to_datetime(value)
+            if parsed is not None:
+                return max(0.0, parsed.timestamp() - time.time())
+    reset = headers.get("x-ratelimit-reset")  # OpenRouter: unix-время в мс
+    if reset:
+        try:
+            return max(0.0, float(reset) / 1000.0 - time.time())
+        except ValueError:
+            return None
+    return None
+
+
+def backoff(attempt: int) -> float:
+    # "full jitter": равномерно в [0, base * 2^attempt], не больше BACKOFF_MAX_S
+    return random.uniform(0, min(BACKOFF_MAX_S, BACKOFF_BASE_S * (2**attempt)))
+
+
+class ScheduledChatModel(BaseChatModel):
+    models: List[ChatOpenAI]
+    max_attempts: int = MAX_ATTEMPTS
+
+    _bucket: TokenBucket = PrivateAttr()
+    _cooldown: Dict[str, float] = PrivateAttr(default_factory=dict)
+    _lock: Any = PrivateAttr(default_factory=threading.Lock)
+    _listeners: List[SchedulerListener] = PrivateAttr(default_factory=list)
+
+    def __init__(self, bucket: Optional[TokenBucket] = None, **kwargs: Any):
+        super().__init__(**kwargs)
+        self._bucket = bucket or TokenBucket(RPM / 60.0, BURST)
+
+    @property
+    def _llm_type(self) -> str:
+        return "scheduled-openrouter"
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        # в ключ кэша LLM идёт основная модель и её параметры; ответы fallback-
+        # моделей помечены FALLBACK_KEY, и кэш их не сохраняет
+        primary = self.models[0]
+        return {"model_name": primary.model_name, "temperature": primary.temperature}
+
+    @property
+    def listeners(self) -> List[SchedulerListener]:
+        return self._listeners
+
+    def _emit(self, event: str, data: Dict[str, Any]) -> None:
+        for fn in self._listeners:
+            fn(event, data)
+
+    def bind_tools(self, tools: Sequence[Any], **kwargs: Any):
+        # формат tools/tool_choice у всех моделей цепочки один — берём у основной
+        return self.bind(**self.models[0].bind_tools(tools, **kwargs).kwargs)
+
+    # ---- выбор модели и задержки ----
+
+    def _pick(self) -> tuple:
+        """(модель, сколько ждать): первая не остывающая, иначе та, что освободится раньше."""
+        now = time.monotonic()
+        with self._lock:
+            ready = [m for m in self.models if self._cooldown.get(m.model_name, 0) <= now]
+            if ready:
+                return ready[0], 0.0
+            m = min(self.models, key=lambda m: self._cooldown[m.model_name])
+            return m, self._cooldown[m.model_name] - now
+
+    def _failed(self, model: ChatOpenAI, err: Exception, attempt: int) -> None:
+        delay = retry_after(err)
+        if delay is None:
+            delay = backoff(attempt)
+        with self._lock:
+            self._cooldown[model.model_name] = time.monotonic() + delay
+        self._emit(
+            "llm_throttled",
+            {
+                "model": model.model_name,
+                "error": type(err).__name__,
+                "delay_s": round(delay, 2),
+                "attempt": attempt + 1,
+            },
+        )
+
+    def _mark(self, model: ChatOpenAI, msg: BaseMessage) -> None:
+        if model is not self.models[0]:
+            msg.response_metadata[FALLBACK_KEY] = model.model_name
+
+    def _plan_attempt(self, attempt: int) -> tuple:
+        model, wait = self._pick()
+        if model is not self.models[0]:
+            self._emit("llm_fallback", {"model": model.model_name, "attempt": attempt + 1})
+        wait = max(wait, self._bucket.reserve())
+        if wait > 0:
+            self._emit("llm_retry_wait", {"model": model.model_name, "wait_s": round(wait, 2)})
+        return model, wait
+
+    # ---- вызовы ----
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        for attempt in range(self.max_attempts):
+            model, wait = self._plan_attempt(attempt)
+            time.sleep(wait)
+            try:
+                result = model._generate(messages, stop=stop, **kwargs)
+                for g in result.generations:
+                    self._mark(model, g.message)
+                return result
+            except RETRYABLE as e:
+                if attempt + 1 >= self.max_attempts:
+                    raise
+                self._failed(model, e, attempt)
+        raise AssertionError("unreachable")
+
+    async def _agenerate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        for attempt in range(self.max_attempts):
+            model, wait = self._plan_attempt(attempt)
+            await asyncio.sleep(wait)
+            try:
+                result = await model._agenerate(messages, stop=stop, **kwargs)
+                for g in result.generations:
+                    self._mark(model, g.message)
+                return result
+            except RETRYABLE as e:
+                if attempt + 1 >= self.max_attempts:
+                    raise
+                self._failed(model, e, attempt)
+        raise AssertionError("unreachable")
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        for attempt in range(self.max_attempts):
+            model, wait = self._plan_attempt(attempt)
+            time.sleep(wait)
+            started = False
+            try:
+                for chunk in model._stream(messages, stop=stop, **kwargs):
+                    if not started:
+                        # метка один раз: при склейке чанков строки в metadata складываются
+                        self._mark(model, chunk.message)
+                    started = True
+                    if run_manager:
+                        run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+                    yield chunk
+                return
+            except RETRYABLE as e:
+                # после первого чанка повтор даст дубли — отдаём ошибку наверх
+                if started or attempt + 1 >= self.max_attempts:
+                    raise
+                self._failed(model, e, attempt)
+
+    async def _astream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        for attempt in range(self.max_attempts):
+            model, wait = self._plan_attempt(attempt)
+            await asyncio.sleep(wait)
+            started = False
+            try:
+                async for chunk in model._astream(messages, stop=stop, **kwargs):
+                    if not started:
+                        self._mark(model, chunk.message)
+                    started = True
+                    if run_manager:
+                        await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+                    yield chunk
+                return
+            except RETRYABLE as e:
+                if started or attempt + 1 >= self.max_attempts:
+                    raise
+                self._failed(model, e, attempt)
+
+
+def model_chain() -> List[str]:
+    primary = os.environ.get("OPENROUTER_MODEL", "openai/gpt-4o-mini")
+    extra = os.environ.get("OPENROUTER_FALLBACK_MODELS", "")
+    names = [primary] + [m.strip() for m in extra.split(",") if m.strip()]
+    return list(dict.fromkeys(names))
+
+
+_LLM: Optional[ScheduledChatModel] = None
+_LLM_LOCK = threading.Lock()
+
+
+def get_llm() -> ScheduledChatModel:
+    """Общая модель процесса: один бакет, одна цепочка fallback, один пул соединений."""
+    global _LLM
+    with _LLM_LOCK:
+        if _LLM is None:
+            limits = httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_CONNECTIONS,
+            )
+            http_client = httpx.Client(limits=limits)
+            http_async_client = httpx.AsyncClient(limits=limits)
+            api_key = os.environ["OPENROUTER_API_KEY"]
+            models = [
+                ChatOpenAI(
+                    model=name,
+                    api_key=api_key,
+                    base_url=BASE_URL,
+                    temperature=0.1,
+                    max_retries=0,  # повторы — забота планировщика
+                    http_client=http_client,
+                    http_async_client=http_async_client,
+                )
+                for name in model_chain()
+            ]
+            _LLM = ScheduledChatModel(models=models, cache=get_llm_cache())
+        return _LLM
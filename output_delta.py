@@ -0,0 +1,139 @@
+"""
+Дельты выводов для повторных команд.
+
+Агенты часто перезапускают одну и ту же команду для проверки:
+systemctl status до и после рестарта, apt-get update дважды. Полный вывод
+повтора почти не несёт нового, но снова уходит в контекст LLM. Здесь вывод
+повтора сравнивается с прошлым выводом той же команды на том же хосте. Если
+он не изменился, вместо текста идёт пометка, иначе — компактный unified diff.
+Если diff выходит не сильно короче самого вывода, отправляется полный текст.
+
+Меняется только то, что видит модель. Отчёт и сайдкар хранят полные выводы.
+agent.py считает дельты заново по шагам прогона, которые читает из
+step_store (в состоянии графа только ссылки на них). agent_tc держит
+OutputTracker на прогон. Включается AGENT_OUTPUT_DELTA (по
+умолчанию 1).
+"""
+
+import difflib
+import os
+import re
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+ENABLED = os.environ.get("AGENT_OUTPUT_DELTA", "1") != "0"
+MIN_CHARS = 200  # короткий вывод дешевле отправить целиком
+MAX_RATIO = 0.6  # diff длиннее 60% вывода не экономит
+CONTEXT_LINES = 1
+
+# ссылка на spill-файл своя у каждого шага и не должна давать расхождение
+_SPILL_REF = re.compile(r"\[\.\.\. full output: \S+ \.\.\.\]")
+
+
+def _norm(text: Optional[str]) -> str:
+    return _SPILL_REF.sub("[... full output ...]", text or "")
+
+
+def is_unchanged(text: Optional[str]) -> bool:
+    return bool(text) and text.startswith("[unchanged since ")
+
+
+def encode_text(prev: Optional[str], cur: Optional[str]) -> Tuple[str, str]:
+    """(режим, текст): unchanged / diff / full."""
+    prev, cur = _norm(prev), _norm(cur)
+    if prev == cur:
+        return "unchanged", ""
+    if len(cur) < MIN_CHARS:
+        return "full", cur
+    lines = difflib.unified_diff(
+        prev.splitlines(), cur.splitlines(), n=CONTEXT_LINES, lineterm=""
+    )
+    # заголовки ---/+++ без имён файлов бесполезны
+    diff = "\n".join(ln for ln in lines if not ln.startswith(("---", "+++")))
+    if len(diff) > len(cur) * MAX_RATIO:
+        return "full", cur
+    return "diff", diff
+
+
+def _encode_streams(
+    item: Dict[str, Any], prev: Dict[str, Any], label: str
+) -> Tuple[Dict[str, Any], bool]:
+    """Копия item с дельтами stdout/stderr; второй элемент — изменилось ли что-то."""
+    out = dict(item)
+    changed = item.get("exit_code") != prev.get("exit_code")
+    for stream in ("stdout", "stderr"):
+        mode, text = encode_text(prev.get(stream), item.get(stream))
+        if mode == "unchanged":
+            if item.get(stream):
+                out[stream] = f"[unchanged since {label}]"
+            continue
+        changed = True
+        if mode == "diff":
+            out[stream] = f"[diff vs {label}]\n{text}"
+    return out, changed
+
+
+def encode(item: Dict[str, Any], prev: Dict[str, Any], label: str) -> Dict[str, Any]:
+    """
+    Результат команды для LLM относительно прошлого запуска той же команды.
+    Fleet-группы сравниваются с группой прошлого шага, где был первый хост группы.
+    """
+    if item.get("groups"):
+        by_host = {h: g for g in prev.get("groups") or [] for h in g.get("hosts", [])}
+        groups, changed = [], False
+        for g in item["groups"]:
+            pg = by_host.get(g["hosts"][0]) if g.get("hosts") else None
+            if pg is None:
+                groups.append(g)
+                changed = True
+                continue
+            eg, ch = _encode_streams(g, pg, label)
+            groups.append(eg)
+            changed = changed or ch
+        out = {**item, "groups": groups}
+    else:
+        out, changed = _encode_streams(item, prev, label)
+    out["delta"] = f"changed since {label}" if changed else f"unchanged since {label}"
+    return out
+
+
+def delta_steps(steps: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Шаги agent.py для планировщика: повторы команд — дельтами к прошлому шагу."""
+    if not ENABLED:
+        return steps
+    last: Dict[str, int] = {}
+    out = []
+    for i, s in enumerate(steps):
+        cmd = s.get("cmd")
+        j = last.get(cmd) if cmd else None
+        if j is None or s.get("error") or steps[j].get("error"):
+            out.append(s)
+        else:
+            out.append(encode(s, steps[j], f"step {j + 1}"))
+        if cmd:
+            last[cmd] = i
+    return out
+
+
+class OutputTracker:
+    """Прошлые выводы по (хост, команда) в рамках одного прогона agent_tc."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._last: Dict[Tuple[str, str], Dict[str, Any]] = {}
+
+    def seed(self, host: str, steps: List[Dict[str, Any]]) -> None:
+        """После --resume: прошлые выводы из сайдкара отчёта."""
+        for s in steps:
+            if s.get("cmd") and not s.get("error"):
+                self._last[(host, s["cmd"])] = s
+
+    def encode(self, host: str, res: Dict[str, Any]) -> Dict[str, Any]:
+        key = (host, res.get("cmd") or "")
+        with self._lock:
+            prev = self._last.get(key)
+            if not res.get("error"):
+                self._last[key] = res
+        if not ENABLED or prev is None or res.get("error"):
+            return res
+        return encode(res, prev, "previous run")
@@ -0,0 +1,313 @@
+"""
+Разбор вывода типовых диагностических команд в компактные записи.
+
+df, free, ps, ss, systemctl --failed, journalctl -p, dpkg -l печатают
+широкие таблицы. Модели из них нужно немного: заполненность разделов,
+топ процессов по памяти, слушающие порты, упавшие юниты, ошибки по юнитам.
+Парсер выбирается по readonly-префиксу политики, на котором сработала
+команда (Verdict.rule). Поэтому `df -h` и `df -hT` попадают в один парсер.
+
+Запись кладётся в результат шага полем "parsed". Отчёт хранит сырой вывод,
+а LLM видит запись вместо stdout (см. for_llm). Парсер, не узнавший формат,
+возвращает None, и тогда остаётся сырой вывод. Так же бывает, если запись
+вышла не короче текста. Включается AGENT_PARSERS (по умолчанию 1).
+"""
+
+import json
+import os
+import re
+from typing import Any, Callable, Dict, List, Optional
+
+from output_delta import is_unchanged
+from policy import POLICY
+
+ENABLED = os.environ.get("AGENT_PARSERS", "1") != "0"
+TOP_N = 10
+MAX_ROWS = 40
+
+# (команда, stdout) -> запись или None
+Parser = Callable[[str, str], Optional[Dict[str, Any]]]
+PARSERS: Dict[str, Parser] = {}
+
+
+def parser(*prefixes: str):
+    """Регистрирует парсер под readonly-префиксами из policy.json."""
+
+    def register(fn: Parser) -> Parser:
+        for p in prefixes:
+            PARSERS[p] = fn
+        return fn
+
+    return register
+
+
+def _num(value: str) -> Any:
+    try:
+        return int(value)
+    except ValueError:
+        try:
+            return float(value)
+        except ValueError:
+            return value
+
+
+def _rows(stdout: str) -> List[str]:
+    return [ln for ln in stdout.splitlines() if ln.strip()]
+
+
+# -----------------------------
+# Парсеры
+# -----------------------------
+
+_PSEUDO_FS = {"tmpfs", "devtmpfs", "udev", "overlay", "squashfs", "none", "efivarfs"}
+
+
+@parser("df")
+def parse_df(cmd: str, stdout: str) -> Optional[Dict[str, Any]]:
+    lines = _rows(stdout)
+    if not lines or not lines[0].startswith("Filesystem"):
+        return None
+    inodes = "IUse%" in lines[0]
+    mounts, skipped, carry = [], 0, ""
+    for line in lines[1:]:
+        parts = (carry + " " + line).split()
+        if len(parts) < 6:
+            # длинное имя устройства df переносит на следующую строку
+            carry = " ".join(parts)
+            continue
+        carry = ""
+        if parts[0] in _PSEUDO_FS:
+            skipped += 1
+            continue
+        pct = parts[4].rstrip("%")
+        mounts.append(
+            {
+                "mount": " ".join(parts[5:]),
+                "fs": parts[0],
+                "size": _num(parts[1]),
+                "used": _num(parts[2]),
+                "avail": _num(parts[3]),
+                "used_pct": int(pct) if pct.isdigit() else None,
+            }
+        )
+    mounts.sort(key=lambda m: -(m["used_pct"] or 0))
+    rec: Dict[str, Any] = {"metric": "inodes" if inodes else "space", "mounts": mounts[:MAX_ROWS]}
+    if skipped:
+        rec["pseudo_fs_skipped"] = skipped
+    return rec
+
+
+@parser("free")
+def parse_free(cmd: str, stdout: str) -> Optional[Dict[str, Any]]:
+    lines = _rows(stdout)
+    if not lines or "total" not in lines[0]:
+        return None
+    cols = lines[0].split()
+    rec: Dict[str, Any] = {}
+    for line in lines[1:]:
+        name, _, rest = line.partition(":")
+        if not rest:
+            continue
+        rec[name.strip().lower()] = dict(zip(cols, (_num(v) for v in rest.split())))
+    return rec or None
+
+
+_PS_CMD = ("COMMAND", "CMD", "ARGS")
+
+
+@parser("ps")
+def parse_ps(cmd: str, stdout: str) -> Optional[Dict[str, Any]]:
+    lines = _rows(stdout)
+    if not lines:
+        return None
+    header = lines[0].split()
+    if "PID" not in header or header[-1] not in _PS_CMD:
+        return None
+    procs = []
+    for line in lines[1:]:
+        parts = line.split(None, len(header) - 1)
+        if len(parts) == len(header):
+            procs.append(dict(zip(header, parts)))
+    rec: Dict[str, Any] = {"processes": len(procs)}
+    if "STAT" in header:
+        rec["zombies"] = sum(1 for p in procs if p["STAT"].startswith("Z"))
+
+    def short(p: Dict[str, str]) -> Dict[str, Any]:
+        out: Dict[str, Any] = {"pid": _num(p["PID"]), "cmd": p[header[-1]][:80]}
+        for col, key in (("USER", "user"), ("%MEM", "mem_pct"), ("%CPU", "cpu_pct"), ("RSS", "rss_kb")):
+            if col in p:
+                out[key] = _num(p[col])
+        return out
+
+    if "%MEM" in header:
+        by_mem = sorted(procs, key=lambda p: -float(_num(p["%MEM"]) or 0))
+        rec["top_mem"] = [short(p) for p in by_mem[:TOP_N]]
+    if "%CPU" in header:
+        by_cpu = sorted(procs, key=lambda p: -float(_num(p["%CPU"]) or 0))
+        rec["top_cpu"] = [short(p) for p in by_cpu[: TOP_N // 2]]
+    if "%MEM" not in header and "%CPU" not in header:
+        # ps -ef и подобные: хотя бы что запущено и сколько
+        counts: Dict[str, int] = {}
+        for p in procs:
+            name = p[header[-1]].split()[0] if p[header[-1]].split() else ""
+            counts[name] = counts.get(name, 0) + 1
+        rec["commands"] = dict(sorted(counts.items(), key=lambda kv: -kv[1])[:TOP_N])
+    return rec
+
+
+_SS_PROC = re.compile(r'users:\(\("([^"]+)"')
+
+
+@parser("ss ")
+def parse_ss(cmd: str, stdout: str) -> Optional[Dict[str, Any]]:
+    lines = _rows(stdout)
+    if not lines:
+        return None
+    head = lines[0].split()
+    if not head or head[0] not in ("Netid", "State"):
+        return None
+    netid = head[0] == "Netid"
+    states: Dict[str, int] = {}
+    listening = []
+    for line in lines[1:]:
+        parts = line.split()
+        if netid:
+            proto, parts = parts[0], parts[1:]
+        else:
+            proto = "tcp"
+        if len(parts) < 5:
+            continue
+        state, local = parts[0], parts[3]
+        states[state] = states.get(state, 0) + 1
+        if state in ("LISTEN", "UNCONN"):
+            item = {"proto": proto, "local": local}
+            m = _SS_PROC.search(line)
+            if m:
+                item["process"] = m.group(1)
+            listening.append(item)
+    return {
+        "sockets": sum(states.values()),
+        "states": states,
+        "listening": listening[:MAX_ROWS],
+    }
+
+
+@parser("systemctl --failed")
+def parse_failed_units(cmd: str, stdout: str) -> Optional[Dict[str, Any]]:
+    units = []
+    for line in _rows(stdout):
+        parts = line.lstrip("●* ").split(None, 4)
+        # заголовок и легенда (LOAD = ..., N loaded units listed) — не юниты
+        if len(parts) < 4 or "." not in parts[0] or parts[1] == "=":
+            continue
+        units.append(
+            {
+                "unit": parts[0],
+                "load": parts[1],
+                "active": parts[2],
+                "sub": parts[3],
+                "description": parts[4] if len(parts) > 4 else "",
+            }
+        )
+    return {"failed": len(units), "units": units[:MAX_ROWS]}
+
+
+_JOURNAL_LINE = re.compile(
+    r"^(?P<ts>\w{3} [ \d]\d \d\d:\d\d:\d\d|\d{4}-\d\d-\d\dT\S+)\s+\S+\s+"
+    r"(?P<ident>[^\s:\[]+)(?:\[\d+\])?:\s*(?P<msg>.*)$"
+)
+
+
+@parser("journalctl")
+def parse_journal(cmd: str, stdout: str) -> Optional[Dict[str, Any]]:
+    # сводка по юнитам уместна для выборки ошибок; journalctl -u nginx модель хочет видеть как есть
+    if not re.search(r"(?:^|\s)(?:-p|--priority)[\s=]", cmd):
+        return None
+    by_unit: Dict[str, Dict[str, Any]] = {}
+    entries = unparsed = 0
+    for line in _rows(stdout):
+        if line.startswith("-- "):
+            continue
+        m = _JOURNAL_LINE.match(line)
+        if not m:
+            unparsed += 1
+            continue
+        entries += 1
+        u = by_unit.setdefault(m["ident"], {"unit": m["ident"], "count": 0})
+        u["count"] += 1
+        u["last"] = m["msg"][:160]
+        u["last_ts"] = m["ts"]
+    if unparsed and not entries:
+        return None
+    units = sorted(by_unit.values(), key=lambda u: -u["count"])
+    rec: Dict[str, Any] = {"entries": entries, "by_unit": units[:TOP_N]}
+    if unparsed:
+        rec["unparsed_lines"] = unparsed
+    return rec
+
+
+_DPKG_ROW = re.compile(r"^([a-zA-Z][a-zA-Z ]{1,2})\s+(\S+)\s+(\S+)\s+(\S+)\s*(.*)$")
+
+
+@parser("dpkg -l")
+def parse_dpkg(cmd: str, stdout: str) -> Optional[Dict[str, Any]]:
+    pkgs = []
+    for line in _rows(stdout):
+        if line.startswith(("Desired=", "|", "+++")):
+            continue
+        m = _DPKG_ROW.match(line)
+        if m:
+            pkgs.append({"state": m[1].strip(), "name": m[2], "version": m[3]})
+    if not pkgs:
+        return None
+    states: Dict[str, int] = {}
+    for p in pkgs:
+        states[p["state"]] = states.get(p["state"], 0) + 1
+    # не до конца установленные пакеты (rc, iU, ...) интереснее обычных ii
+    pkgs.sort(key=lambda p: p["state"] == "ii")
+    rec: Dict[str, Any] = {"packages": len(pkgs), "states": states, "list": pkgs[:MAX_ROWS]}
+    if len(pkgs) > MAX_ROWS:
+        rec["truncated"] = len(pkgs) - MAX_ROWS
+    return rec
+
+
+# -----------------------------
+# Применение
+# -----------------------------
+
+
+def parse_output(cmd: str, stdout: Optional[str]) -> Optional[Dict[str, Any]]:
+    if not ENABLED or not stdout:
+        return None
+    verdict = POLICY.check(cmd)
+    fn = PARSERS.get(verdict.rule or "") if verdict.kind == "readonly" else None
+    if fn is None:
+        return None
+    try:
+        rec = fn(cmd, stdout)
+    except (ValueError, IndexError, KeyError):
+        return None
+    if rec is None or len(json.dumps(rec, ensure_ascii=False)) >= len(stdout):
+        return None
+    return rec
+
+
+def attach(result: Dict[str, Any]) -> Dict[str, Any]:
+    """Добавляет в результат команды поле parsed (по полному, ещё не урезанному выводу)."""
+    rec = parse_output(result.get("cmd") or "", result.get("stdout"))
+    if rec is not None:
+        result["parsed"] = rec
+    return result
+
+
+def for_llm(item: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Шаг или fleet-группа для LLM: разобранная запись вместо stdout.
+    Пометка "без изменений" от output_delta ещё короче, её не трогаем.
+    """
+    out = item
+    if item.get("parsed") is not None and not is_unchanged(item.get("stdout")):
+        out = {k: v for k, v in item.items() if k != "stdout"}
+    if item.get("groups"):
+        out = {**out, "groups": [for_llm(g) for g in item["groups"]]}
+    return out
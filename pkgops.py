@@ -0,0 +1,271 @@
+"""
+Пакетные операции: apt-get / dnf / yum без лишних транзакций.
+
+Агенты часто ставят пакеты по одному (`apt-get install nginx`, потом
+`apt-get install curl`) и повторяют `apt-get update`. Каждый такой вызов —
+отдельный цикл dpkg lock, а update каждый раз заново качает индексы. Здесь:
+
+- prepare(): sudo, -y и DEBIAN_FRONTEND=noninteractive для apt-get, а также
+  sudo и -y для dnf/yum. Раньше это жило прямо в run_remote agent_tc.
+- skip(): apt-get update пропускается, если индексы свежие. Проверяется
+  своя запись об успешном update в этом процессе (по хосту и пользователю)
+  или mtime /var/lib/apt/lists на хосте (одна короткая сессия; pkgcache.bin
+  не годится — его пересобирают и install, и dpkg). install не пропускается
+  никогда: пакет мог удалить кто-то другой, и только менеджер знает, что
+  стоит на хосте.
+- merge_commands(): подряд идущие install (remove) одного менеджера с
+  одинаковыми флагами склеиваются в одну команду. Так делает планировщик
+  agent.py с пачкой команд.
+- Coalescer: install/remove одного хоста (параллельные tool calls в
+  agent_tc) — group commit. Первый запрос идёт сразу. Те, что пришли, пока
+  он выполняется, уходят следующей общей транзакцией. Результат общий.
+
+У dnf/yum метаданные и так кэшируются (metadata_expire), а `dnf update`
+обновляет пакеты, а не индексы, — поэтому пропуск update только для apt.
+Включается AGENT_PKGOPS (по умолчанию 1).
+"""
+
+import os
+import re
+import shlex
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple, TypeVar
+
+from policy import POLICY, normalize_command
+from ssh_pool import POOL
+from ssh_stream import read_channel
+
+ENABLED = os.environ.get("AGENT_PKGOPS", "1") != "0"
+LISTS_TTL_S = float(os.environ.get("AGENT_APT_LISTS_TTL", "3600"))
+CHECK_TIMEOUT_S = 15
+
+MANAGERS = ("apt-get", "dnf", "yum")
+# действия dnf/yum, которым нужен -y (иначе менеджер ждёт подтверждения на stdin)
+_NEEDS_YES = ("install", "update", "upgrade", "remove", "erase")
+_MERGEABLE = ("install", "remove")
+# флаги со значением отдельным словом: `-o Dpkg::Options::=...`, `-t bookworm-backports`
+_VALUE_FLAGS = ("-o", "-t", "-c", "--option", "--target-release")
+
+_SHELL_META = re.compile(r"[;&|<>`$(){}\n]")
+
+T = TypeVar("T")
+
+
+def parse(cmd: str) -> Optional[Dict[str, Any]]:
+    """`sudo apt-get install -y nginx` -> {manager, action, flags, packages, prefix}."""
+    norm = normalize_command(cmd)
+    # цепочки, перенаправления и подстановки — не одна пакетная операция
+    if _SHELL_META.search(norm):
+        return None
+    try:
+        tokens = shlex.split(norm)
+    except ValueError:
+        return None
+    if len(tokens) < 2 or tokens[0] not in MANAGERS:
+        return None
+    flags: List[str] = []
+    packages: List[str] = []
+    rest = iter(tokens[2:])
+    for t in rest:
+        if t in _VALUE_FLAGS:
+            flags.append(f"{t} {next(rest, '')}")
+        elif t.startswith("-"):
+            flags.append(t)
+        else:
+            packages.append(t)
+    return {
+        "cmd": cmd,
+        "manager": tokens[0],
+        "action": tokens[1],
+        "flags": flags,
+        "packages": packages,
+        # VAR=... sudo перед менеджером: склеиваем только команды с одинаковой обвязкой
+        "prefix": cmd.strip()[: len(cmd.strip()) - len(norm)],
+    }
+
+
+def prepare(cmd: str) -> str:
+    """sudo, -y и noninteractive: без них менеджер пакетов падает или ждёт ввода."""
+    cmd = cmd.strip()
+    manager = cmd.split(" ", 1)[0]
+    if manager not in MANAGERS or " " not in cmd:
+        return cmd
+    action = cmd.split()[1]
+    cmd = "sudo " + cmd
+    if manager == "apt-get":
+        # -y обязательно для install/upgrade/remove
+        if " -y" not in cmd and action in ("install", "upgrade", "remove"):
+            cmd = cmd + " -y"
+        if "DEBIAN_FRONTEND=noninteractive" not in cmd:
+            cmd = "DEBIAN_FRONTEND=noninteractive " + cmd
+    elif action in _NEEDS_YES and " -y" not in cmd and "--assumeyes" not in cmd:
+        cmd = cmd + " -y"
+    return cmd
+
+
+def _merge_key(op: Dict[str, Any]) -> Optional[Tuple[Any, ...]]:
+    if op["action"] not in _MERGEABLE or not op["packages"]:
+        return None
+    return (op["prefix"], op["manager"], op["action"], frozenset(op["flags"]))
+
+
+def merge_ops(ops: List[Dict[str, Any]]) -> str:
+    """Одна команда на все ops (ключ склейки у них общий): пакеты дописываются к первой."""
+    first = ops[0]
+    seen = set(first["packages"])
+    extra = []
+    for op in ops[1:]:
+        for p in op["packages"]:
+            if p not in seen:
+                seen.add(p)
+                extra.append(p)
+    return " ".join([first["cmd"].strip()] + [shlex.quote(p) for p in extra])
+
+
+def merge_commands(cmds: List[str]) -> List[str]:
+    """Подряд идущие install/remove одного менеджера с одинаковыми флагами — одной командой."""
+    if not ENABLED:
+        return cmds
+    out: List[str] = []
+    run: List[Dict[str, Any]] = []
+    for c in cmds + [""]:
+        op = parse(c) if c else None
+        key = _merge_key(op) if op else None
+        if run and (key is None or key != _merge_key(run[0])):
+            out.append(merge_ops(run) if len(run) > 1 else run[0]["cmd"])
+            run = []
+        if key is not None:
+            run.append(op)
+        elif c:
+            out.append(c)
+    return out
+
+
+# -----------------------------
+# Пропуск лишних операций
+# -----------------------------
+
+_LOCK = threading.Lock()
+# (host, user) -> время последнего успешного apt-get update в этом процессе
+_UPDATED: Dict[Tuple[str, str], float] = {}
+
+# каталог lists меняет только update: новые индексы переименовываются в него
+_LISTS_CHECK = "sh -c " + shlex.quote("date +%s; stat -c %Y /var/lib/apt/lists 2>/dev/null; exit 0")
+
+
+def lists_age(
+    host: str, user: str, key_path: Optional[str], password: Optional[str]
+) -> Optional[float]:
+    """Возраст индексов apt на хосте в секундах (по часам хоста) или None."""
+    try:
+        with POOL.session(host, user, key_path=key_path, password=password) as chan:
+            chan.exec_command(_LISTS_CHECK)
+            res = read_channel(chan, CHECK_TIMEOUT_S)
+    except Exception:
+        return None
+    nums = [int(x) for x in res["stdout"].split() if x.isdigit()]
+    if len(nums) != 2:
+        return None
+    return max(0, nums[0] - nums[1])
+
+
+def skip(
+    host: str,
+    user: str,
+    key_path: Optional[str],
+    password: Optional[str],
+    cmd: str,
+) -> Optional[Dict[str, Any]]:
+    """Результат-заглушка, если операцию можно не выполнять; иначе None."""
+    op = parse(cmd) if ENABLED else None
+    if op is None or op["manager"] != "apt-get" or op["action"] != "update":
+        return None
+    if POLICY.check(cmd).kind != "change":
+        return None
+    with _LOCK:
+        last_update = _UPDATED.get((host, user))
+    age = time.time() - last_update if last_update else None
+    if age is None or age > LISTS_TTL_S:
+        age = lists_age(host, user, key_path, password)
+    if age is None or age > LISTS_TTL_S:
+        return None
+    reason = f"package lists are fresh (updated {int(age // 60)} min ago)"
+    return {
+        "ok": True,
+        "cmd": cmd,
+        "exit_code": 0,
+        "stdout": f"[skipped: {reason}]",
+        "stderr": "",
+        "duration_s": 0.0,
+        "skipped": True,
+    }
+
+
+def record(host: str, user: str, cmd: str, ok: Optional[bool]) -> None:
+    """Запоминает успешный apt-get update (для skip)."""
+    op = parse(cmd)
+    if not ok or op is None or op["manager"] != "apt-get" or op["action"] != "update":
+        return
+    with _LOCK:
+        _UPDATED[(host, user)] = time.time()
+
+
+# -----------------------------
+# Склейка одновременных транзакций
+# -----------------------------
+
+
+class Coalescer:
+    """
+    Group commit для install/remove: свободный ключ — команда выполняется
+    сразу. Пока она идёт, новые запросы копятся в следующую пачку; её первый
+    запрос дожидается конца текущей и выполняет одну общую команду.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        # ключ -> {"running": идёт транзакция, "next": копящаяся пачка или None}
+        self._keys: Dict[Tuple[Any, ...], Dict[str, Any]] = {}
+
+    def run(self, target: str, cmd: str, execute: Callable[[str], T]) -> T:
+        op = parse(cmd) if ENABLED else None
+        key = _merge_key(op) if op else None
+        if key is None:
+            return execute(cmd)
+        key = (target,) + key
+        with self._cond:
+            st = self._keys.setdefault(key, {"running": False, "next": None})
+            batch = st["next"]
+            leader = batch is None
+            if leader:
+                batch = {"ops": [], "event": threading.Event()}
+                st["next"] = batch
+            batch["ops"].append(op)
+            if leader:
+                while st["running"]:
+                    self._cond.wait()
+                st["running"] = True
+                st["next"] = None
+        if not leader:
+            batch["event"].wait()
+            if "error" in batch:
+                raise batch["error"]
+            return batch["result"]
+
+        try:
+            batch["result"] = execute(merge_ops(batch["ops"]))
+        except Exception as e:
+            batch["error"] = e
+            raise
+        finally:
+            batch["event"].set()
+            with self._cond:
+                st["running"] = False
+                if st["next"] is None:
+                    del self._keys[key]
+                self._cond.notify_all()
+        return batch["result"]
+
+
+COALESCER = Coalescer()
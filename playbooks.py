@@ -0,0 +1,147 @@
+"""
+Плейбуки: успешные прогоны agent.py, сохранённые как последовательность раундов.
+
+Ключ — нормализованная цель + ОС хоста из bootstrap-фактов (ID и VERSION_ID).
+Когда новый прогон совпал по ключу, планировщик не зовёт LLM, а
+отдаёт записанные раунды по одному. Политика и executor работают как обычно.
+Раунд с изменяющими командами без LLM не повторяется: планировщик получает
+его как предложение (playbook_proposal) и сам решает, выполнять ли его.
+После каждого раунда коды выхода сверяются с записанными. При первом
+расхождении плейбук бросаем, и дальше план снова строит LLM. Прогон, который
+прошёл плейбук до конца, сразу завершается.
+
+В плейбук попадают только раунды, где все команды успешны. Пробы, которые
+не сработали, воспроизводить незачем. Включается AGENT_PLAYBOOKS (по
+умолчанию 1).
+"""
+
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from facts_cache import CACHE_DIR
+
+ENABLED = os.environ.get("AGENT_PLAYBOOKS", "1") != "0"
+
+# служебные слова не меняют смысла цели: "проверь память и диск" == "проверь память, диск"
+_STOPWORDS = {
+    "и", "а", "на", "в", "во", "с", "по", "что", "он", "она", "это", "пожалуйста",
+    "the", "a", "an", "and", "on", "in", "of", "to", "it", "is", "please",
+}
+
+
+def normalize_goal(goal: str) -> str:
+    # порядок слов сохраняем: "установи nginx и удали apache2" != "удали nginx и установи apache2"
+    words = re.findall(r"\w+", goal.lower())
+    return " ".join(w for w in words if w not in _STOPWORDS)
+
+
+def os_signature(facts: Optional[Dict[str, Any]]) -> str:
+    """debian-12 для хоста; для флота — только если у всех одна ОС."""
+    facts = facts or {}
+    os_ = facts.get("os")
+    if not isinstance(os_, dict):
+        return "unknown"
+    if "probed" in facts:
+        # сводка флота: {"Debian GNU/Linux 12 (bookworm)": 50}
+        return "fleet:" + next(iter(os_)) if len(os_) == 1 else "unknown"
+    if os_.get("id"):
+        return f"{os_['id']}-{os_.get('version_id', '')}"
+    return "unknown"
+
+
+def distill(steps: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Шаги прогона -> раунды плейбука: [{"cmds": [...], "exit_codes": [...]}]."""
+    rounds: Dict[Any, List[Dict[str, Any]]] = {}
+    for i, s in enumerate(steps):
+        # итог фоновой задачи (jobs.py) — не команда плана, повторно её не запускают
+        if not s.get("background"):
+            rounds.setdefault(s.get("round", i), []).append(s)
+    out = []
+    for group in rounds.values():
+        if all(s.get("ok") for s in group):
+            out.append(
+                {
+                    "cmds": [s["cmd"] for s in group],
+                    "exit_codes": [s.get("exit_code") for s in group],
+                }
+            )
+    return out
+
+
+def diverged(expected: Dict[str, Any], got: List[Dict[str, Any]]) -> Optional[str]:
+    """Причина расхождения раунда с записью или None."""
+    codes = {s.get("cmd"): s.get("exit_code") for s in got if not s.get("background")}
+    for cmd, code in zip(expected["cmds"], expected["exit_codes"]):
+        if cmd not in codes:
+            return f"`{cmd}` was not executed"
+        if codes[cmd] != code:
+            return f"`{cmd}` exited {codes[cmd]}, recorded {code}"
+    return None
+
+
+class PlaybookStore:
+    def __init__(self, root: Path = CACHE_DIR / "playbooks"):
+        self.root = root
+        self._lock = threading.Lock()
+
+    def key(self, goal: str, facts: Optional[Dict[str, Any]]) -> str:
+        raw = normalize_goal(goal) + "\0" + os_signature(facts)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+
+    def _path(self, key: str) -> Path:
+        return self.root / f"{key}.json"
+
+    def get(self, goal: str, facts: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        path = self._path(self.key(goal, facts))
+        try:
+            pb = json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return None
+        return pb if pb.get("rounds") else None
+
+    def record(
+        self, goal: str, facts: Optional[Dict[str, Any]], steps: List[Dict[str, Any]]
+    ) -> Optional[Dict[str, Any]]:
+        """Новый плейбук из успешного прогона (заменяет прежний с тем же ключом)."""
+        rounds = distill(steps)
+        if not rounds:
+            return None
+        key = self.key(goal, facts)
+        pb = {
+            "id": key,
+            "goal": goal,
+            "goal_key": normalize_goal(goal),
+            "os": os_signature(facts),
+            "rounds": rounds,
+            "created": time.time(),
+            "replays": 0,
+        }
+        self._save(key, pb)
+        return pb
+
+    def replayed(self, key: str) -> None:
+        with self._lock:
+            path = self._path(key)
+            try:
+                pb = json.loads(path.read_text(encoding="utf-8"))
+            except (OSError, ValueError):
+                return
+            pb["replays"] = pb.get("replays", 0) + 1
+            pb["last_replay"] = time.time()
+            self._save(key, pb)
+
+    def _save(self, key: str, pb: Dict[str, Any]) -> None:
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp.write_text(json.dumps(pb, ensure_ascii=False, indent=1), encoding="utf-8")
+        os.replace(tmp, path)
+
+
+PLAYBOOKS = PlaybookStore()
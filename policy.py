@@ -0,0 +1,201 @@
+"""
+Единый движок политики для agent.py и agent_tc.py.
+
+Правила грузятся из JSON/YAML-файла (по умолчанию policy.json рядом с модулем)
+и компилируются в:
+- один общий regex с именованными группами для всех deny-правил;
+- префиксное дерево (trie) для readonly/change-префиксов.
+
+Фиксированные многострочные скрипты (bootstrap-проба) не пройдут deny-правила
+про ; и |, поэтому их одобряют точечно: запись в "trusted" с sha256 полного
+текста команды и её классом. Любое изменение скрипта хэш ломает.
+
+Allowlist сверяется с командой буквально: `sudo tail /etc/shadow` или
+`LD_PRELOAD=... uname` не readonly, а unknown. Обвязка из sudo и безопасных
+переменных (WRAPPER_ENV) допускается только перед change-командой —
+`DEBIAN_FRONTEND=noninteractive sudo apt-get install` остаётся change.
+
+check() за один проход возвращает вердикт и сработавшее правило. Файл
+перечитывается при изменении mtime (не чаще раза в RELOAD_CHECK_S).
+"""
+
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, List, Literal, Optional, Tuple
+
+from runlog import get_run_logger
+
+POLICY_PATH = Path(
+    os.environ.get("AGENT_POLICY", Path(__file__).with_name("policy.json"))
+)
+RELOAD_CHECK_S = 1.0
+
+Kind = Literal["readonly", "change", "unknown", "deny"]
+
+_ENV_ASSIGN = re.compile(r"^(?:[A-Za-z_][A-Za-z0-9_]*=\S*\s+)+")
+# переменные, которые можно ставить перед change-командой (не меняют, что запускается)
+WRAPPER_ENV = frozenset({"DEBIAN_FRONTEND", "LC_ALL", "LANG"})
+
+
+def normalize_command(cmd: str) -> str:
+    """Срезает VAR=value и sudo в начале: `DEBIAN_FRONTEND=... sudo apt-get` -> `apt-get`."""
+    c = cmd.strip()
+    while True:
+        c2 = _ENV_ASSIGN.sub("", c)
+        if c2.startswith("sudo "):
+            c2 = c2[len("sudo ") :].lstrip()
+        if c2 == c:
+            return c
+        c = c2
+
+
+def _safe_wrapper(prefix: str) -> bool:
+    """Обвязка из sudo и VAR=value только с переменными из WRAPPER_ENV."""
+    for tok in prefix.split():
+        if tok != "sudo" and tok.split("=", 1)[0] not in WRAPPER_ENV:
+            return False
+    return True
+
+
+@dataclass(frozen=True)
+class Verdict:
+    kind: Kind
+    rule: Optional[str] = None  # id deny-правила или сработавший префикс
+    reason: Optional[str] = None
+
+    @property
+    def denied(self) -> bool:
+        return self.kind == "deny"
+
+
+class _Trie:
+    __slots__ = ("root",)
+
+    def __init__(self, entries: List[Tuple[str, str]]):
+        # узел: dict символ -> узел; терминальная метка под ключом None
+        self.root: Dict[Any, Any] = {}
+        for prefix, label in entries:
+            node = self.root
+            for ch in prefix:
+                node = node.setdefault(ch, {})
+            node.setdefault(None, (label, prefix))
+
+    def longest(self, s: str) -> Optional[Tuple[str, str]]:
+        node = self.root
+        best = node.get(None)
+        for ch in s:
+            node = node.get(ch)
+            if node is None:
+                break
+            best = node.get(None, best)
+        return best
+
+
+class CompiledPolicy:
+    def __init__(self, rules: Dict[str, Any]):
+        self.deny_rules: Dict[str, Dict[str, Any]] = {}
+        parts = []
+        for i, r in enumerate(rules.get("deny", [])):
+            group = f"r{i}"  # id правила может быть не python-идентификатором
+            if "pattern" in r:
+                pat = r["pattern"]
+                re.compile(pat)  # ошибка в правиле должна указывать на правило
+            else:
+                pat = re.escape(r["substring"])
+            parts.append(f"(?P<{group}>{pat})")
+            self.deny_rules[group] = r
+        self.deny_re = re.compile("|".join(parts)) if parts else None
+
+        # sha256 точного текста команды -> (класс, id записи)
+        self.trusted: Dict[str, Tuple[Kind, str]] = {
+            t["sha256"]: (t.get("kind", "readonly"), t["id"]) for t in rules.get("trusted", [])
+        }
+
+        entries = [(p, "readonly") for p in rules.get("readonly", [])]
+        entries += [(p, "change") for p in rules.get("change", [])]
+        self.trie = _Trie(entries)
+
+    def check(self, cmd: str) -> Verdict:
+        c = cmd.strip()
+        if not c:
+            return Verdict("deny", "empty", "Empty command")
+
+        if self.trusted:
+            hit = self.trusted.get(hashlib.sha256(c.encode("utf-8")).hexdigest())
+            if hit:
+                return Verdict(hit[0], f"trusted:{hit[1]}")
+
+        if self.deny_re is not None:
+            m = self.deny_re.search(c)
+            if m:
+                r = self.deny_rules[m.lastgroup]
+                reason = r.get("reason") or f"Command denied by policy (rule: {r['id']})"
+                return Verdict("deny", r["id"], reason)
+
+        hit = self.trie.longest(c)
+        if hit is None:
+            # sudo/VAR=... не наследуют readonly голой команды: обвязка меняет,
+            # что и с какими правами запустится. Пропускаем её только для change.
+            bare = normalize_command(c)
+            if bare != c and _safe_wrapper(c[: len(c) - len(bare)]):
+                hit = self.trie.longest(bare)
+                if hit is not None and hit[0] == "change":
+                    return Verdict("change", hit[1])
+            return Verdict("unknown")
+        kind, prefix = hit
+        return Verdict(kind, prefix)
+
+
+def load_rules(path: Path) -> Dict[str, Any]:
+    text = path.read_text(encoding="utf-8")
+    if path.suffix in (".yaml", ".yml"):
+        import yaml  # опционально: только для YAML-файлов правил
+
+        return yaml.safe_load(text) or {}
+    return json.loads(text)
+
+
+class PolicyEngine:
+    def __init__(self, path: Path = POLICY_PATH):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._mtime = self.path.stat().st_mtime
+        self._compiled = CompiledPolicy(load_rules(self.path))
+        self._next_check = time.monotonic() + RELOAD_CHECK_S
+
+    def _maybe_reload(self) -> None:
+        now = time.monotonic()
+        if now < self._next_check:
+            return
+        with self._lock:
+            if now < self._next_check:
+                return
+            self._next_check = now + RELOAD_CHECK_S
+            try:
+                mtime = self.path.stat().st_mtime
+            except OSError:
+                return
+            if mtime == self._mtime:
+                return
+            self._mtime = mtime
+            try:
+                self._compiled = CompiledPolicy(load_rules(self.path))
+            except (ValueError, re.error, KeyError) as e:
+                # битый файл правил не должен ронять агента — работаем на старых
+                get_run_logger().log(
+                    "policy_reload_error",
+                    {"path": str(self.path), "type": type(e).__name__, "error": str(e)},
+                )
+
+    def check(self, cmd: str) -> Verdict:
+        self._maybe_reload()
+        return self._compiled.check(cmd)
+
+
+POLICY = PolicyEngine()
@@ -0,0 +1,116 @@
+"""
+Потоковый отчёт о прогоне: каждый шаг дописывается в Markdown и в
+JSONL-сайдкар сразу после выполнения, а не рендерится целиком в конце.
+
+    reports/report_<host>_<run>.md      — заголовок, шаги, в конце сводка
+    reports/report_<host>_<run>.jsonl   — по строке JSON на шаг
+    reports/report_<host>_<run>/        — полные выводы, не влезшие в отчёт
+
+Вывод длиннее SPILL_BYTES уходит в отдельный файл, в отчёте и в памяти
+остаются только начало и конец со ссылкой. Если процесс упал, отчёт до последнего
+шага уже на диске; finalize() лишь дописывает сводку.
+"""
+
+import json
+import os
+import re
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+REPORT_DIR = Path(os.environ.get("AGENT_REPORT_DIR", "reports"))
+SPILL_BYTES = int(os.environ.get("AGENT_REPORT_SPILL_BYTES", "8192"))
+PREVIEW_CHARS = 2000
+FSYNC = os.environ.get("AGENT_REPORT_FSYNC", "1") != "0"
+
+# (номер шага, шаг) -> строки Markdown
+StepRenderer = Callable[[int, Dict[str, Any]], List[str]]
+
+
+def report_path(host: str, hosts: Optional[List[str]], run_id: Optional[str]) -> Path:
+    """Имя отчёта; с run_id оно стабильно, и --resume дописывает тот же файл."""
+    name = f"fleet-{len(hosts)}" if hosts else host
+    name = re.sub(r"[^\w.:-]", "_", name)
+    suffix = run_id or datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+    return REPORT_DIR / f"report_{name}_{suffix}.md"
+
+
+def _append(path: Path, text: str) -> None:
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(text)
+        f.flush()
+        if FSYNC:
+            os.fsync(f.fileno())
+
+
+class ReportWriter:
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.sidecar = self.path.with_suffix(".jsonl")
+        self.out_dir = self.path.with_suffix("")
+        # после --resume нумерация продолжается
+        self.steps = sum(1 for _ in self._lines()) if self.sidecar.exists() else 0
+
+    @classmethod
+    def create(cls, path: Path, header: List[str]) -> "ReportWriter":
+        path = Path(path)
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            _append(path, "\n".join(header) + "\n\n")
+        return cls(path)
+
+    def _lines(self) -> Iterator[str]:
+        with open(self.sidecar, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield line
+
+    def read_steps(self) -> List[Dict[str, Any]]:
+        """Шаги из сайдкара (выводы — в урезанном виде, как в отчёте)."""
+        if not self.sidecar.exists():
+            return []
+        return [json.loads(line) for line in self._lines()]
+
+    def _spill(self, name: str, text: str) -> Optional[str]:
+        if len(text.encode("utf-8")) <= SPILL_BYTES:
+            return None
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        (self.out_dir / name).write_text(text, encoding="utf-8")
+        return f"{self.out_dir.name}/{name}"
+
+    def _slim(self, prefix: str, item: Dict[str, Any]) -> Dict[str, Any]:
+        out = dict(item)
+        for stream in ("stdout", "stderr"):
+            text = item.get(stream) or ""
+            ref = self._spill(f"{prefix}.{stream}", text)
+            if ref:
+                # начало и конец: у логов и apt самое важное обычно в хвосте
+                half = PREVIEW_CHARS // 2
+                out[stream] = f"{text[:half]}\n[... full output: {ref} ...]\n{text[-half:]}"
+                out[f"{stream}_file"] = ref
+        return out
+
+    def add_step(self, step: Dict[str, Any], render: StepRenderer) -> Dict[str, Any]:
+        """
+        Дописывает шаг в отчёт и сайдкар. Возвращает копию шага, где длинные
+        выводы заменены началом, концом и ссылкой на файл, — её и стоит держать в памяти.
+        """
+        self.steps += 1
+        prefix = f"step-{self.steps:03d}"
+        slim = self._slim(prefix, step)
+        if step.get("groups"):
+            slim["groups"] = [
+                self._slim(f"{prefix}.g{i}", g) for i, g in enumerate(step["groups"], 1)
+            ]
+
+        _append(self.path, "\n".join(render(self.steps, slim)) + "\n")
+        _append(self.sidecar, json.dumps(slim, ensure_ascii=False, default=str) + "\n")
+        return slim
+
+    def add_section(self, title: str, lines: List[str]) -> None:
+        """Раздел вне нумерации шагов (например, факты bootstrap-пробы); в сайдкар не идёт."""
+        _append(self.path, "\n".join([f"## {title}", ""] + lines) + "\n\n")
+
+    def finalize(self, summary: List[str]) -> Path:
+        _append(self.path, "\n".join(["## Summary", ""] + summary) + "\n\n")
+        return self.path
@@ -0,0 +1,504 @@
+"""
+Журнал событий прогона (agent_run.log) с фоновой записью.
+
+log() только кладёт запись в очередь; отдельный поток пишет пачками
+одним write(), fsync — не чаще раза в FSYNC_S секунд, эхо в stdout (если
+включено) — тоже из этого потока. Строки разных потоков не перемешиваются.
+
+Формат (AGENT_LOG_FORMAT): jsonl (по умолчанию) или msgpack — кадры
+<длина u32 BE><ormsgpack>. Новый процесс дописывает в текущий сегмент;
+файл ротируется только по размеру (AGENT_LOG_MAX_MB) или при смене формата:
+agent_run.log -> agent_run.log.000001, ...; хранится AGENT_LOG_KEEP
+старых сегментов. Запись пачки, её индекс и ротация идут под flock
+(<журнал>.lock), так что несколько процессов могут писать в один журнал.
+Если поток записи упал, ошибка печатается в stderr, а log() дальше пишет
+синхронно.
+
+Рядом с каждым сегментом — индекс <сегмент>.idx: по строке JSON на пачку
+(смещение, длина, min/max ts, множества run_id/host/event). Запрос читает
+индексы и с диска только подходящие пачки:
+
+    python runlog.py query --run 20260301-101500-ab12cd --host web1 --event ssh_done
+    python runlog.py query --since 2026-03-01T10:00 --until 2026-03-01T11:00
+    python runlog.py reindex agent_run.log.000003
+"""
+
+import atexit
+import contextlib
+import contextvars
+import glob
+import json
+import os
+import queue
+import struct
+import sys
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional
+
+import ormsgpack
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows: без межпроцессной блокировки
+    fcntl = None  # type: ignore[assignment]
+
+LOG_PATH = os.environ.get("AGENT_LOG", "agent_run.log")
+LOG_FORMAT = os.environ.get("AGENT_LOG_FORMAT", "jsonl")
+MAX_BYTES = int(float(os.environ.get("AGENT_LOG_MAX_MB", "64")) * 1024 * 1024)
+KEEP_SEGMENTS = int(os.environ.get("AGENT_LOG_KEEP", "20"))
+FLUSH_S = float(os.environ.get("AGENT_LOG_FLUSH_MS", "200")) / 1000
+FSYNC_S = float(os.environ.get("AGENT_LOG_FSYNC_S", "1.0"))
+ECHO = os.environ.get("AGENT_LOG_STDOUT", "1") != "0"
+BATCH_MAX = 512
+
+# run_id текущего прогона: попадает в каждую запись и в индекс
+RUN_ID: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("run_id", default=None)
+
+
+# -------------------------
+# Encoders
+# -------------------------
+
+
+class JsonlEncoder:
+    name = "jsonl"
+
+    def encode(self, rec: Dict[str, Any]) -> bytes:
+        return (json.dumps(rec, ensure_ascii=False, default=str) + "\n").encode("utf-8")
+
+    def decode(self, data: bytes) -> Iterator[Dict[str, Any]]:
+        for line in data.splitlines():
+            if line.strip():
+                yield json.loads(line)
+
+
+class MsgpackEncoder:
+    name = "msgpack"
+    _len = struct.Struct(">I")
+
+    def encode(self, rec: Dict[str, Any]) -> bytes:
+        body = ormsgpack.packb(rec, default=str)
+        return self._len.pack(len(body)) + body
+
+    def decode(self, data: bytes) -> Iterator[Dict[str, Any]]:
+        pos = 0
+        while pos + 4 <= len(data):
+            (n,) = self._len.unpack_from(data, pos)
+            pos += 4
+            yield ormsgpack.unpackb(data[pos : pos + n])
+            pos += n
+
+
+ENCODERS = {e.name: e for e in (JsonlEncoder(), MsgpackEncoder())}
+
+
+def _sniff(path: str) -> str:
+    # для сегмента без индекса: JSONL начинается с "{"
+    with open(path, "rb") as f:
+        return "jsonl" if f.read(1) in (b"{", b"") else "msgpack"
+
+
+# -------------------------
+# Writer
+# -------------------------
+
+
+def _block_index(recs: List[Dict[str, Any]], off: int, size: int, fmt: str) -> Dict[str, Any]:
+    ts = [r["ts"] for r in recs]
+    return {
+        "off": off,
+        "len": size,
+        "n": len(recs),
+        "fmt": fmt,
+        "ts": [min(ts), max(ts)],
+        "run": sorted({r["run_id"] for r in recs if r.get("run_id")}),
+        "host": sorted({str(r["host"]) for r in recs if r.get("host")}),
+        "event": sorted({r["event"] for r in recs}),
+    }
+
+
+class RunLogger:
+    def __init__(
+        self,
+        path: str = LOG_PATH,
+        fmt: str = LOG_FORMAT,
+        max_bytes: int = MAX_BYTES,
+        keep: int = KEEP_SEGMENTS,
+        echo: bool = ECHO,
+    ):
+        self.path = path
+        self.encoder = ENCODERS[fmt]
+        self.max_bytes = max_bytes
+        self.keep = keep
+        self.echo = echo
+        self._q: "queue.SimpleQueue[Any]" = queue.SimpleQueue()
+        self._fh = None
+        self._idx = None
+        self._lockfh = None
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._closed = False
+        # исключение, на котором умер поток записи: дальше пишем синхронно
+        self.error: Optional[BaseException] = None
+
+    def log(self, event: str, data: Dict[str, Any]) -> None:
+        rec = {"ts": time.time(), "event": event}
+        run_id = RUN_ID.get()
+        if run_id and "run_id" not in data:
+            rec["run_id"] = run_id
+        rec.update(data)
+        if self._thread is None:
+            self._start()
+        self._q.put(rec)
+        if self.error is not None:
+            self._drain()
+
+    def flush(self, timeout: float = 10.0) -> None:
+        """Дождаться, пока всё, что в очереди, окажется на диске."""
+        if self._thread is None:
+            return
+        if self.error is not None:
+            self._drain()
+            return
+        done = threading.Event()
+        self._q.put(done)
+        done.wait(timeout)
+
+    def close(self) -> None:
+        if self._thread is None or self._closed:
+            return
+        self._closed = True
+        self._q.put(None)
+        self._thread.join(10.0)
+        if self.error is not None:
+            self._drain()
+
+    # ---- поток записи ----
+
+    def _start(self) -> None:
+        with self._start_lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._loop, name="runlog", daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+
+    @contextlib.contextmanager
+    def _locked(self) -> Iterator[None]:
+        # несколько процессов пишут в один журнал: запись, индекс и ротация — под flock
+        if fcntl is None:
+            yield
+            return
+        if self._lockfh is None:
+            self._lockfh = open(self.path + ".lock", "a")
+        fcntl.flock(self._lockfh.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lockfh.fileno(), fcntl.LOCK_UN)
+
+    def _open(self) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with self._locked():
+            # дописываем в текущий сегмент; новый — только по размеру, при смене
+            # формата или если сегмент оборван и индекс не восстановить
+            size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+            if size >= self.max_bytes or (size and _sniff(self.path) != self.encoder.name):
+                self._rotate()
+            elif size and _indexed_bytes(self.path) != size:
+                try:
+                    reindex(self.path)
+                except Exception:
+                    self._rotate()
+            self._reopen()
+
+    def _reopen(self) -> None:
+        self._close_files()
+        # без буфера: одна пачка — один write() в конец файла (O_APPEND)
+        self._fh = open(self.path, "ab", buffering=0)
+        self._idx = open(self.path + ".idx", "a", encoding="utf-8")
+
+    def _close_files(self) -> None:
+        for f in (self._fh, self._idx):
+            if f is not None:
+                try:
+                    f.close()
+                except OSError:
+                    pass
+        self._fh = self._idx = None
+
+    def _rotate(self) -> None:
+        """Активный файл -> следующий номер сегмента; вызывается под _locked()."""
+        if not os.path.exists(self.path):
+            return
+        segs = segments(self.path)[:-1]
+        last = int(segs[-1].rsplit(".", 1)[1]) if segs else 0
+        dst = f"{self.path}.{last + 1:06d}"
+        os.replace(self.path, dst)
+        if os.path.exists(self.path + ".idx"):
+            os.replace(self.path + ".idx", dst + ".idx")
+        for old in (segs + [dst])[: -self.keep] if self.keep > 0 else []:
+            for p in (old, old + ".idx"):
+                if os.path.exists(p):
+                    os.remove(p)
+
+    def _sync(self) -> None:
+        self._idx.flush()
+        os.fsync(self._fh.fileno())
+        os.fsync(self._idx.fileno())
+
+    def _write(self, recs: List[Dict[str, Any]]) -> None:
+        data = b"".join(self.encoder.encode(r) for r in recs)
+        with self._locked():
+            if _stale(self._fh, self.path):
+                # сегмент ротировал другой процесс — пишем в новый активный файл
+                self._reopen()
+            self._fh.write(data)
+            end = self._fh.tell()
+            self._idx.write(
+                json.dumps(_block_index(recs, end - len(data), len(data), self.encoder.name)) + "\n"
+            )
+            self._idx.flush()
+            if end >= self.max_bytes:
+                self._sync()
+                self._close_files()
+                self._rotate()
+                self._reopen()
+        if self.echo:
+            out = (
+                data.decode("utf-8")
+                if self.encoder.name == "jsonl"
+                else "".join(JsonlEncoder().encode(r).decode("utf-8") for r in recs)
+            )
+            sys.stdout.write(out)
+            sys.stdout.flush()
+
+    def _loop(self) -> None:
+        try:
+            self._run()
+        except BaseException as e:
+            with self._write_lock:
+                self._close_files()
+                self.error = e
+            print(f"runlog: writer thread failed, logging synchronously: {e!r}", file=sys.stderr)
+            self._drain()
+
+    def _run(self) -> None:
+        self._open()
+        last_sync = time.monotonic()
+        dirty = False
+        while True:
+            try:
+                items = [self._q.get(timeout=FLUSH_S)]
+            except queue.Empty:
+                items = []
+            while items and len(items) < BATCH_MAX:
+                try:
+                    items.append(self._q.get_nowait())
+                except queue.Empty:
+                    break
+
+            recs = [x for x in items if isinstance(x, dict)]
+            if recs:
+                self._write(recs)
+                dirty = True
+            waiters = [x for x in items if isinstance(x, threading.Event)]
+            stop = any(x is None for x in items)
+            if dirty and (waiters or stop or time.monotonic() - last_sync >= FSYNC_S):
+                self._sync()
+                last_sync = time.monotonic()
+                dirty = False
+            for w in waiters:
+                w.set()
+            if stop:
+                self._close_files()
+                return
+
+    def _drain(self) -> None:
+        """Запись без потока: всё из очереди — сразу на диск в вызывающем потоке."""
+        with self._write_lock:
+            items = []
+            while True:
+                try:
+                    items.append(self._q.get_nowait())
+                except queue.Empty:
+                    break
+            recs = [x for x in items if isinstance(x, dict)]
+            try:
+                if recs:
+                    if self._fh is None:
+                        self._open()
+                    self._write(recs)
+                    self._sync()
+            finally:
+                for x in items:
+                    if isinstance(x, threading.Event):
+                        x.set()
+            if self._closed:
+                self._close_files()
+
+
+def _stale(fh: Any, path: str) -> bool:
+    """Файл открыт на сегменте, который уже не активный (ротирован другим процессом)."""
+    try:
+        return os.fstat(fh.fileno()).st_ino != os.stat(path).st_ino
+    except FileNotFoundError:
+        return True
+
+
+def _indexed_bytes(seg: str) -> int:
+    """Сколько байт сегмента покрыто индексом (конец последней пачки)."""
+    end = 0
+    try:
+        with open(seg + ".idx", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    b = json.loads(line)
+                    end = max(end, b["off"] + b["len"])
+    except (OSError, ValueError, KeyError):
+        return -1
+    return end
+
+
+_LOGGER: Optional[RunLogger] = None
+_LOGGER_LOCK = threading.Lock()
+
+
+def get_run_logger() -> RunLogger:
+    global _LOGGER
+    with _LOGGER_LOCK:
+        if _LOGGER is None:
+            _LOGGER = RunLogger()
+        return _LOGGER
+
+
+# -------------------------
+# Index / query
+# -------------------------
+
+
+def segments(path: str = LOG_PATH) -> List[str]:
+    """Сегменты журнала от старых к новым; активный файл — последним."""
+    rotated = sorted(
+        p for p in glob.glob(glob.escape(path) + ".*") if p.rsplit(".", 1)[1].isdigit()
+    )
+    return rotated + ([path] if os.path.exists(path) else [])
+
+
+def reindex(seg: str, block: int = BATCH_MAX) -> int:
+    """Перестроить индекс сегмента полным чтением (индекс потерян или отстал)."""
+    fmt = _sniff(seg)
+    with open(seg, "rb") as f:
+        data = f.read()
+    enc = ENCODERS[fmt]
+    entries = []
+    if fmt == "jsonl":
+        off, recs, start = 0, [], 0
+        for line in data.splitlines(keepends=True):
+            if line.strip():
+                recs.append(json.loads(line))
+            off += len(line)
+            if len(recs) >= block:
+                entries.append(_block_index(recs, start, off - start, fmt))
+                recs, start = [], off
+        if recs:
+            entries.append(_block_index(recs, start, off - start, fmt))
+    else:
+        recs = list(enc.decode(data))
+        # длина кадров известна только при разборе — пишем один блок на сегмент
+        if recs:
+            entries.append(_block_index(recs, 0, len(data), fmt))
+    with open(seg + ".idx", "w", encoding="utf-8") as f:
+        for e in entries:
+            f.write(json.dumps(e) + "\n")
+    return len(entries)
+
+
+def _blocks(seg: str) -> Iterator[Dict[str, Any]]:
+    idx = seg + ".idx"
+    if not os.path.exists(idx):
+        reindex(seg)
+    with open(idx, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def query(
+    path: str = LOG_PATH,
+    run_id: Optional[str] = None,
+    host: Optional[str] = None,
+    event: Optional[str] = None,
+    since: Optional[float] = None,
+    until: Optional[float] = None,
+) -> Iterator[Dict[str, Any]]:
+    for seg in segments(path):
+        with open(seg, "rb") as f:
+            for b in _blocks(seg):
+                if since is not None and b["ts"][1] < since:
+                    continue
+                if until is not None and b["ts"][0] > until:
+                    continue
+                if run_id and run_id not in b["run"]:
+                    continue
+                if host and host not in b["host"]:
+                    continue
+                if event and event not in b["event"]:
+                    continue
+                f.seek(b["off"])
+                for rec in ENCODERS[b["fmt"]].decode(f.read(b["len"])):
+                    if since is not None and rec["ts"] < since:
+                        continue
+                    if until is not None and rec["ts"] > until:
+                        continue
+                    if run_id and rec.get("run_id") != run_id:
+                        continue
+                    if host and str(rec.get("host")) != host:
+                        continue
+                    if event and rec["event"] != event:
+                        continue
+                    yield rec
+
+
+def _parse_time(value: Optional[str]) -> Optional[float]:
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    p = argparse.ArgumentParser(description="Поиск по журналу прогонов")
+    sub = p.add_subparsers(dest="cmd", required=True)
+    q = sub.add_parser("query")
+    q.add_argument("--log", default=LOG_PATH)
+    q.add_argument("--run")
+    q.add_argument("--host")
+    q.add_argument("--event")
+    q.add_argument("--since", help="unix-время или ISO 8601 (локальное)")
+    q.add_argument("--until")
+    r = sub.add_parser("reindex")
+    r.add_argument("segment", nargs="*")
+    r.add_argument("--log", default=LOG_PATH)
+    args = p.parse_args()
+
+    if args.cmd == "reindex":
+        for seg in args.segment or segments(args.log):
+            print(f"{seg}: {reindex(seg)} blocks")
+    else:
+        for rec in query(
+            args.log,
+            run_id=args.run,
+            host=args.host,
+            event=args.event,
+            since=_parse_time(args.since),
+            until=_parse_time(args.until),
+        ):
+            print(json.dumps(rec, ensure_ascii=False, default=str))
@@ -0,0 +1,318 @@
+"""
+Пул SSH-соединений: один аутентифицированный Transport на (host, user, auth),
+новая дешёвая сессия (channel) на каждую команду.
+"""
+
+import asyncio
+import atexit
+import contextvars
+import functools
+import hashlib
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, TypeVar
+
+import paramiko
+
+SSH_KEEPALIVE_S = int(os.environ.get("SSH_KEEPALIVE", "15"))
+SSH_IDLE_TIMEOUT_S = float(os.environ.get("SSH_IDLE_TIMEOUT", "300"))
+SSH_MAX_CHANNELS = int(os.environ.get("SSH_MAX_CHANNELS", "8"))  # OpenSSH MaxSessions=10
+SSH_CONNECT_TIMEOUT_S = float(os.environ.get("SSH_CONNECT_TIMEOUT", "10"))
+# потоки под блокирующий paramiko для async-пути: сколько SSH-вызовов идут одновременно
+SSH_IO_WORKERS = int(os.environ.get("SSH_IO_WORKERS", "64"))
+# сколько изменяющая команда ждёт, пока другой прогон меняет тот же хост
+CHANGE_LOCK_TIMEOUT_S = float(os.environ.get("AGENT_CHANGE_LOCK_TIMEOUT", "1800"))
+
+PoolKey = Tuple[str, int, str, str]
+T = TypeVar("T")
+
+
+def split_host(host: str) -> Tuple[str, int]:
+    """'host' или 'host:port' -> (host, port)."""
+    if host.count(":") == 1:
+        name, port = host.rsplit(":", 1)
+        if port.isdigit():
+            return name, int(port)
+    return host, 22
+
+
+def _auth_id(key_path: Optional[str], password: Optional[str]) -> str:
+    # пароль в ключ пула кладём только в виде хэша
+    if key_path:
+        return "key:" + key_path
+    if password is not None:
+        return "pw:" + hashlib.sha256(password.encode()).hexdigest()[:16]
+    return "none"
+
+
+class _Conn:
+    def __init__(self, client: paramiko.SSHClient, max_channels: int):
+        self.client = client
+        self.slots = threading.BoundedSemaphore(max_channels)
+        self.active = 0
+        self.last_used = time.monotonic()
+
+    @property
+    def transport(self) -> Optional[paramiko.Transport]:
+        return self.client.get_transport()
+
+    def alive(self) -> bool:
+        t = self.transport
+        return t is not None and t.is_active()
+
+    def close(self) -> None:
+        try:
+            self.client.close()
+        except Exception:
+            pass
+
+
+class SSHPool:
+    def __init__(
+        self,
+        keepalive: int = SSH_KEEPALIVE_S,
+        idle_timeout: float = SSH_IDLE_TIMEOUT_S,
+        max_channels: int = SSH_MAX_CHANNELS,
+        connect_timeout: float = SSH_CONNECT_TIMEOUT_S,
+    ):
+        self.keepalive = keepalive
+        self.idle_timeout = idle_timeout
+        self.max_channels = max_channels
+        self.connect_timeout = connect_timeout
+
+        self._lock = threading.Lock()
+        self._conns: Dict[PoolKey, _Conn] = {}
+        # отдельный лок на ключ, чтобы параллельные хосты коннектились параллельно
+        self._key_locks: Dict[PoolKey, threading.Lock] = {}
+        self._reaper: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    # ---- connections ----
+
+    def _connect(
+        self,
+        host: str,
+        port: int,
+        user: str,
+        key_path: Optional[str],
+        password: Optional[str],
+        **connect_opts: Any,
+    ) -> _Conn:
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+
+        connect_kwargs: Dict[str, Any] = {
+            "hostname": host,
+            "port": port,
+            "username": user,
+            "timeout": self.connect_timeout,
+            **connect_opts,
+        }
+        if key_path:
+            connect_kwargs["key_filename"] = key_path
+        else:
+            connect_kwargs["password"] = password
+
+        ssh.connect(**connect_kwargs)
+        transport = ssh.get_transport()
+        if transport is not None:
+            if self.keepalive > 0:
+                transport.set_keepalive(self.keepalive)
+            # мелкие пакеты (exec-request, exit-status) не должны ждать Nagle/delayed ACK
+            try:
+                transport.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            except (OSError, AttributeError):
+                pass
+        return _Conn(ssh, self.max_channels)
+
+    def _get(
+        self,
+        host: str,
+        user: str,
+        key_path: Optional[str],
+        password: Optional[str],
+        **connect_opts: Any,
+    ) -> _Conn:
+        name, port = split_host(host)
+        key: PoolKey = (name, port, user, _auth_id(key_path, password))
+
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+            self._ensure_reaper()
+
+        with key_lock:
+            with self._lock:
+                conn = self._conns.get(key)
+            if conn is not None and conn.alive():
+                return conn
+            if conn is not None:
+                # транспорт умер (сеть, рестарт sshd) — переподключаемся
+                conn.close()
+
+            conn = self._connect(name, port, user, key_path, password, **connect_opts)
+            with self._lock:
+                self._conns[key] = conn
+            return conn
+
+    def _drop(self, conn: _Conn) -> None:
+        with self._lock:
+            for k, c in list(self._conns.items()):
+                if c is conn:
+                    del self._conns[k]
+        conn.close()
+
+    @contextmanager
+    def session(
+        self,
+        host: str,
+        user: str,
+        key_path: Optional[str] = None,
+        password: Optional[str] = None,
+        **connect_opts: Any,
+    ) -> Iterator[paramiko.Channel]:
+        """
+        Открывает новую сессию поверх живого соединения к хосту.
+        Если транспорт оказался мёртвым — один раз переподключается.
+        """
+        conn: Optional[_Conn] = self._acquire(host, user, key_path, password, **connect_opts)
+        try:
+            try:
+                chan = conn.transport.open_session(timeout=self.connect_timeout)
+            except (paramiko.SSHException, EOFError, OSError, AttributeError):
+                self._release(conn)
+                self._drop(conn)
+                # слот уже отдан: если переподключение упадёт, finally его не трогает
+                conn = None
+                conn = self._acquire(host, user, key_path, password, **connect_opts)
+                chan = conn.transport.open_session(timeout=self.connect_timeout)
+
+            try:
+                yield chan
+            finally:
+                chan.close()
+        finally:
+            if conn is not None:
+                self._release(conn)
+
+    def _acquire(self, host, user, key_path, password, **connect_opts) -> _Conn:
+        conn = self._get(host, user, key_path, password, **connect_opts)
+        conn.slots.acquire()  # лимит одновременно открытых каналов
+        with self._lock:
+            conn.active += 1
+        return conn
+
+    def _release(self, conn: _Conn) -> None:
+        with self._lock:
+            conn.active -= 1
+            conn.last_used = time.monotonic()
+        conn.slots.release()
+
+    # ---- idle eviction ----
+
+    def _ensure_reaper(self) -> None:
+        if self._reaper is not None or self.idle_timeout <= 0:
+            return
+        self._reaper = threading.Thread(
+            target=self._reap_loop, name="ssh-pool-reaper", daemon=True
+        )
+        self._reaper.start()
+
+    def _reap_loop(self) -> None:
+        interval = max(1.0, min(30.0, self.idle_timeout / 4))
+        while not self._stop.wait(interval):
+            self.evict_idle()
+
+    def evict_idle(self) -> int:
+        now = time.monotonic()
+        victims = []
+        with self._lock:
+            for k, c in list(self._conns.items()):
+                idle = c.active == 0 and now - c.last_used > self.idle_timeout
+                if idle or not c.alive():
+                    victims.append(c)
+                    del self._conns[k]
+        for c in victims:
+            c.close()
+        return len(victims)
+
+    def close_all(self) -> None:
+        self._stop.set()
+        with self._lock:
+            conns = list(self._conns.values())
+            self._conns.clear()
+        for c in conns:
+            c.close()
+
+
+# Общий пул процесса: используется и agent.run_ssh, и agent_tc._ssh_exec
+POOL = SSHPool()
+atexit.register(POOL.close_all)
+
+# Один ограниченный пул потоков на процесс: сотни async-сессий делят его,
+# а не плодят по потоку на каждую команду
+SSH_EXECUTOR = ThreadPoolExecutor(max_workers=SSH_IO_WORKERS, thread_name_prefix="ssh-io")
+
+
+async def run_blocking(fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """Выполнить блокирующий SSH-вызов из корутины на SSH_EXECUTOR."""
+    loop = asyncio.get_running_loop()
+    ctx = contextvars.copy_context()  # как asyncio.to_thread: run_id журнала и т.п.
+    call = functools.partial(ctx.run, fn, *args, **kwargs)
+    return await loop.run_in_executor(SSH_EXECUTOR, call)
+
+
+# -------------------------
+# Change locks
+# -------------------------
+
+
+class HostLocks:
+    """
+    Изменяющие команды на хосте — по одной между прогонами процесса (batch.py
+    гоняет много сессий agent_tc разом). Владелец — объект сессии, а не поток:
+    tool calls одной сессии идут из разных потоков, а фоновая задача держит
+    хост от запуска до итога. Повторный захват тем же владельцем проходит сразу.
+    """
+
+    def __init__(self) -> None:
+        self._cond = threading.Condition()
+        self._owners: Dict[str, Tuple[Any, int]] = {}  # host -> (владелец, глубина)
+
+    def acquire(self, hosts: List[str], owner: Any, timeout: Optional[float] = None) -> bool:
+        """Все хосты разом или ничего: так fleet-прогоны не ловят взаимную блокировку."""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self._cond:
+            while any(h in self._owners and self._owners[h][0] is not owner for h in hosts):
+                left = deadline - time.monotonic() if deadline is not None else None
+                if left is not None and left <= 0:
+                    return False
+                self._cond.wait(left)
+            for h in hosts:
+                depth = self._owners[h][1] if h in self._owners else 0
+                self._owners[h] = (owner, depth + 1)
+            return True
+
+    def release(self, hosts: List[str], owner: Any) -> None:
+        with self._cond:
+            for h in hosts:
+                held = self._owners.get(h)
+                if held is None or held[0] is not owner:
+                    continue
+                if held[1] > 1:
+                    self._owners[h] = (owner, held[1] - 1)
+                else:
+                    del self._owners[h]
+            self._cond.notify_all()
+
+    def release_all(self, owner: Any) -> None:
+        with self._cond:
+            for h in [h for h, (o, _) in self._owners.items() if o is owner]:
+                del self._owners[h]
+            self._cond.notify_all()
+
+
+CHANGE_LOCKS = HostLocks()
@@ -0,0 +1,206 @@
+"""
+Чтение вывода из SSH-канала по событиям, без sleep-поллинга.
+
+select() на channel просыпается, как только в stdout/stderr пришли данные
+(paramiko сигналит через pipe из Channel.fileno()), а после EOF ждём только
+exit-status через status_event. Таймаут соблюдается точно: каждое ожидание
+ограничено оставшимся до дедлайна временем.
+
+Вывод не копится целиком: на каждый поток держим head-буфер и tail-кольцо
+фиксированного размера и считаем выброшенные байты, так что память на шаг
+не зависит от того, сколько напечатала удалённая команда.
+"""
+
+import codecs
+import os
+import select
+import time
+from typing import Any, Callable, Dict, Optional, Sequence
+
+import paramiko
+
+# (stream, text) -> None; stream: "stdout" | "stderr"
+OutputConsumer = Callable[[str, str], None]
+
+READ_MIN = 32 * 1024
+READ_MAX = 1024 * 1024
+
+# Бюджеты захвата на поток (байты); hard cap — на stdout+stderr вместе,
+# после него канал закрывается, не дожидаясь конца команды (0 — без лимита).
+CAPTURE_HEAD = int(os.environ.get("SSH_CAPTURE_HEAD", str(16 * 1024)))
+CAPTURE_TAIL = int(os.environ.get("SSH_CAPTURE_TAIL", str(16 * 1024)))
+CAPTURE_HARD_CAP = int(os.environ.get("SSH_CAPTURE_HARD_CAP", str(64 * 1024 * 1024)))
+
+
+def _decode_head(data: bytes) -> str:
+    # незаконченный многобайтный символ на конце head просто отбрасываем
+    return codecs.getincrementaldecoder("utf-8")(errors="replace").decode(data)
+
+
+def _decode_tail(data: bytes) -> str:
+    # tail мог начаться с середины символа: пропускаем continuation-байты (10xxxxxx)
+    i = 0
+    while i < min(len(data), 3) and data[i] & 0xC0 == 0x80:
+        i += 1
+    return data[i:].decode("utf-8", errors="replace")
+
+
+class OutputCapture:
+    """
+    Head-буфер + tail-кольцо: первые head_bytes и последние tail_bytes байт
+    потока, середина только считается в dropped.
+    """
+
+    def __init__(self, head_bytes: int = CAPTURE_HEAD, tail_bytes: int = CAPTURE_TAIL):
+        self.head_bytes = head_bytes
+        self.tail_bytes = tail_bytes
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.total = 0
+
+    def write(self, data: bytes) -> None:
+        self.total += len(data)
+        room = self.head_bytes - len(self.head)
+        if room > 0:
+            self.head += data[:room]
+            data = data[room:]
+        if not data or self.tail_bytes <= 0:
+            return
+        if len(data) >= self.tail_bytes:
+            self.tail[:] = data[-self.tail_bytes :]
+            return
+        self.tail += data
+        extra = len(self.tail) - self.tail_bytes
+        if extra > 0:
+            del self.tail[:extra]
+
+    @property
+    def dropped(self) -> int:
+        return self.total - len(self.head) - len(self.tail)
+
+    def text(self) -> str:
+        if self.dropped == 0:
+            return bytes(self.head + self.tail).decode("utf-8", errors="replace")
+        return (
+            _decode_head(bytes(self.head))
+            + f"\n[... {self.dropped} bytes dropped ...]\n"
+            + _decode_tail(bytes(self.tail))
+        )
+
+
+class _Stream:
+    def __init__(
+        self,
+        name: str,
+        recv: Callable[[int], bytes],
+        consumers: Sequence[OutputConsumer],
+        capture: OutputCapture,
+    ):
+        self.name = name
+        self.recv = recv
+        self.consumers = consumers
+        self.capture = capture
+        self.read_size = READ_MIN
+        # потребителям отдаём текст; символ, разрезанный границей чанка,
+        # декодер допишет в следующем вызове
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    @property
+    def nbytes(self) -> int:
+        return self.capture.total
+
+    def feed(self, data: bytes, final: bool = False) -> None:
+        self.capture.write(data)
+        if not self.consumers:
+            return
+        text = self.decoder.decode(data, final)
+        if not text:
+            return
+        for fn in self.consumers:
+            fn(self.name, text)
+
+    def drain(self, ready: Callable[[], bool], budget: float) -> None:
+        while ready() and self.nbytes < budget:
+            data = self.recv(self.read_size)
+            if not data:
+                break
+            # буфер отдали целиком — читаем крупнее, иначе возвращаемся к минимуму
+            if len(data) >= self.read_size:
+                self.read_size = min(self.read_size * 2, READ_MAX)
+            else:
+                self.read_size = READ_MIN
+            self.feed(data)
+
+    def text(self) -> str:
+        self.feed(b"", final=True)
+        return self.capture.text()
+
+
+def read_channel(
+    channel: paramiko.Channel,
+    timeout: float,
+    consumers: Sequence[OutputConsumer] = (),
+    head_bytes: int = CAPTURE_HEAD,
+    tail_bytes: int = CAPTURE_TAIL,
+    hard_cap: int = CAPTURE_HARD_CAP,
+) -> Dict[str, Any]:
+    """
+    Читает stdout/stderr уже запущенной команды до exit-status или дедлайна.
+    Возвращает stdout, stderr (head + tail), exit_code (None при таймауте или
+    hard cap), timed_out, capped, число принятых и выброшенных байт.
+    """
+    deadline = time.monotonic() + timeout
+    out = _Stream(
+        "stdout", channel.recv, consumers, OutputCapture(head_bytes, tail_bytes)
+    )
+    err = _Stream(
+        "stderr", channel.recv_stderr, consumers, OutputCapture(head_bytes, tail_bytes)
+    )
+    cap = hard_cap if hard_cap > 0 else float("inf")
+    timed_out = False
+    capped = False
+
+    while True:
+        out.drain(channel.recv_ready, cap - err.nbytes)
+        err.drain(channel.recv_stderr_ready, cap - out.nbytes)
+
+        if out.nbytes + err.nbytes >= cap:
+            capped = True
+            break
+
+        if channel.exit_status_ready() and not (
+            channel.recv_ready() or channel.recv_stderr_ready()
+        ):
+            break
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            timed_out = True
+            break
+
+        if channel.eof_received:
+            # данных больше не будет, а pipe остаётся "готовым" — select крутился бы
+            # вхолостую; ждём exit-status (close тоже выставляет status_event)
+            if not channel.status_event.wait(remaining):
+                timed_out = True
+                break
+            continue
+
+        select.select([channel], [], [], remaining)
+
+    exit_code: Optional[int] = None
+    if timed_out or capped:
+        channel.close()
+    elif channel.exit_status_ready():
+        exit_code = channel.recv_exit_status()
+
+    return {
+        "stdout": out.text(),
+        "stderr": err.text(),
+        "exit_code": exit_code,
+        "timed_out": timed_out,
+        "capped": capped,
+        "bytes_in": out.nbytes + err.nbytes,
+        "stdout_dropped": out.capture.dropped,
+        "stderr_dropped": err.capture.dropped,
+    }
@@ -0,0 +1,145 @@
+"""
+Хранилище шагов agent.py вне состояния графа.
+
+Раньше AgentState держал в steps каждый шаг с выводом, а в transcript — сырые
+ответы планировщика. LangGraph копирует состояние через каждый узел и пишет
+его в чекпойнт, так что накладные расходы узла росли с длиной прогона.
+Теперь в состоянии только короткие ссылки (ref): номер шага и поля, по
+которым решают critic и плейбуки. Сам шаг лежит здесь.
+
+Диск — это JSONL-сайдкар отчёта (report_stream): шаг попадает туда сразу, и
+номер шага совпадает с номером строки. Память — общий для всех прогонов
+процесса LRU-кэш в пределах MEM_BYTES. Вытесненный шаг читается из
+сайдкара по смещению строки. После --resume в новом процессе смещения
+восстанавливаются одним проходом по файлу.
+
+Транскрипт планировщика (ответ модели, разобранный план, команды) пишется
+только в <отчёт>.transcript.jsonl рядом с отчётом.
+"""
+
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from report_stream import ReportWriter, StepRenderer
+
+MEM_BYTES = int(float(os.environ.get("AGENT_STEP_STORE_MB", "32")) * 1024 * 1024)
+
+# поля шага, которые остаются в состоянии графа (critic, плейбуки, бюджет)
+REF_FIELDS = ("cmd", "kind", "ok", "exit_code", "round", "background")
+
+
+def make_ref(n: int, step: Dict[str, Any]) -> Dict[str, Any]:
+    ref: Dict[str, Any] = {"id": n}
+    for k in REF_FIELDS:
+        if step.get(k) is not None:
+            ref[k] = step[k]
+    return ref
+
+
+class StepStore:
+    def __init__(self, mem_bytes: int = MEM_BYTES):
+        self.mem_bytes = mem_bytes
+        self._lock = threading.Lock()
+        # (отчёт, номер шага) -> (шаг, размер строки в сайдкаре)
+        self._cache: "OrderedDict[Tuple[str, int], Tuple[Dict[str, Any], int]]" = OrderedDict()
+        self._used = 0
+        # отчёт -> смещения строк сайдкара (индекс = номер шага - 1)
+        self._offsets: Dict[str, List[int]] = {}
+        self._writers: Dict[str, ReportWriter] = {}
+
+    def _writer(self, path: str) -> ReportWriter:
+        # один writer на прогон: ReportWriter() считает строки сайдкара при создании
+        w = self._writers.get(path)
+        if w is None:
+            w = self._writers[path] = ReportWriter(Path(path))
+        return w
+
+    def _index(self, path: str) -> List[int]:
+        offs = self._offsets.get(path)
+        if offs is None:
+            offs = []
+            sidecar = Path(path).with_suffix(".jsonl")
+            if sidecar.exists():
+                pos = 0
+                with open(sidecar, "rb") as f:
+                    for line in f:
+                        if line.strip():
+                            offs.append(pos)
+                        pos += len(line)
+            self._offsets[path] = offs
+        return offs
+
+    def _remember(self, key: Tuple[str, int], step: Dict[str, Any], size: int) -> None:
+        old = self._cache.pop(key, None)
+        if old is not None:
+            self._used -= old[1]
+        self._cache[key] = (step, size)
+        self._used += size
+        while self._used > self.mem_bytes and len(self._cache) > 1:
+            _, (_, freed) = self._cache.popitem(last=False)
+            self._used -= freed
+
+    def add(self, path: str, step: Dict[str, Any], render: StepRenderer) -> Dict[str, Any]:
+        """Шаг в отчёт, сайдкар и кэш; возвращает ref для состояния графа."""
+        with self._lock:
+            writer = self._writer(path)
+            offs = self._index(path)
+            start = writer.sidecar.stat().st_size if writer.sidecar.exists() else 0
+            slim = writer.add_step(step, render)
+            n = writer.steps
+            offs.append(start)
+            self._remember((path, n), slim, writer.sidecar.stat().st_size - start)
+        return make_ref(n, slim)
+
+    def get(self, path: str, ids: List[int]) -> List[Dict[str, Any]]:
+        """Шаги по номерам, в том же порядке."""
+        out: List[Optional[Dict[str, Any]]] = []
+        missing = []
+        with self._lock:
+            for i in ids:
+                hit = self._cache.get((path, i))
+                if hit is None:
+                    missing.append(len(out))
+                    out.append(None)
+                else:
+                    self._cache.move_to_end((path, i))
+                    out.append(hit[0])
+            offs = list(self._index(path)) if missing else []
+        if missing:
+            sidecar = Path(path).with_suffix(".jsonl")
+            with open(sidecar, "rb") as f:
+                for pos in missing:
+                    n = ids[pos]
+                    f.seek(offs[n - 1])
+                    line = f.readline()
+                    step = json.loads(line)
+                    out[pos] = step
+                    with self._lock:
+                        self._remember((path, n), step, len(line))
+        return out  # type: ignore[return-value]
+
+    def note(self, path: str, role: str, content: str) -> None:
+        """Запись транскрипта планировщика (в память не идёт)."""
+        rec = {"ts": time.time(), "role": role, "content": content}
+        with open(Path(path).with_suffix(".transcript.jsonl"), "a", encoding="utf-8") as f:
+            f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+
+    def close(self, path: str) -> None:
+        """Прогон закончен: его шаги и writer больше не держим."""
+        with self._lock:
+            for key in [k for k in self._cache if k[0] == path]:
+                self._used -= self._cache.pop(key)[1]
+            self._offsets.pop(path, None)
+            self._writers.pop(path, None)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"steps": len(self._cache), "bytes": self._used, "runs": len(self._offsets)}
+
+
+STEPS = StepStore()